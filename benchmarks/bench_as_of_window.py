@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DataMerger._merge_horse_results（馬の過去成績の直近nレース・全レースの集計）について、
+従来の日付ごとにqueryで過去成績を絞り込んで集計・マージする実装と、
+AsOfWindowAggregatorによる1回の走査での実装の処理時間を比較し、出力が一致することを確認する。
+
+使い方（プロジェクトルートで実行）:
+    python benchmarks/bench_as_of_window.py [レース日数（デフォルト: 500）] [1日あたりの出走数（デフォルト: 300）]
+"""
+
+import os
+import sys
+import time
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+from tqdm.auto import tqdm
+
+# modules を sys.path に追加
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.preprocessing import DataMerger
+
+TARGET_COLS = ['着順', '賞金', '着差', 'first_corner', 'final_corner', 'time_seconds']
+GROUP_COLS = ['course_len', 'race_type', '開催']
+
+
+class DataMergerBefore(DataMerger):
+    """
+    従来の実装（レース日ごとに過去成績をqueryで絞り込み、直近nレース・group_colごとに集計してマージする）
+    """
+    def _merge_horse_results(self, n_races_list=[5, 9]):
+        self._load_horse_results()
+        separated_results_dict = {}
+        separated_horse_results_dict = {}
+        for date, df_by_date in tqdm(self._results.groupby('date')):
+            separated_results_dict[date] = df_by_date
+            horse_id_list = df_by_date['horse_id'].unique()
+            separated_horse_results_dict[date] = self._horse_results\
+                .query('date < @date').query('index in @horse_id_list')
+        output_results_dict = {}
+        for date in tqdm(separated_results_dict):
+            results = separated_results_dict[date].copy()
+            horse_results = separated_horse_results_dict[date].copy()
+            for n_races in n_races_list:
+                n_race_horse_results = horse_results.sort_values('date', ascending=False)\
+                    .groupby(level=0).head(n_races)
+                summarized = n_race_horse_results.groupby(level=0)[self._target_cols].mean()\
+                    .add_suffix('_{}R'.format(n_races))
+                results = results.merge(summarized, left_on='horse_id', right_index=True, how='left')
+                for group_col in self._group_cols:
+                    summarized_with = n_race_horse_results.groupby(['horse_id', group_col])[self._target_cols]\
+                        .mean().add_suffix('_{}_{}R'.format(group_col, n_races))
+                    results = results.merge(summarized_with, left_on=['horse_id', group_col],
+                                            right_index=True, how='left')
+            summarized = horse_results.groupby(level=0)[self._target_cols].mean().add_suffix('_allR')
+            results = results.merge(summarized, left_on='horse_id', right_index=True, how='left')
+            for group_col in self._group_cols:
+                summarized_with = horse_results.groupby(['horse_id', group_col])[self._target_cols].mean()\
+                    .add_suffix('_{}_allR'.format(group_col))
+                results = results.merge(summarized_with, left_on=['horse_id', group_col],
+                                        right_index=True, how='left')
+            latest = horse_results.groupby('horse_id')['date'].max().rename('latest')
+            results = results.merge(latest, left_on='horse_id', right_index=True, how='left')
+            output_results_dict[date] = results
+        self._merged_data = pd.concat([output_results_dict[date] for date in output_results_dict])
+
+
+def make_data(n_days: int, runners_per_day: int, seed: int = 0):
+    """
+    レース結果（results）と、前処理済みの馬の過去成績（horse_results）と同じ形式のダミーデータ。
+    過去成績は、レース結果と同じ出走の成績（各レースでは、それより前の日付の分だけが集計される）。
+    """
+    rng = np.random.default_rng(seed)
+    n_horses = n_days * runners_per_day // 15
+    dates = pd.Timestamp('2015-01-03') + pd.to_timedelta(np.sort(rng.choice(3000, n_days, replace=False)), 'D')
+    n_rows = n_days * runners_per_day
+    runs = pd.DataFrame({
+        'date': np.repeat(dates, runners_per_day),
+        'horse_id': np.array(['{:010d}'.format(i) for i in range(n_horses)])[rng.integers(0, n_horses, n_rows)],
+        'course_len': rng.choice([1200, 1400, 1600, 1800, 2000, 2400], n_rows),
+        'race_type': rng.choice(['芝', 'ダート', '障害'], n_rows),
+        '開催': rng.choice(['01', '02', '05', '06', '08', '09'], n_rows),
+        })
+    # 同じ馬が同じ日に2回出走することはない
+    runs = runs.drop_duplicates(['date', 'horse_id']).reset_index(drop=True)
+    n_rows = len(runs)
+    history = runs.copy()
+    history['着順'] = rng.integers(1, 19, n_rows).astype(float)
+    history['賞金'] = np.where(history['着順'] <= 5, rng.uniform(100, 5000, n_rows).round(1), 0.0)
+    history['着差'] = np.where(rng.random(n_rows) < 0.05, np.nan, rng.uniform(0, 3, n_rows).round(1))
+    history['first_corner'] = rng.integers(1, 19, n_rows).astype(float)
+    history['final_corner'] = rng.integers(1, 19, n_rows).astype(float)
+    history['time_seconds'] = rng.uniform(60, 200, n_rows).round(1)
+    results = runs.set_index(pd.Index(np.arange(n_rows) // 16, name='race_id'))
+    return results, history.set_index('horse_id')
+
+
+def make_merger(merger_class, results, horse_results):
+    horse_results_processor = SimpleNamespace(fetch=lambda horse_id_list, date_to: horse_results)
+    merger = merger_class.__new__(merger_class)
+    merger._results = results
+    merger._horse_results_processor = horse_results_processor
+    merger._horse_results = pd.DataFrame()
+    merger._target_cols = TARGET_COLS
+    merger._group_cols = GROUP_COLS
+    merger._merged_data = pd.DataFrame()
+    merger._requirements = None
+    return merger
+
+
+def measure(merger_class, results, horse_results):
+    merger = make_merger(merger_class, results, horse_results)
+    start = time.perf_counter()
+    merger._merge_horse_results()
+    return time.perf_counter() - start, merger.merged_data
+
+
+if __name__ == '__main__':
+    n_days = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    runners_per_day = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    results, horse_results = make_data(n_days, runners_per_day)
+    print('レース日{:,}日、出走{:,}行、過去成績{:,}行'.format(n_days, len(results), len(horse_results)))
+    t_before, out_before = measure(DataMergerBefore, results, horse_results)
+    print('before: {:.1f}秒'.format(t_before))
+    t_after, out_after = measure(DataMerger, results, horse_results)
+    print('after:  {:.1f}秒（{:.0f}x）'.format(t_after, t_before / t_after))
+    pd.testing.assert_frame_equal(out_before, out_after)
+    print('出力は一致しました')
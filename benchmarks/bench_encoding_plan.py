@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+カテゴリ変数のエンコーディングについて、従来のdumminize_*の連鎖（get_dummiesを7回）と
+EncodingPlan（ダミー変数を1回で結合 / LightGBMのカテゴリ変数）の、変換時間・列数・学習と予測の時間を比較する。
+
+学習・予測の時間は、REPEAT回測った中央値。
+
+使い方（プロジェクトルートで実行）:
+    python benchmarks/bench_encoding_plan.py [行数（デフォルト: 200000）]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+
+# modules を sys.path に追加
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.preprocessing import EncodingPlan
+
+# 学習・予測の時間を測る回数
+REPEAT = 3
+
+
+def make_data(n_rows: int, n_numeric: int = 150, seed: int = 0) -> pd.DataFrame:
+    """
+    マージ後のテーブルと同じカテゴリ変数の列（欠損値を含む）と、数値の列を持つダミーデータ
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({col: rng.choice(list(vocabulary) + [None], n_rows)
+                       for col, vocabulary in EncodingPlan.CATEGORICALS})
+    for i in range(n_numeric):
+        df['feature_{}'.format(i)] = rng.normal(size=n_rows)
+    df['rank'] = (rng.random(n_rows) < 0.2).astype(int)
+    return df
+
+
+def chained_get_dummies(df: pd.DataFrame) -> pd.DataFrame:
+    """従来の実装（dumminize_*を順に呼んだ場合と同じ処理）"""
+    for col, vocabulary in EncodingPlan.CATEGORICALS:
+        df[col] = pd.Categorical(df[col], list(vocabulary))
+        df = pd.get_dummies(df, columns=[col])
+    return df
+
+
+def measure(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def fit_predict(X: pd.DataFrame, y: pd.Series):
+    """学習・予測の時間（REPEAT回の中央値）"""
+    matrix = EncodingPlan.feature_matrix(X).astype(float)
+    t_fits, t_predicts = [], []
+    for _ in range(REPEAT):
+        model = lgb.LGBMClassifier(objective='binary', n_estimators=100, verbose=-1)
+        t_fit, _ = measure(lambda: model.fit(
+            matrix, y, categorical_feature=EncodingPlan.categorical_indices(X) or 'auto'))
+        t_predict, _ = measure(model.predict_proba, matrix)
+        t_fits.append(t_fit)
+        t_predicts.append(t_predict)
+    return np.median(t_fits), np.median(t_predicts)
+
+
+if __name__ == '__main__':
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    df = make_data(n_rows)
+    print('{:,}行'.format(n_rows))
+    print('{:<24}{:>8}{:>12}{:>12}{:>12}'.format('処理', '列数', '変換 (s)', '学習 (s)', '予測 (s)'))
+    t_before, before = measure(chained_get_dummies, df.copy())
+    t_onehot, onehot = measure(EncodingPlan().apply, df)
+    pd.testing.assert_frame_equal(before, onehot)
+    t_native, native = measure(EncodingPlan(native=True).apply, df)
+    for name, t_encode, X in [
+            ('get_dummies x7', t_before, before),
+            ('EncodingPlan (one-hot)', t_onehot, onehot),
+            ('EncodingPlan (native)', t_native, native),
+            ]:
+        t_fit, t_predict = fit_predict(X.drop('rank', axis=1), X['rank'])
+        print('{:<24}{:>8}{:>12.2f}{:>12.2f}{:>12.2f}'.format(name, X.shape[1] - 1, t_encode, t_fit, t_predict))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+JockeyStatsProcessorの直近10/50レースの集計について、
+従来の騎手ごとのgroupby.apply（_calc_group）と、累積和の差分による実装の処理時間を比較し、出力が一致することを確認する。
+
+使い方（プロジェクトルートで実行）:
+    python benchmarks/bench_jockey_stats.py [行数（デフォルト: 1500000）] [騎手数（デフォルト: 3000）]
+"""
+
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+
+# modules を sys.path に追加
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.preprocessing import JockeyStatsProcessor
+
+
+class JockeyStatsProcessorBefore(JockeyStatsProcessor):
+    """
+    従来の実装（騎手ごとにgroupby.applyでshift + rollingを計算する）
+    """
+    @staticmethod
+    def _add_rolling_stats(df, keys):
+        def _calc_group(group: pd.DataFrame) -> pd.DataFrame:
+            plc_shifted = group['plc_flag'].shift(1)
+            ride_flag = (~plc_shifted.isna()).astype(int)
+            rides_10 = ride_flag.rolling(window=10, min_periods=1).sum()
+            rate_10 = plc_shifted.rolling(window=10, min_periods=1).mean()
+            rides_50 = ride_flag.rolling(window=50, min_periods=1).sum()
+            rate_50 = plc_shifted.rolling(window=50, min_periods=1).mean()
+            group['jockey_rides_10_all'] = rides_10.fillna(0).astype(int)
+            group['jockey_plc_rate_10_all'] = rate_10
+            group['jockey_rides_50_all'] = rides_50.fillna(0).astype(int)
+            group['jockey_plc_rate_50_all'] = rate_50
+            group['jockey_has_history_flag'] = (rides_50 > 0).astype(int)
+            return group
+
+        df = df.groupby('_jockey_key', group_keys=False).apply(_calc_group)
+        # その日の終わり時点の値の列は比較しない（出力の列を揃えるため、欠損値で追加する）
+        for col in JockeyStatsProcessor.STATS_COLS:
+            df[col + JockeyStatsProcessor.AFTER_DAY_SUFFIX] = np.nan
+        return df
+
+
+def make_horse_results(n_rows: int, n_jockeys: int, seed: int = 0) -> pd.DataFrame:
+    """
+    horse_resultsのrawデータと同じ形式（インデックス: horse_id、日付・着順・騎手の列）のダミーデータ
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2000-01-01', '2023-12-31', freq='D').strftime('%Y/%m/%d').to_numpy()
+    horse_ids = np.array(['{:010d}'.format(i) for i in range(n_rows // 10 + 1)])
+    rank = rng.integers(1, 19, n_rows).astype(str).astype(object)
+    rank[rng.random(n_rows) < 0.02] = '中止'
+    return pd.DataFrame({
+        '日付': rng.choice(dates, n_rows),
+        '着順': rank,
+        '騎手': np.array(['騎手{}'.format(i) for i in range(n_jockeys)])[rng.integers(0, n_jockeys, n_rows)],
+        }, index=rng.choice(horse_ids, n_rows))
+
+
+def measure_rolling(processor_class, raw):
+    """
+    集計部分（_add_rolling_stats）だけの処理時間
+    """
+    df = pd.DataFrame({
+        '_jockey_key': raw['騎手'].astype(str).to_numpy(),
+        'date': pd.to_datetime(raw['日付']).to_numpy(),
+        'plc_flag': pd.to_numeric(raw['着順'], errors='coerce').between(1, 3).astype(int).to_numpy(),
+        }).sort_values(['_jockey_key', 'date'])
+    start = time.perf_counter()
+    processor_class._add_rolling_stats(df, df['_jockey_key'].to_numpy())
+    return time.perf_counter() - start
+
+
+def measure(processor_class, filepath):
+    start = time.perf_counter()
+    out = processor_class(filepath, use_cache=False).preprocessed_data
+    return time.perf_counter() - start, out
+
+
+if __name__ == '__main__':
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1500000
+    n_jockeys = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filepath = os.path.join(tmp_dir, 'horse_results.pickle')
+        raw = make_horse_results(n_rows, n_jockeys)
+        raw.to_pickle(filepath)
+        print('{:,}行、騎手{:,}人'.format(n_rows, n_jockeys))
+        t_before = measure_rolling(JockeyStatsProcessorBefore, raw)
+        t_after = measure_rolling(JockeyStatsProcessor, raw)
+        print('集計部分 before: {:.2f}秒 after: {:.2f}秒（{:.0f}x）'.format(t_before, t_after, t_before / t_after))
+        t_before, out_before = measure(JockeyStatsProcessorBefore, filepath)
+        print('前処理全体 before: {:.1f}秒'.format(t_before))
+        t_after, out_after = measure(JockeyStatsProcessor, filepath)
+        print('前処理全体 after:  {:.1f}秒（{:.1f}x）'.format(t_after, t_before / t_after))
+        compared = ['jockey_id'] + JockeyStatsProcessor.STATS_COLS
+        pd.testing.assert_frame_equal(out_before[compared], out_after[compared])
+        print('出力は一致しました')
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HorseResultsProcessor・ResultsProcessorの文字列パース処理について、
+従来の行ごとの処理（map(lambda)、apply、re.findall）と_string_kernelsの処理速度（rows/sec）を比較する。
+
+使い方（プロジェクトルートで実行）:
+    python benchmarks/bench_string_kernels.py [行数（デフォルト: 1000000）]
+"""
+
+import os
+import re
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+# modules を sys.path に追加
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules.preprocessing import _string_kernels as kernels
+
+
+def make_data(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    horse_results・resultsのrawデータと同じ形式の列を持つダミーデータ
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range('2010-01-01', '2023-12-31', freq='D').strftime('%Y/%m/%d').to_numpy()
+    corners = np.array(['{}-{}-{}-{}'.format(*rng.integers(1, 19, 4)) for _ in range(5000)] + ['3-2', '12'])
+    times = np.array(['{}:{:02d}.{}'.format(m, s, f)
+                      for m in (0, 1, 2, 3) for s in range(60) for f in range(10)] + ['1.34.5', '1:34:5'])
+    df = pd.DataFrame({
+        '日付': rng.choice(dates, n_rows),
+        '着差': np.round(rng.uniform(-1, 5, n_rows), 1),
+        '通過': np.where(rng.random(n_rows) < 0.05, None, rng.choice(corners, n_rows)).astype(object),
+        'タイム': np.where(rng.random(n_rows) < 0.02, None, rng.choice(times, n_rows)).astype(object),
+        '性齢': rng.choice(['牡', '牝', 'セ'], n_rows).astype(object) + rng.integers(2, 10, n_rows).astype(str),
+        '馬体重': np.where(rng.random(n_rows) < 0.01, '計不',
+                        pd.Series(rng.integers(400, 560, n_rows)).astype(str) + '(+' +
+                        pd.Series(rng.integers(0, 20, n_rows)).astype(str) + ')'),
+        '着順': np.where(rng.random(n_rows) < 0.02, rng.choice(['取消', '中止', '除外'], n_rows),
+                       rng.integers(1, 19, n_rows).astype(str)),
+        })
+    df.loc[rng.random(n_rows) < 0.01, '着差'] = np.nan
+    return df
+
+
+# 従来の実装
+def corner_before(s, n):
+    def corner(x, n):
+        if type(x) != str:
+            return x
+        elif n == 4:
+            return int(re.findall(r'\d+', x)[-1])
+        elif n == 1:
+            return int(re.findall(r'\d+', x)[0])
+    return s.map(lambda x: corner(x, n))
+
+
+def time_before(s):
+    baseformat = '%M:%S.%f'
+    basetime = pd.to_datetime("00:00.0", format=baseformat)
+    to_datetime = lambda x: pd.to_datetime(s, format=x, errors='coerce')
+    datetime_s = to_datetime(baseformat)
+    for format_ in ['%M.%S.%f', '%M:%S:%f']:
+        datetime_s = datetime_s.fillna(to_datetime(format_))
+    return (datetime_s - basetime).dt.total_seconds()
+
+
+def rank_before(s):
+    s = s.apply(lambda x: x if str(x).isdigit() else (-1 if x == "取消" else 0))
+    return pd.to_numeric(s, errors='coerce').fillna(0).astype(int)
+
+
+def weight_before(s):
+    weight = pd.to_numeric(s.str.split("(", expand=True)[0], errors='coerce')
+    diff = pd.to_numeric(s.str.split("(", expand=True)[1].str[:-1], errors='coerce')
+    return weight, diff
+
+
+def sex_age_before(s):
+    return s.map(lambda x: str(x)[0]), pd.to_numeric(s.map(lambda x: str(x)[1:]), errors='coerce')
+
+
+CASES = [
+    ('日付', '日付', lambda s: pd.to_datetime(s), kernels.to_datetime_unique),
+    ('着差', '着差', lambda s: s.map(lambda x: 0 if x < 0 else x), kernels.clip_negative),
+    ('first_corner', '通過', lambda s: corner_before(s, 1), kernels.first_number),
+    ('final_corner', '通過', lambda s: corner_before(s, 4), kernels.last_number),
+    ('time_seconds', 'タイム', time_before, kernels.race_time_to_seconds),
+    ('性・年齢', '性齢', sex_age_before, kernels.split_sex_age),
+    ('体重・体重変化', '馬体重', weight_before, kernels.split_weight_and_diff),
+    ('着順', '着順', rank_before, kernels.parse_rank),
+    ]
+
+
+def measure(func, s):
+    start = time.perf_counter()
+    result = func(s)
+    return time.perf_counter() - start, result
+
+
+def assert_same(before, after):
+    before = before if isinstance(before, tuple) else (before,)
+    after = after if isinstance(after, tuple) else (after,)
+    for b, a in zip(before, after):
+        pd.testing.assert_series_equal(b, a, check_names=False, check_dtype=False)
+
+
+if __name__ == '__main__':
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    df = make_data(n_rows)
+    print('{:,}行'.format(n_rows))
+    print('{:<16}{:>18}{:>18}{:>10}'.format('処理', 'before (rows/s)', 'after (rows/s)', '倍率'))
+    total_before = total_after = 0
+    for name, col, before, after in CASES:
+        t_before, r_before = measure(before, df[col])
+        t_after, r_after = measure(after, df[col])
+        assert_same(r_before, r_after)
+        total_before += t_before
+        total_after += t_after
+        print('{:<16}{:>18,.0f}{:>18,.0f}{:>9.1f}x'.format(
+            name, n_rows / t_before, n_rows / t_after, t_before / t_after))
+    print('{:<16}{:>18,.0f}{:>18,.0f}{:>9.1f}x'.format(
+        '合計', n_rows / total_before, n_rows / total_after, total_before / total_after))
@@ -26,7 +26,18 @@ class LocalPaths:
     ### tmpディレクトリのパス
     TMP_DIR: str = os.path.join(DATA_DIR, 'tmp')
     JOCKEY_STATS_PATH: str = os.path.join(TMP_DIR, 'jockey_stats.pickle')
+    ENTITY_FORM_PATH: str = os.path.join(TMP_DIR, 'entity_form.pickle')
+    PEDIGREE_FORM_PATH: str = os.path.join(TMP_DIR, 'pedigree_form.pickle')
+    ENTITY_FORM_STATE_PATH: str = os.path.join(TMP_DIR, 'entity_form_state.pickle')
+    PEDIGREE_FORM_STATE_PATH: str = os.path.join(TMP_DIR, 'pedigree_form_state.pickle')
+    EXPANDING_STATE_PATH: str = os.path.join(TMP_DIR, 'horse_results_expanding_state.pickle')
+    STANDARD_TIME_PATH: str = os.path.join(TMP_DIR, 'standard_time.pickle')
+    HORSE_RESULTS_STORE_DIR: str = os.path.join(TMP_DIR, 'horse_results_store')
+    PREPROCESSING_CACHE_DIR: str = os.path.join(TMP_DIR, 'preprocessing_cache')
+    FEATURE_STORE_DIR: str = os.path.join(TMP_DIR, 'feature_store')
+    LGB_DATASET_DIR: str = os.path.join(TMP_DIR, 'lgb_datasets')
 
     ### masterディレクトリのパス
     MASTER_DIR: str = os.path.join(DATA_DIR, 'master')
-    MASTER_RAW_HORSE_RESULTS_PATH: str = os.path.join(MASTER_DIR, 'horse_results_updated_at.csv')
\ No newline at end of file
+    MASTER_RAW_HORSE_RESULTS_PATH: str = os.path.join(MASTER_DIR, 'horse_results_updated_at.csv')
+    MASTER_PEDS_ANCESTORS_PATH: str = os.path.join(MASTER_DIR, 'peds_ancestors.csv')
\ No newline at end of file
@@ -69,11 +69,27 @@ def race_type_dict_default_factory():
         '障': '障害',
     })
 
+def bet_type_dict_default_factory():
+    # 払い戻し表の券種と、ReturnProcessorの出力（bet_type列）のコード
+    return MappingProxyType({
+        '単勝': 1,
+        '複勝': 2,
+        '枠連': 3,
+        '馬連': 4,
+        'ワイド': 5,
+        '馬単': 6,
+        '三連複': 7,
+        '三連単': 8,
+    })
+
 @dataclass(frozen=True)
 class Master:
     # クラス属性として定義
     PLACE_DICT = place_dict_default_factory()
     RACE_TYPE_DICT = race_type_dict_default_factory()
+    BET_TYPE_DICT = bet_type_dict_default_factory()
+    # 着順を問わない（馬番を昇順に並べて持つ）券種
+    UNORDERED_BET_TYPES: tuple = ('枠連', '馬連', 'ワイド', '三連複')
     
     WEATHER_LIST: tuple = ('晴', '曇', '小雨', '雨', '小雪', '雪')
     
@@ -5,13 +5,8 @@ import pandas as pd
 
 from modules.constants import ResultsCols
 import numpy as np
-from pandas.api.types import (
-    is_datetime64_any_dtype,
-    is_datetime64tz_dtype,
-    is_timedelta64_dtype,
-    is_bool_dtype,
-)
 import warnings
+import weakref
 
 
 # const
@@ -19,162 +14,228 @@ _SCORE = 'score'
 
 
 # common funcs
-def _calc(model, X: pd.DataFrame) -> pd.DataFrame:
-    # メタ列（例: race_id, 馬番）は結果用に保持し、予測には使わない
-    uma = X[ResultsCols.UMABAN] if ResultsCols.UMABAN in X.columns else None
-    race = X['race_id'] if 'race_id' in X.columns else None
-
-    score_table = pd.DataFrame(index=X.index)
-    if race is not None:
-        score_table['race_id'] = race
-    if uma is not None:
-        score_table[ResultsCols.UMABAN] = uma
-
-    # 特徴量として使う列を決定（メタ列を除外）
-    meta_cols = []
-    if ResultsCols.UMABAN in X.columns:
-        meta_cols.append(ResultsCols.UMABAN)
-    if 'race_id' in X.columns:
-        meta_cols.append('race_id')
-    x_cols = [c for c in X.columns if c not in meta_cols]
-    # モデルが期待する特徴量数を取得
-    n_model = getattr(model, 'n_features_', None)
-    if n_model is None:
-        booster = getattr(model, 'booster_', None)
-        if booster is not None:
-            try:
-                n_model = booster.num_feature()
-            except Exception:
-                n_model = None
+# (列の型の種類) ごとの変換: カテゴリ→コード、datetime/timedelta→秒、それ以外（数値・bool）→float
+_DTYPE_KINDS = {'M': 'datetime', 'm': 'timedelta'}
 
-    # 互換性対応:
-    # 過去に UMABAN も含めて学習したモデルでは
-    #   ・学習時の特徴量数 == 入力Xの列数
-    # となっているため、その場合は UMABAN も特徴量として残す
-    # ただし race_id は常に特徴量から除外する
-    if n_model is not None and n_model == X.shape[1] and ResultsCols.UMABAN in X.columns:
-        x_cols = [c for c in X.columns if c != 'race_id']
 
-    # モデルが学習した列に整列（不足は0埋め、余剰は落とす）
-    # ToDo4: KeibaAI側で注入する学習時列（mykeiba_feature_columns_）を最優先で使う
-    mykeiba_cols = getattr(model, 'mykeiba_feature_columns_', None)
+def _column_kind(dtype) -> str:
+    if isinstance(dtype, pd.CategoricalDtype):
+        return 'category'
+    return _DTYPE_KINDS.get(dtype.kind, 'numeric')
+
+
+# モデルごとのFeatureSchema（(列名, 列の型の種類, 学習時の列) → FeatureSchema）。モデルが消えると一緒に消える
+_SCHEMAS = weakref.WeakKeyDictionary()
 
-    feature_names = getattr(model, 'feature_name_', None)
-    if feature_names is None:
-        try:
-            feature_names = model.booster_.feature_name()
-        except Exception:
-            feature_names = None
 
-    # モデルの期待特徴量数
-    n_model = getattr(model, 'n_features_in_', None)
-    if n_model is None:
+class FeatureSchema:
+    """
+    モデルに渡す特徴量の配列を、入力Xからどう作るかを（モデル, Xの列の並びと型）ごとに1度だけ決めておくもの。
+        - 使う列: 学習時の列（mykeiba_feature_columns_）、LightGBMのfeature名、Xの列の順で選ぶ
+        - 各列の、Xの中の位置（ない列は0埋め）と変換（カテゴリ→コード、datetime/timedelta→秒、その他→float）
+        - 列名が合わない場合の、列数の切り詰め・0埋め
+    スコアの計算は、同じ種類の列をまとめて取り出して変換し、inf・欠損値を0にした配列で予測するだけになる。
+    for_model()は、同じモデル・同じ列の並びと型のXについては、前回作ったものを返す。
+    """
+    def __init__(self, model, columns: pd.Index, kinds: tuple):
+        """
+        初期処理
+        """
+        columns = list(columns)
+        # メタ列（例: race_id, 馬番）は結果用に保持し、予測には使わない
+        x_cols = [c for c in columns if c not in (ResultsCols.UMABAN, 'race_id')]
+
+        # モデルが期待する特徴量数を取得
         n_model = getattr(model, 'n_features_', None)
-    if n_model is None and feature_names is not None:
-        try:
-            n_model = len(feature_names)
-        except Exception:
-            n_model = None
-    if n_model is None:
-        booster = getattr(model, 'booster_', None)
-        if booster is not None:
+        if n_model is None:
+            n_model = self.__booster_num_feature(model)
+
+        # 互換性対応:
+        # 過去に UMABAN も含めて学習したモデルでは
+        #   ・学習時の特徴量数 == 入力Xの列数
+        # となっているため、その場合は UMABAN も特徴量として残す
+        # ただし race_id は常に特徴量から除外する
+        if n_model is not None and n_model == len(columns) and ResultsCols.UMABAN in columns:
+            x_cols = [c for c in columns if c != 'race_id']
+
+        # モデルが学習した列に整列（不足は0埋め、余剰は落とす）
+        # ToDo4: KeibaAI側で注入する学習時列（mykeiba_feature_columns_）を最優先で使う
+        mykeiba_cols = getattr(model, 'mykeiba_feature_columns_', None)
+
+        feature_names = getattr(model, 'feature_name_', None)
+        if feature_names is None:
             try:
-                n_model = booster.num_feature()
+                feature_names = model.booster_.feature_name()
+            except Exception:
+                feature_names = None
+
+        # モデルの期待特徴量数
+        n_model = getattr(model, 'n_features_in_', None)
+        if n_model is None:
+            n_model = getattr(model, 'n_features_', None)
+        if n_model is None and feature_names is not None:
+            try:
+                n_model = len(feature_names)
             except Exception:
                 n_model = None
+        if n_model is None:
+            n_model = self.__booster_num_feature(model)
 
-    # 予測入力の作り方を選ぶ
-    # - 列名の一致が十分 → 学習時列順でreindex
-    # - 一致がほぼ無い/少ない → Xの列順を使って numpy 配列で shape だけ合わせる（全0化を避ける）
-    selected_name_cols = None
-    overlap = 0
+        # 予測入力の作り方を選ぶ
+        # - 列名の一致が十分 → 学習時列順でreindex
+        # - 一致がほぼ無い/少ない → Xの列順を使って numpy 配列で shape だけ合わせる（全0化を避ける）
+        selected_name_cols = None
+        overlap = 0
 
-    # 1) MyKeibaの学習時列（あれば最優先）
-    if isinstance(mykeiba_cols, (list, tuple)) and len(mykeiba_cols) > 0:
-        try:
-            overlap_my = len(pd.Index(mykeiba_cols).intersection(x_cols))
-        except Exception:
-            overlap_my = 0
-        if overlap_my > 0:
-            selected_name_cols = list(mykeiba_cols)
-            overlap = overlap_my
-
-    # 2) fallback: LightGBM/boosterのfeature名
-    if selected_name_cols is None and feature_names is not None:
+        # 1) MyKeibaの学習時列（あれば最優先）
+        if isinstance(mykeiba_cols, (list, tuple)) and len(mykeiba_cols) > 0:
+            try:
+                overlap_my = len(pd.Index(mykeiba_cols).intersection(x_cols))
+            except Exception:
+                overlap_my = 0
+            if overlap_my > 0:
+                selected_name_cols = list(mykeiba_cols)
+                overlap = overlap_my
+
+        # 2) fallback: LightGBM/boosterのfeature名
+        if selected_name_cols is None and feature_names is not None:
+            try:
+                overlap_fn = len(pd.Index(feature_names).intersection(x_cols))
+                if overlap_fn >= max(1, int(0.5 * len(feature_names))):
+                    selected_name_cols = list(feature_names)
+                    overlap = overlap_fn
+            except Exception:
+                pass
+
+        # 列名が合っていない可能性が高い場合は、Xの情報を捨てないように、数値行列としてモデルに渡す（必要ならpad/truncate）
+        self.__matrix_mode = selected_name_cols is None
+        self.__columns = x_cols if self.__matrix_mode else selected_name_cols
+        self.__n_model = n_model
+        self.__low_overlap = feature_names is not None and self.__matrix_mode
+        self.__overlap = overlap
+
+        # 出力の各列の、Xの中の位置（ない列は0埋め）を、列の型の種類ごとにまとめる
+        position = {}
+        for i, col in enumerate(columns):
+            position.setdefault(col, i)
+        self.__gathers = {}
+        for out, col in enumerate(self.__columns):
+            if col in position:
+                src = position[col]
+                outs, srcs = self.__gathers.setdefault(kinds[src], ([], []))
+                outs.append(out)
+                srcs.append(src)
+        self.__gathers = {kind: (np.array(outs), np.array(srcs)) for kind, (outs, srcs) in self.__gathers.items()}
+
+    @classmethod
+    def for_model(cls, model, X: pd.DataFrame) -> 'FeatureSchema':
+        """
+        modelとXの列の並び・型に対応するFeatureSchema（なければ作ってモデルごとに保持する）
+        """
+        kinds = tuple(_column_kind(dtype) for dtype in X.dtypes)
+        mykeiba_cols = getattr(model, 'mykeiba_feature_columns_', None)
+        key = (tuple(X.columns), kinds, tuple(mykeiba_cols) if isinstance(mykeiba_cols, (list, tuple)) else None)
         try:
-            overlap_fn = len(pd.Index(feature_names).intersection(x_cols))
-            if overlap_fn >= max(1, int(0.5 * len(feature_names))):
-                selected_name_cols = list(feature_names)
-                overlap = overlap_fn
-        except Exception:
-            pass
-
-    if selected_name_cols is not None:
-        X_model = X.reindex(columns=selected_name_cols, fill_value=0)
-        X_matrix_mode = False
-    else:
-        # 列名が合っていない可能性が高い
-        # → Xの情報を捨てないように、数値行列としてモデルに渡す（必要ならpad/truncate）
-        X_model = X.reindex(columns=x_cols, fill_value=0)
-        X_matrix_mode = True
-    # 型の安全化（カテゴリ→コード、datetime/timedelta→数値、float化、inf/NaN対策）
-    for col in X_model.columns:
-        s = X_model[col]
-        if getattr(s.dtype, 'name', '') == 'category':
-            X_model[col] = s.cat.codes
-            continue
-
-        # datetime は float に直接 cast できないので、epoch秒へ変換
-        if is_datetime64tz_dtype(s) or is_datetime64_any_dtype(s):
-            dt = pd.to_datetime(s, errors='coerce')
-            # NaT は int64 の最小値になるため NaN に戻す
-            i64 = dt.view('int64').astype('float64')
-            i64[i64 == float(np.iinfo('int64').min)] = np.nan
-            X_model[col] = i64 / 1e9  # ns -> seconds
-            continue
-
-        # timedelta も同様に秒へ
-        if is_timedelta64_dtype(s):
-            td = pd.to_timedelta(s, errors='coerce')
-            i64 = td.view('int64').astype('float64')
-            i64[i64 == float(np.iinfo('int64').min)] = np.nan
-            X_model[col] = i64 / 1e9
-            continue
-
-        # bool は 0/1 へ
-        if is_bool_dtype(s):
-            X_model[col] = s.astype('int64')
-
-    X_model = X_model.astype(float).replace([np.inf, -np.inf], 0).fillna(0)
-
-    # 予測
-    if not X_matrix_mode:
-        score = model.predict_proba(X_model)[:, 1]
-    else:
-        mat = X_model.to_numpy(dtype=float, copy=False)
-        if n_model is not None:
-            if mat.shape[1] > n_model:
-                mat = mat[:, :n_model]
-            elif mat.shape[1] < n_model:
-                pad = np.zeros((mat.shape[0], n_model - mat.shape[1]), dtype=float)
-                mat = np.concatenate([mat, pad], axis=1)
-        # 行が全て同じだと予測も同一になりやすいので警告
-        if mat.shape[0] >= 2 and np.allclose(mat, mat[0], equal_nan=True):
+            schemas = _SCHEMAS.setdefault(model, {})
+        except TypeError:
+            # 弱参照できないモデルの場合は、保持せずに毎回作る
+            return cls(model, X.columns, kinds)
+        schema = schemas.get(key)
+        if schema is None:
+            schema = schemas[key] = cls(model, X.columns, kinds)
+        return schema
+
+    @property
+    def columns(self) -> list:
+        """モデルに渡す列（列名が合わない場合は、Xのメタ列以外の列）"""
+        return self.__columns
+
+    def transform(self, X: pd.DataFrame) -> np.ndarray:
+        """
+        Xを、モデルに渡すfloatの配列（行数 × len(columns)）にする
+        """
+        matrix = np.zeros((len(X), len(self.__columns)), dtype=float)
+        for kind, (outs, srcs) in self.__gathers.items():
+            if kind == 'numeric':
+                matrix[:, outs] = X.iloc[:, srcs].to_numpy(dtype=float, na_value=np.nan)
+                continue
+            for out, src in zip(outs, srcs):
+                s = X.iloc[:, src]
+                if kind == 'category':
+                    matrix[:, out] = s.cat.codes.to_numpy()
+                else:
+                    # datetime/timedelta はepoch秒へ変換（NaT は int64 の最小値になるため NaN に戻す）
+                    values = pd.to_datetime(s, errors='coerce') if kind == 'datetime' \
+                        else pd.to_timedelta(s, errors='coerce')
+                    i64 = values.to_numpy().view('int64').astype('float64')
+                    i64[i64 == float(np.iinfo('int64').min)] = np.nan
+                    matrix[:, out] = i64 / 1e9  # ns -> seconds
+        # inf/NaN対策
+        return np.nan_to_num(matrix, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+
+    def predict(self, model, X: pd.DataFrame) -> np.ndarray:
+        """
+        Xの各行の、1（好走）の確率
+        """
+        matrix = self.transform(X)
+        if not self.__matrix_mode:
+            if self.__pass_frame(model):
+                matrix = pd.DataFrame(matrix, columns=self.__columns, copy=False)
+            score = model.predict_proba(matrix)[:, 1]
+        else:
+            n_model = self.__n_model
+            if n_model is not None:
+                if matrix.shape[1] > n_model:
+                    matrix = matrix[:, :n_model]
+                elif matrix.shape[1] < n_model:
+                    pad = np.zeros((matrix.shape[0], n_model - matrix.shape[1]), dtype=float)
+                    matrix = np.concatenate([matrix, pad], axis=1)
+            # 行が全て同じだと予測も同一になりやすいので警告
+            if matrix.shape[0] >= 2 and np.allclose(matrix, matrix[0], equal_nan=True):
+                warnings.warn(
+                    'All rows in prediction features are identical. Scores will be identical within the race. '
+                    'This usually indicates feature engineering/merge issues or severe feature-name mismatch.',
+                    RuntimeWarning,
+                )
+            score = model.predict_proba(matrix)[:, 1]
+
+        if self.__low_overlap:
             warnings.warn(
-                'All rows in prediction features are identical. Scores will be identical within the race. '
-                'This usually indicates feature engineering/merge issues or severe feature-name mismatch.',
+                f'Low overlap between model feature names and X columns (overlap={self.__overlap}). '
+                'Falling back to matrix-based prediction; verify that training/prediction feature columns match.',
                 RuntimeWarning,
             )
-        score = model.predict_proba(mat)[:, 1]
-
-    if feature_names is not None and selected_name_cols is None:
-        warnings.warn(
-            f'Low overlap between model feature names and X columns (overlap={overlap}). '
-            'Falling back to matrix-based prediction; verify that training/prediction feature columns match.',
-            RuntimeWarning,
-        )
-    score_table[_SCORE] = score
-    return score_table
+        return score
+
+    @staticmethod
+    def __pass_frame(model) -> bool:
+        """
+        予測にDataFrameで渡す必要があるか（DataFrameで学習したモデルは列名・pandasのカテゴリを持つため、DataFrameで渡す）。
+        そうでなければ配列のまま渡す（LightGBMでのDataFrameの変換を省く）。
+        """
+        if hasattr(model, 'feature_names_in_'):
+            return True
+        booster = getattr(model, 'booster_', None)
+        return getattr(booster, 'pandas_categorical', None) is not None
+
+    @staticmethod
+    def __booster_num_feature(model):
+        booster = getattr(model, 'booster_', None)
+        if booster is not None:
+            try:
+                return booster.num_feature()
+            except Exception:
+                return None
+        return None
+
+
+def _calc(model, X: pd.DataFrame) -> pd.DataFrame:
+    # メタ列（例: race_id, 馬番）は結果用に保持し、予測には使わない
+    score_table = {col: X[col].to_numpy() for col in ('race_id', ResultsCols.UMABAN) if col in X.columns}
+
+    # 特徴量の選び方・変換は、モデルとXの列の並びごとに1度だけ決める（FeatureSchema）
+    score_table[_SCORE] = FeatureSchema.for_model(model, X).predict(model, X)
+    return pd.DataFrame(score_table, index=X.index)
 
 def _group_keys_for_race(score_table: pd.DataFrame, score: pd.Series):
     if isinstance(score_table, pd.DataFrame) and 'race_id' in score_table.columns:
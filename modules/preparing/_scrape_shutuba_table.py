@@ -1,3 +1,4 @@
+import os
 import time
 import re
 import random
@@ -195,6 +196,33 @@ def scrape_shutuba_table(race_id: str, date: str, file_path: str):
     
     df.to_pickle(file_path)
 
+def scrape_shutuba_tables(race_id_list: list, date: str, file_path: str, sleep: float = 1) -> list:
+    """
+    複数レース（開催日の全レースや、create_active_race_id_listで取得した発走前のレース）の出馬表をスクレイピングし、
+    1つのDataFrame（インデックスがrace_id）にまとめてfile_pathに保存する。
+    まとめた出馬表は、ShutubaTableProcessor・ShutubaDataMerger・FeatureEngineeringで1度に処理できる。
+    出馬表を取得できたレースのrace_idのリストを返す。dateはyyyy/mm/ddの形式。
+    """
+    race_file_path = file_path + '.race'
+    tables = []
+    for race_id in race_id_list:
+        # サーバー負荷軽減のため待機
+        time.sleep(sleep)
+        try:
+            scrape_shutuba_table(race_id, date, race_file_path)
+            df = pd.read_pickle(race_file_path)
+        except Exception as e:
+            # 取得できなかったレースは飛ばして続行
+            print('{} 出馬表の取得エラー: {}'.format(race_id, e))
+            continue
+        if len(df) > 0:
+            tables.append(df)
+    if os.path.isfile(race_file_path):
+        os.remove(race_file_path)
+    shutuba_tables = pd.concat(tables) if tables else pd.DataFrame()
+    shutuba_tables.to_pickle(file_path)
+    return list(dict.fromkeys(shutuba_tables.index)) if tables else []
+
 def scrape_horse_id_list(race_id_list: list) -> list:
     """
     当日出走するhorse_id一覧を取得
@@ -1,11 +1,28 @@
 from ._horse_results_processor import HorseResultsProcessor
+from ._horse_results_store import HorseResultsStore
 from ._horse_info_processor import HorseInfoProcessor
+from ._horse_history_index import HorseHistoryIndex
+from ._as_of_window_aggregator import AsOfWindowAggregator
+from ._expanding_aggregate_state import ExpandingAggregateState
+from ._head_to_head_index import HeadToHeadIndex
+from ._standard_time_table import StandardTimeTable
+from ._as_of_join import AsOfJoiner
 from ._data_merger import DataMerger
 from ._feature_engineering import FeatureEngineering
+from ._encoding_plan import EncodingPlan
+from ._feature_requirements import FeatureRequirements
+from ._featured_data_snapshot import FeaturedDataSnapshot
+from ._feature_store import FeatureStore
 from ._peds_processor import PedsProcessor
+from ._preprocessing_cache import PreprocessingCache
 from ._race_info_processor import RaceInfoProcessor
 from ._results_processor import ResultsProcessor
 from ._return_processor import ReturnProcessor
 from ._shutuba_table_processor import ShutubaTableProcessor
 from ._shutuba_data_merger import ShutubaDataMerger
-from ._jockey_stats_processor import JockeyStatsProcessor
\ No newline at end of file
+from ._id_dictionary import IdDictionary
+from ._jockey_stats_processor import JockeyStatsProcessor
+from ._entity_form_processor import EntityFormProcessor
+from ._entity_form_state import EntityFormState
+from ._pedigree_form_processor import PedigreeFormProcessor
+from ._pedigree_form_state import PedigreeFormState
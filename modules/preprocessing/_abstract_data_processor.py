@@ -1,22 +1,83 @@
 import pandas as pd
 from abc import ABCMeta, abstractmethod
 
+from ._preprocessing_cache import PreprocessingCache
+
 class AbstractDataProcessor(metaclass=ABCMeta):
-    def __init__(self, filepath: str):
-        self.__raw_data = pd.read_pickle(filepath)
-        self.__preprocessed_data = self._preprocess()
+    # 前処理の結果が、modules配下以外の変更（ライブラリ・読み込むデータの形式など）で変わる場合に上げると、キャッシュが作り直される
+    # （プロセッサのモジュールと、そこから読み込んでいるmodules配下のモジュールの変更は、PreprocessingCacheが検知する）
+    _VERSION = 1
+    # 前処理済みデータをキャッシュするかどうか
+    _CACHEABLE = True
+
+    def __init__(self, filepath: str, copy: bool = False, use_cache: bool = True):
+        """
+        初期処理
+
+        rawデータの読み込みと前処理は、raw_data・preprocessed_dataに初めてアクセスした時に行い、結果を保持する。
+        copy=Falseの場合は、保持しているデータと値を共有する浅いコピーを返す。
+        列の追加・置き換え・行の絞り込みは返されたDataFrameだけに反映されるが、
+        既存列の値をその場で書き換える操作（df.loc[...] = ... など）は保持しているデータにも反映される。
+        そのような使い方をする場合はcopy=Trueにすると、アクセスのたびに深いコピーを返す。
+
+        use_cache=Trueの場合は、前処理済みデータをLocalPaths.PREPROCESSING_CACHE_DIRに保存しておき、
+        rawデータと前処理のコードが変わっていなければ、次回からは前処理をせずにそれを読み込む（PreprocessingCache）。
+        """
+        self.__filepath = filepath
+        self.__copy = copy
+        self.__use_cache = use_cache and self._CACHEABLE
+        self.__raw_data = None
+        self.__preprocessed_data = None
 
     @abstractmethod
     def _preprocess(self):
         pass
-    
+
+    @property
+    def filepath(self):
+        return self.__filepath
+
     @property
     def raw_data(self):
-        return self.__raw_data.copy()
+        if self.__raw_data is None:
+            self.__raw_data = pd.read_pickle(self.__filepath)
+        return self._hand_out(self.__raw_data)
 
     @property
     def preprocessed_data(self):
-        return self.__preprocessed_data.copy()
+        if self.__preprocessed_data is None:
+            cache = PreprocessingCache() if self.__use_cache else None
+            if cache is not None:
+                self.__preprocessed_data = cache.load(self)
+            if self.__preprocessed_data is None:
+                self.__preprocessed_data = self._preprocess()
+                # 前処理後は不要なので、rawデータは手放す（再度アクセスされた場合は読み込み直す）
+                self.__raw_data = None
+                if cache is not None:
+                    cache.save(self, self.__preprocessed_data)
+        return self._hand_out(self.__preprocessed_data)
+
+    def _cache_params(self) -> dict:
+        """
+        前処理の結果を左右するパラメータ（キャッシュのキーに含める）。
+        rawデータ以外のファイルも読み込む場合は、'files'にパスのリストを入れると、その内容もキーに含める。
+        """
+        return {}
+
+    def _hand_out(self, data):
+        """
+        保持しているデータを、copyの設定に応じて浅いコピー・深いコピーにして返す。
+        dict（ReturnProcessor）の場合は、各値をコピーしたdictを返す。
+        """
+        if isinstance(data, dict):
+            return {key: self._hand_out(value) for key, value in data.items()}
+        if self.__copy:
+            return data.copy(deep=True)
+        out = data.copy(deep=False)
+        # インデックス・列名のオブジェクトまで共有すると、index.nameの変更などが保持データに及ぶため、ビューに差し替える
+        out.index = data.index.view()
+        out.columns = data.columns.view()
+        return out
 
     #rawデータを一つのファイルにまとめる運用に変更したため、以下は不要
     """def _delete_duplicate(self, old, new):
@@ -0,0 +1,100 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+# 読み込んだ特徴量テーブル・AsOfJoinerのキャッシュ（ファイルのパス・サイズ・更新日時・変更日時が同じ間は使い回す）
+_TABLE_CACHE = {}
+
+
+def read_stats_table(filepath: str) -> pd.DataFrame:
+    """
+    (date, horse_id) をインデックスとする特徴量テーブル（jockey_stats.pickleなど）を読み込み、
+    インデックスを列に戻して返す。ファイルが変わっていなければ、前回読み込んだものを返す。
+    """
+    return _cached(filepath, 'table', lambda: pd.read_pickle(filepath).reset_index())
+
+
+def _cached(filepath: str, kind, load):
+    """
+    st_ctime_nsも比べるのは、書き直した後に更新日時を戻した（サイズも同じ）ファイルを古いまま使わないため
+    （st_ctime_nsはos.utimeでは戻せない）。
+    """
+    stat = os.stat(filepath)
+    stamp = (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+    key = (os.path.abspath(filepath), kind)
+    entry = _TABLE_CACHE.get(key)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+    value = load()
+    _TABLE_CACHE[key] = (stamp, value)
+    return value
+
+
+class AsOfJoiner:
+    """
+    特徴量テーブル（right）の各行を、エンティティ（by列、騎手など）・日付順に並べておき、
+    別のテーブル（left）の各行に「同じエンティティの、leftの日付より前（同じ日付は含まない）の最後の行」を付けるクラス。
+    pd.merge_asof(allow_exact_matches=False) と同じ対応付けを、
+    エンティティのコードと日付をまとめたint64のキーに対するsearchsortedで行う。
+    同じエンティティ・同じ日付の行が複数ある場合は、rightで後ろにある行を使う。
+    """
+    def __init__(self, right: pd.DataFrame, by: str, columns: list = None, date_col: str = 'date'):
+        """
+        初期処理
+        """
+        right = right[right[by].notna() & right[date_col].notna()]
+        self.__by = by
+        self.__date_col = date_col
+        self.__columns = [col for col in right.columns if col not in (by, date_col)] \
+            if columns is None else list(columns)
+        codes, uniques = pd.factorize(right[by].astype(str).to_numpy())
+        self.__entities = pd.Index(uniques)
+        days = self.__to_days(right[date_col])
+        order = np.lexsort((days, codes))
+        self.__codes = codes[order].astype(np.int64)
+        self.__days = days[order]
+        self.__values = right[self.__columns].iloc[order].reset_index(drop=True)
+        self.__day_offset = int(self.__days.min()) if len(self.__days) > 0 else 0
+        self.__day_bits = max(int(self.__days.max() - self.__day_offset + 2).bit_length(), 1) \
+            if len(self.__days) > 0 else 1
+        self.__key = (self.__codes << self.__day_bits) + (self.__days - self.__day_offset)
+
+    @classmethod
+    def from_pickle(cls, filepath: str, by: str, columns: list = None, date_col: str = 'date') -> 'AsOfJoiner':
+        """
+        read_stats_table()で読み込んだテーブルから作る。ファイルとテーブルの最後の日付が変わっていなければ、
+        前回作ったものを返す（テーブルより古いAsOfJoinerを使わないよう、最後の日付もキーにする）。
+        """
+        table = read_stats_table(filepath)
+        kind = ('as_of_joiner', by, tuple(columns) if columns is not None else None, date_col, table[date_col].max())
+        return _cached(filepath, kind, lambda: cls(table, by, columns, date_col))
+
+    @property
+    def columns(self) -> list:
+        return self.__columns
+
+    def join(self, left: pd.DataFrame, left_by: str = None, left_date_col: str = None) -> pd.DataFrame:
+        """
+        leftの各行に対応する行のcolumnsを返す（インデックスはleftと同じ）。対応する行がない場合は欠損値。
+        """
+        left_by = self.__by if left_by is None else left_by
+        left_date_col = self.__date_col if left_date_col is None else left_date_col
+        codes = self.__entities.get_indexer(left[left_by].astype(str).to_numpy()).astype(np.int64)
+        days = self.__to_days(left[left_date_col]) - self.__day_offset
+        found = (codes >= 0) & (days > 0) & left[left_date_col].notna().to_numpy()
+        # 過去の日付の範囲を超える日付は、searchsortedの結果が変わらない値に丸める
+        days = np.minimum(days, (1 << self.__day_bits) - 1)
+        # (code, day) より小さい最後の行 = 同じエンティティなら、その日付より前の最後の行
+        position = np.searchsorted(self.__key, (np.where(found, codes, 0) << self.__day_bits) + days, side='left') - 1
+        found &= position >= 0
+        found[found] = self.__codes[position[found]] == codes[found]
+
+        out = self.__values.iloc[np.where(found, position, 0)].reset_index(drop=True)
+        out = out.where(pd.Series(found), other=np.nan) if not found.all() else out
+        out.index = left.index
+        return out
+
+    @staticmethod
+    def __to_days(dates: pd.Series) -> np.ndarray:
+        return pd.to_datetime(dates).to_numpy().astype('datetime64[D]').astype(np.int64)
@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+
+from ._horse_history_index import HorseHistoryIndex
+
+
+class AsOfWindowAggregator:
+    """
+    馬の過去成績テーブルから、各（レース日, 馬）について「レース日より前の直近nレース」の集計を求めるクラス。
+
+    過去成績を馬ごと・日付順に並べた索引（HorseHistoryIndex）に対して、各レースの
+        - 集計範囲の終わり: その馬の、レース日より前の最後の行の次（searchsorted）
+        - 集計範囲の始め: 終わりからnレース前（その馬の先頭より前には戻らない）
+    を求めて、馬ごとの累積和の差分で平均を計算する。
+    group_col（course_lenなど）ごとの集計は、(horse_id, group_colの値) ごとに、上の並びの位置の順に並べた
+    配列の中で同じ範囲をsearchsortedで求めて、同じように計算する。
+    日付ごとに過去成績を絞り込む必要がないため、全レースを1回の走査で計算できる。
+    """
+    def __init__(self, horse_results, target_cols: list, group_cols: list):
+        """
+        初期処理
+
+        horse_resultsは、インデックスがhorse_idで、date列・target_cols・group_colsを持つ前処理済みの過去成績か、
+        それらの列を持つHorseHistoryIndex。
+        """
+        self.__target_cols = list(target_cols)
+        self.__group_cols = list(group_cols)
+        if not isinstance(horse_results, HorseHistoryIndex):
+            horse_results = HorseHistoryIndex(horse_results, self.__target_cols + self.__group_cols)
+        self.__index = horse_results
+        self.__horse_codes = horse_results.row_horse_codes()
+        self.__days = horse_results.days
+        self.__values = {col: horse_results.column(col).astype(float) for col in self.__target_cols}
+        self.__group_values = {col: horse_results.column(col) for col in self.__group_cols}
+
+    def aggregate(self, results: pd.DataFrame, n_races_list: list, expanding_state=None,
+                  outputs=None) -> pd.DataFrame:
+        """
+        resultsの各行（horse_id, date, group_colsを持つ）について、過去成績の集計を返す。インデックスはresultsと同じ。
+
+        カラム（DataMergerが従来日付ごとに計算していたものと同じ）:
+            - {target_col}_{n}R, {target_col}_{group_col}_{n}R: 直近nレースの平均（n_races_listの順）
+            - {target_col}_allR, {target_col}_{group_col}_allR: 全レースの平均
+            - latest: 前走の日付
+
+        expanding_state（ExpandingAggregateState）を渡した場合、状態のas_ofより後の日付のレースのうち、
+        状態の集計済みの行数が過去成績の行数と一致する馬（その馬の全ての過去成績を集計済み）の行は、
+        全レースの平均・前走の日付を状態から読み込み、過去成績からは計算しない。
+        それ以外の行（状態の更新後に取得した馬など）は、過去成績から計算する。
+        outputs（列名の集合。FeatureRequirementsなど）を渡した場合は、outputsに含まれる集計の列（とlatest）だけを計算する。
+        """
+        def required(name):
+            return outputs is None or name in outputs
+
+        horse_codes = self.__index.horse_codes(results['horse_id'])
+        horse_start, end = self.__index.bounds(results['horse_id'], results['date'])
+        use_state = self.__state_rows(results, expanding_state, horse_start, end)
+
+        # (集計範囲の始め, 接尾辞, 計算する行（Noneは全ての行）)。全レースは、状態から読み込まない行だけ計算する
+        windows = [(np.maximum(horse_start, end - n), '{}R'.format(n), None) for n in n_races_list]
+        if not use_state.all():
+            windows.append((horse_start, 'allR', np.flatnonzero(~use_state) if use_state.any() else None))
+        suffixes = [suffix for _, suffix, _ in windows]
+        target_cols = [col for col in self.__target_cols
+                       if any(required('{}_{}'.format(col, suffix)) for suffix in suffixes)]
+        group_target_cols = {
+            group_col: [col for col in self.__target_cols
+                        if any(required('{}_{}_{}'.format(col, group_col, suffix)) for suffix in suffixes)]
+            for group_col in self.__group_cols
+            }
+
+        # 累積和は集計範囲によらないので、列ごと（group_colごと）に1度だけ求める
+        cumulatives = {col: self.__cumulative(self.__values[col], self.__horse_codes) for col in target_cols}
+        layouts = {group_col: self.__group_layout(results, group_col, horse_codes, cols)
+                   for group_col, cols in group_target_cols.items() if cols}
+
+        features = {}
+        for start, suffix, rows in windows:
+            if rows is None:
+                rows = slice(None)
+            row_start, row_end, row_horse_start = start[rows], end[rows], horse_start[rows]
+            computed = {}
+            for col in target_cols:
+                if required('{}_{}'.format(col, suffix)):
+                    computed['{}_{}'.format(col, suffix)] = self.__range_mean(
+                        cumulatives[col], row_horse_start, row_start, row_end)
+            for group_col, layout in layouts.items():
+                cols = [col for col in group_target_cols[group_col]
+                        if required('{}_{}_{}'.format(col, group_col, suffix))]
+                if not cols:
+                    continue
+                # 範囲 [start, end) のうち、group_colの値がレースと同じ行だけの平均
+                race_key = layout['race_key'][rows]
+                lo = np.searchsorted(layout['key'], race_key + row_start, side='left')
+                hi = np.searchsorted(layout['key'], race_key + row_end, side='left')
+                hi = np.where(layout['valid'][rows], hi, lo)
+                for col in cols:
+                    computed['{}_{}_{}'.format(col, group_col, suffix)] = self.__range_mean(
+                        layout['cumulatives'][col], layout['pair_start'][rows], lo, hi)
+            for name, values in computed.items():
+                if isinstance(rows, slice):
+                    features[name] = values
+                else:
+                    features[name] = np.full(len(results), np.nan)
+                    features[name][rows] = values
+
+        latest = np.full(len(results), np.datetime64('NaT'), dtype='datetime64[ns]')
+        has_prior = end > horse_start
+        latest[has_prior] = (self.__days[end[has_prior] - 1]).astype('datetime64[D]').astype('datetime64[ns]')
+        features['latest'] = latest
+
+        if use_state.any():
+            from_state = expanding_state.lookup(results[use_state])
+            for col in from_state.columns:
+                if col == 'latest' or required(col):
+                    features.setdefault(col, np.full(len(results), np.nan))[use_state] = from_state[col].to_numpy()
+        return pd.DataFrame(self.__ordered(features, n_races_list), index=results.index)
+
+    def __state_rows(self, results: pd.DataFrame, expanding_state, horse_start: np.ndarray,
+                     end: np.ndarray) -> np.ndarray:
+        """
+        全レースの平均・前走の日付を、expanding_stateから読み込む行。
+        as_ofより後のレースでは、[horse_start, end) はその馬の全ての過去成績なので、
+        その行数が状態の集計済みの行数と一致すれば、状態の値は過去成績から計算した値と同じになる。
+        """
+        use_state = np.zeros(len(results), dtype=bool)
+        if expanding_state is None or expanding_state.as_of is None:
+            return use_state
+        if expanding_state.target_cols != self.__target_cols or expanding_state.group_cols != self.__group_cols:
+            return use_state
+        use_state = (results['date'] > expanding_state.as_of).to_numpy()
+        if use_state.any():
+            use_state[use_state] = expanding_state.row_counts(results['horse_id'][use_state]) \
+                == (end - horse_start)[use_state]
+        return use_state
+
+    def __ordered(self, features: dict, n_races_list: list) -> dict:
+        """列を、窓（n_races_listの順, allR）ごとに target_cols、group_colsごとの target_cols の順に並べ、latestを最後にする"""
+        names = []
+        for suffix in ['{}R'.format(n) for n in n_races_list] + ['allR']:
+            names += ['{}_{}'.format(col, suffix) for col in self.__target_cols]
+            names += ['{}_{}_{}'.format(col, group_col, suffix)
+                      for group_col in self.__group_cols for col in self.__target_cols]
+        return {name: features[name] for name in names + ['latest'] if name in features}
+
+    def __group_layout(self, results: pd.DataFrame, group_col: str, horse_codes: np.ndarray,
+                       target_cols: list) -> dict:
+        """
+        過去成績を (horse_id, group_colの値) ごとに、(horse_id, date) 順の位置で並べたもの。
+        key（(horse_id, 値)のコードと位置をまとめたint64）に対して、各レースの race_key + 位置 でsearchsortedすると、
+        その馬・そのレースと同じ値の行のうち、位置がそれより前のものの数が求まる。
+        """
+        history = self.__group_values[group_col]
+        # 過去成績とレースの値に共通のコードを振る（欠損値は-1で、集計しない）
+        codes, uniques = pd.factorize(pd.concat([pd.Series(history), results[group_col].reset_index(drop=True)],
+                                                ignore_index=True), use_na_sentinel=True)
+        history_codes, race_codes = codes[:len(history)], codes[len(history):]
+        n_groups = max(len(uniques), 1)
+
+        positions = np.flatnonzero(history_codes >= 0)
+        pair_codes = self.__horse_codes[positions] * n_groups + history_codes[positions]
+        position_bits = max(int(len(history)).bit_length(), 1)
+        order = np.lexsort((positions, pair_codes))
+        sorted_pairs = pair_codes[order]
+        key = (sorted_pairs << position_bits) + positions[order]
+
+        valid = (horse_codes >= 0) & (race_codes >= 0)
+        race_key = np.where(valid, horse_codes * n_groups + race_codes, -1) << position_bits
+        return {
+            'key': key,
+            'race_key': race_key,
+            'valid': valid,
+            'pair_start': np.searchsorted(key, race_key, side='left'),
+            'cumulatives': {col: self.__cumulative(self.__values[col][positions][order], sorted_pairs)
+                            for col in target_cols},
+            }
+
+    @staticmethod
+    def __cumulative(values: np.ndarray, segments: np.ndarray) -> tuple:
+        """
+        segments（同じ値が連続している）ごとの、欠損値を除いたvaluesの累積和と個数。
+        cum[i]は、segmentの先頭からi-1行目までの合計（先頭に0を足している）。
+        segmentごとに取るため、桁の大きい値でも誤差が積み重ならない。
+        """
+        notna = ~np.isnan(values)
+        grouped = pd.DataFrame({'sum': np.where(notna, values, 0.0), 'count': notna.astype(np.int64)})\
+            .groupby(segments, sort=False).cumsum()
+        return np.r_[0.0, grouped['sum'].to_numpy()], np.r_[0, grouped['count'].to_numpy()]
+
+    @staticmethod
+    def __range_mean(cumulative: tuple, segment_start: np.ndarray, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+        """
+        範囲 [start, end) の平均（欠損値は除く）。範囲は1つのsegmentの中にあり、segment_startはそのsegmentの先頭。
+        値がない場合は欠損値。
+        """
+        cum_sum, cum_count = cumulative
+        # 範囲がsegmentの先頭からなら、引く値は0
+        from_start = start <= segment_start
+        total = cum_sum[end] - np.where(from_start, 0.0, cum_sum[start])
+        count = cum_count[end] - np.where(from_start, 0, cum_count[start])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where((end > start) & (count > 0), total / np.maximum(count, 1), np.nan)
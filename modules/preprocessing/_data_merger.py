@@ -1,12 +1,22 @@
 import os
+import numpy as np
 import pandas as pd
 from ._horse_results_processor import HorseResultsProcessor
 from ._horse_info_processor import HorseInfoProcessor
 from ._peds_processor import PedsProcessor
+from ._as_of_window_aggregator import AsOfWindowAggregator
+from ._expanding_aggregate_state import ExpandingAggregateState
+from ._entity_form_state import EntityFormState
+from ._pedigree_form_state import PedigreeFormState
+from ._id_dictionary import IdDictionary
+from ._as_of_join import AsOfJoiner, read_stats_table
+from ._head_to_head_index import HeadToHeadIndex
+from ._standard_time_table import StandardTimeTable
+from ._feature_requirements import FeatureRequirements
 from ._race_info_processor import RaceInfoProcessor
+from ._jockey_stats_processor import JockeyStatsProcessor
 from ._results_processor import ResultsProcessor
 from modules.constants import LocalPaths
-from tqdm.auto import tqdm
 
 class DataMerger:
     def __init__(
@@ -27,7 +37,9 @@ class DataMerger:
         # レース情報テーブル（前処理後）
         self._race_info = race_info_processor.preprocessed_data
         # 馬の過去成績テーブル（前処理後）
-        self._horse_results = horse_results_processor.preprocessed_data
+        # マージ対象の馬・日付に必要な分だけを、_merge_horse_results実行時に読み込む
+        self._horse_results_processor = horse_results_processor
+        self._horse_results = pd.DataFrame()
         # 馬の基本情報テーブル（前処理後）
         # 馬主情報はレース情報テーブルのものを利用するため、列を削除
         self._horse_info = horse_info_processor.preprocessed_data.drop(
@@ -40,10 +52,8 @@ class DataMerger:
         self._group_cols = group_cols
         # 全てのマージが完了したデータ
         self._merged_data = pd.DataFrame()
-        # 日付(date列)ごとに分かれたレース結果
-        self._separated_results_dict = {}
-        # レース結果データのdateごとに分かれた馬の過去成績
-        self._separated_horse_results_dict = {}
+        # モデルが使う特徴量（FeatureRequirements）。Noneなら全ての特徴量を作る
+        self._requirements = None
     
     def merge(self):
         """
@@ -51,10 +61,39 @@ class DataMerger:
         """
         self._merge_race_info()
         self._merge_horse_results()
+        self._merge_head_to_head()
         self._merge_horse_info()
         self._merge_peds()
         self._merge_jockey_stats()
+        self._merge_entity_form()
+        self._merge_pedigree_form()
     
+    def select_dates(self, dates) -> 'DataMerger':
+        """
+        マージするレースを、datesの日付のものだけに絞り込む（FeatureStoreで、特徴量がない日付の分だけ作る時に使う）。
+        特徴量は全てレース日より前の情報から作るため、各レースの特徴量は全てのレースをマージした場合と同じになる。
+        """
+        race_dates = self._race_info['date'].reindex(self._results.index)
+        self._results = self._results[race_dates.isin(pd.to_datetime(list(dates))).to_numpy()]
+        return self
+
+    def require(self, requirements: FeatureRequirements) -> 'DataMerger':
+        """
+        モデルが使う特徴量（FeatureRequirements）だけを作るようにする（当日の予測用）。
+        過去成績の集計は使う列だけを計算し、直接対決は使う場合だけ計算し、
+        血統・特徴量テーブルは使う列だけをマージする。
+        """
+        self._requirements = requirements
+        return self
+
+    def _required_columns(self, columns) -> list:
+        """
+        columnsのうち、モデルが使うもの（requireしていなければ全て）
+        """
+        if self._requirements is None:
+            return list(columns)
+        return self._requirements.select(columns)
+
     def _merge_race_info(self):
         """
         レース情報テーブルを、レース結果テーブルにマージ
@@ -66,67 +105,64 @@ class DataMerger:
             how = 'left'
             )
     
-    def _separate_by_date(self):
+    def _load_horse_results(self):
         """
-        - レース結果を日付(date列)ごとに分ける
-        - (レース結果のdate, その日に走る馬の過去成績データ)のペアを作る
+        レース結果に出走する馬の、最終レース日より前の過去成績だけを読み込む。
+        （HorseResultsProcessorがout_of_coreの場合は、該当パーティションだけをディスクから読む）
         """
-        print('separating horse results by date')
-        # dateでデータを分割
-        for date, df_by_date in tqdm(self._results.groupby('date')):
-            self._separated_results_dict[date] = df_by_date
-            # その日に走る馬一覧
-            horse_id_list = df_by_date['horse_id'].unique()
-            # dateより過去に絞る
-            self._separated_horse_results_dict[date] = self._horse_results\
-                    .query('date < @date').query('index in @horse_id_list')
+        self._horse_results = self._horse_results_processor.fetch(
+            horse_id_list=self._results['horse_id'].unique(),
+            date_to=self._results['date'].max()
+            )
+        if 'speed_figure' in self._target_cols and 'speed_figure' not in self._horse_results.columns:
+            self._add_speed_figure()
+
+    def _add_speed_figure(self):
+        """
+        過去成績に、基準タイムとの差のスピード指数（speed_figure列）を追加する。
+        基準タイムは、過去成績全体から作ってLocalPaths.STANDARD_TIME_PATHに保存した表（StandardTimeTable）を使う。
+        読み込んだ過去成績（出走馬の分だけ）から作ると、マージする対象ごとに同じレースのspeed_figureが変わるため、
+        表がない場合はエラーにする。
+        """
+        standard_time_table = StandardTimeTable.load_if_exists()
+        if standard_time_table is None:
+            raise FileNotFoundError(
+                '基準タイムの表 {} がありません。過去成績全体から StandardTimeTable を作って保存してください'.format(
+                    LocalPaths.STANDARD_TIME_PATH))
+        self._horse_results = self._horse_results.assign(
+            speed_figure=standard_time_table.speed_figure(self._horse_results))
 
     def _merge_horse_results(self, n_races_list = [5, 9]):
         """
         馬の過去成績テーブルのマージ
+
+        各レースについて、その日より前の過去成績の直近nレース・全レースの平均と前走の日付を、
+        AsOfWindowAggregatorで全レース分まとめて計算する。
+        LocalPaths.EXPANDING_STATE_PATHに過去成績を集計済みの状態（ExpandingAggregateState）があれば、
+        その日付より後のレースの全レースの平均・前走の日付は状態から読み込む。
+        行は日付順（同じ日付の中ではレース結果テーブルの順）に並べる。
         """
-        self._separate_by_date()
+        self._load_horse_results()
         print('merging horse_results')
-        output_results_dict = {}
-        for date in tqdm(self._separated_results_dict):
-            results = self._separated_results_dict[date].copy()
-            horse_results = self._separated_horse_results_dict[date].copy()
-            # 直近nレースに絞った過去成績をマージ
-            for n_races in n_races_list:
-                # 直近nレースに絞った過去成績
-                n_race_horse_results = self._filter_horse_results(self._separated_horse_results_dict[date], n_races)
-                
-                # horse_idのみのターゲットエンコーディング
-                # 何レース分集計しているか分かるように、列名に接尾辞をつける
-                summarized = self._summarize(n_race_horse_results, self._target_cols).add_suffix('_{}R'.format(n_races))
-                # resultsにマージ
-                results = results.merge(summarized, left_on='horse_id', right_index=True, how='left')
-                
-                # horse_idとカテゴリ変数を合わせてターゲットエンコーディング
-                for group_col in self._group_cols:
-                    # 何レース分、どのカテゴリ変数とともに集計しているか分かるように、列名に接尾辞をつける
-                    summarized_with = self._summarize_with(n_race_horse_results, self._target_cols, group_col)\
-                        .add_suffix('_{}_{}R'.format(group_col, n_races)) 
-                    # resultsにマージ
-                    results = results.merge(summarized_with, left_on=['horse_id', group_col],right_index=True, how='left')
-            # 直近nレースに絞らないで過去成績をマージ
-            summarized = self._summarize(horse_results, self._target_cols).add_suffix('_allR')
-            results = results.merge(summarized, left_on='horse_id', right_index=True, how='left')
-            for group_col in self._group_cols:
-                # どのカテゴリ変数とともに集計しているか分かるように、列名に接尾辞をつける
-                summarized_with = self._summarize_with(horse_results, self._target_cols, group_col)\
-                    .add_suffix('_{}_allR'.format(group_col))
-                # resultsにマージ
-                results = results.merge(summarized_with, left_on=['horse_id', group_col], right_index=True, how='left')
-            # 前走の日付をマージ
-            latest = horse_results.groupby('horse_id')['date'].max().rename('latest')
-            results = results.merge(latest, left_on='horse_id', right_index=True, how='left')
-            # 辞書型に格納
-            output_results_dict[date] = results
-        # 日付で分かれていたものを結合
-        merged_data = pd.concat([output_results_dict[date] for date in output_results_dict])
-        self._merged_data = merged_data
+        results = self._results[self._results['date'].notna()].sort_values('date', kind='stable')
+        aggregator = AsOfWindowAggregator(self._horse_results, self._target_cols, self._group_cols)
+        expanding_state = ExpandingAggregateState.load_if_exists(self._target_cols, self._group_cols)
+        features = aggregator.aggregate(results, n_races_list, expanding_state, outputs=self._requirements)
+        self._merged_data = pd.concat([results, features], axis=1)
     
+    def _merge_head_to_head(self):
+        """
+        同じレースの他の出走馬との、レース日より前の直接対決の成績（HeadToHeadIndex）のマージ。
+        _merge_horse_resultsで読み込んだ過去成績を使うため、その後に実行する。
+        """
+        if not self._required_columns(HeadToHeadIndex.FEATURES):
+            return
+        print('merging head_to_head')
+        head_to_head = HeadToHeadIndex(self._horse_results)
+        features = head_to_head.features(self._merged_data)
+        self._merged_data = pd.concat(
+            [self._merged_data, features[self._required_columns(features.columns)]], axis=1)
+
     def _merge_horse_info(self):
         """
         馬の基本情報テーブルのマージ
@@ -142,8 +178,9 @@ class DataMerger:
         """
         血統テーブルのマージ
         """
+        peds = self._peds if self._requirements is None else self._peds[self._required_columns(self._peds.columns)]
         self._merged_data = self._merged_data.merge(
-            self._peds,
+            peds,
             left_on='horse_id',
             right_index=True,
             how='left'
@@ -154,6 +191,9 @@ class DataMerger:
         騎手成績特徴量テーブルのマージ
 
         data/tmp/jockey_stats.pickle を (date, horse_id) 単位でマージする。
+        (date, horse_id) の行がないレース（出馬表のレースや、着順が数値でない出走など）は、
+        騎手（jockey_id）ごとに、レースの日付より前の最後の行の、その日の終わり時点の値（{列名}_after_day）を付ける
+        （AsOfJoiner）。前の行の値そのもの（その騎乗の結果を含まない）を付けると、学習データより1騎乗分古い値になるため。
         ファイルが存在しない場合は何もしない。
         """
         stats_path = LocalPaths.JOCKEY_STATS_PATH
@@ -161,44 +201,161 @@ class DataMerger:
             # 騎手特徴量ファイルがまだ生成されていない場合はスキップ
             return
 
-        stats = pd.read_pickle(stats_path)
         # JockeyStatsProcessor では (date, horse_id) をインデックスにしている想定
-        stats = stats.reset_index()  # date, horse_id 列を取り出す
+        # （ファイルが変わっていなければ、前回読み込んだものを使う）
+        stats = read_stats_table(stats_path)
 
         # 既存の self._merged_data 側にも jockey_id 列があるため、
         # ここでは騎手特徴量テーブル側の jockey_id は使わずに削除しておく
         # （重複した列名による "jockey_id_x" / "jockey_id_y" 化を防ぐ）
-        if 'jockey_id' in stats.columns:
-            stats = stats.drop(columns=['jockey_id'])
-
-        base = self._merged_data.copy()
-
-        base = base.merge(
-            stats,
+        suffix = JockeyStatsProcessor.AFTER_DAY_SUFFIX
+        stats_cols = [col for col in stats.columns
+                      if col not in ('date', 'horse_id', 'jockey_id') and not col.endswith(suffix)]
+        # モデルが使う列だけをマージする（対応する行の有無の判定にjockey_has_history_flagを使うため、これは残す）
+        stats_cols = [col for col in stats_cols
+                      if col == 'jockey_has_history_flag' or col in self._required_columns(stats_cols)]
+        base = self._merged_data.merge(
+            stats[['date', 'horse_id'] + stats_cols],
             on=['date', 'horse_id'],
             how='left'
         )
 
+        # (date, horse_id) の行がないレースは、騎手ごとにレースの日付より前の最後の行を付ける
+        if 'jockey_id' in stats.columns and 'jockey_id' in base.columns:
+            unmatched = base['jockey_has_history_flag'].isna().to_numpy()
+            if unmatched.any():
+                after_day_cols = [col + suffix for col in stats_cols]
+                missing = [col for col in after_day_cols if col not in stats.columns]
+                if missing:
+                    raise ValueError('{} に {} がありません。JockeyStatsProcessorで作り直してください'
+                                     .format(stats_path, missing))
+                joiner = AsOfJoiner.from_pickle(stats_path, by='jockey_id', columns=after_day_cols)
+                joined = joiner.join(base[unmatched])
+                for col, after_day_col in zip(stats_cols, after_day_cols):
+                    base.loc[unmatched, col] = joined[after_day_col].to_numpy()
+
         self._merged_data = base
-    
-    @property
-    def merged_data(self):
-        return self._merged_data
-    
-    def _filter_horse_results(self, horse_results, n_races):
+
+    def _merge_entity_form(self):
+        """
+        騎手・調教師・馬主・生産者・種牡馬の直近成績特徴量テーブル（EntityFormProcessor）のマージ
+
+        data/tmp/entity_form.pickle を (date, horse_id) 単位でマージする。
+        (date, horse_id) の行がないレース（出馬表のレースなど）は、_entity_form_from_stateで状態から求める。
+        ファイルが存在しない場合は何もしない。
         """
-        直近nレースに絞る
+        stats_path = LocalPaths.ENTITY_FORM_PATH
+        if not os.path.isfile(stats_path):
+            return
+
+        stats = read_stats_table(stats_path)
+        stats_cols = self._required_columns([col for col in stats.columns if col not in ('date', 'horse_id')])
+        if not stats_cols:
+            return
+        base = self._merged_data.merge(
+            stats[['date', 'horse_id'] + stats_cols],
+            on=['date', 'horse_id'],
+            how='left',
+            indicator=True
+        )
+        unmatched = (base.pop('_merge') == 'left_only').to_numpy()
+        if unmatched.any():
+            from_state = self._entity_form_from_state(base[unmatched], stats_cols)
+            if from_state is not None:
+                base.loc[from_state.index, stats_cols] = from_state.to_numpy()
+        self._merged_data = base
+
+    def _entity_form_from_state(self, rows: pd.DataFrame, stats_cols: list) -> pd.DataFrame:
         """
-        return horse_results.sort_values('date', ascending=False).groupby(level=0).head(n_races)
-    
-    def _summarize(self, horse_results, target_cols):
+        特徴量テーブルに行がないレースの直近成績特徴量を、LocalPaths.ENTITY_FORM_STATE_PATHに保存されている状態
+        （EntityFormState）から求める。対象は、状態に取り込み済みの最後の日付より後のレース（当日のレースなど）だけ。
+        状態がない場合・対象の行がない場合はNoneを返す（欠損値のまま）。
+
+        エンティティは、騎手はjockey_id、調教師・馬主はレース結果（出馬表）の trainer_id・owner_id、
+        生産者は馬の基本情報の breeder_id、種牡馬は血統の父（祖先辞書のコードをIDに戻したもの）。
+        騎手をjockey_idで引くため、状態はresults_filepathを指定したEntityFormProcessorのrunsから作っておく。
         """
-        horse_idごとに、target_colsを集計する
+        state_path = LocalPaths.ENTITY_FORM_STATE_PATH
+        if not os.path.isfile(state_path):
+            return None
+        state = EntityFormState.load(state_path)
+        target = rows['date'].notna()
+        if state.last_ingested_date is not None:
+            target &= rows['date'] > state.last_ingested_date
+        if state.current_date is not None:
+            target &= rows['date'] >= state.current_date
+        rows = rows[target]
+        if len(rows) == 0:
+            return None
+
+        runners = pd.DataFrame(index=rows.index)
+        for entity, col in (('jockey', 'jockey_id'), ('trainer', 'trainer_id'),
+                            ('owner', 'owner_id'), ('breeder', 'breeder_id')):
+            if col in rows.columns:
+                runners[entity] = rows[col].astype(object).to_numpy()
+        if 'peds_0' in self._peds.columns:
+            sire_codes = pd.Series(self._peds['peds_0'].cat.codes.to_numpy(), index=self._peds.index.astype(str))
+            sire_codes = sire_codes[~sire_codes.index.duplicated(keep='last')]
+            sire_codes = sire_codes.reindex(rows['horse_id'].astype(str)).fillna(-1)
+            ancestors = IdDictionary.open(LocalPaths.MASTER_PEDS_ANCESTORS_PATH, 'ancestor_id')
+            runners['sire'] = ancestors.decode(sire_codes.to_numpy(dtype=np.int64))
+        frames = [state.query_frame(runners.loc[day_rows.index], date)
+                  for date, day_rows in rows.groupby('date', sort=True)]
+        return pd.concat(frames)[stats_cols]
+
+    def _merge_pedigree_form(self):
         """
-        return horse_results.groupby(level=0)[target_cols].mean()
-        
-    def _summarize_with(self, horse_results, target_cols, group_col):
+        父・母父・祖先全体の産駒成績特徴量テーブル（PedigreeFormProcessor）のマージ
+
+        data/tmp/pedigree_form.pickle を (date, horse_id) 単位でマージする。
+        (date, horse_id) の行がないレース（出馬表のレースなど）は、_pedigree_form_from_stateで状態から求める。
+        ファイルが存在しない場合は何もしない。
         """
-        horse_id, group_colごとにtarget_colsを集計する
+        stats_path = LocalPaths.PEDIGREE_FORM_PATH
+        if not os.path.isfile(stats_path):
+            return
+
+        stats = read_stats_table(stats_path)
+        stats_cols = self._required_columns([col for col in stats.columns if col not in ('date', 'horse_id')])
+        if not stats_cols:
+            return
+        base = self._merged_data.merge(
+            stats[['date', 'horse_id'] + stats_cols],
+            on=['date', 'horse_id'],
+            how='left',
+            indicator=True
+        )
+        unmatched = (base.pop('_merge') == 'left_only').to_numpy()
+        if unmatched.any():
+            from_state = self._pedigree_form_from_state(base[unmatched], stats_cols)
+            if from_state is not None:
+                base.loc[from_state.index, stats_cols] = from_state.to_numpy()
+        self._merged_data = base
+
+    def _pedigree_form_from_state(self, rows: pd.DataFrame, stats_cols: list) -> pd.DataFrame:
+        """
+        特徴量テーブルに行がないレースの産駒成績特徴量を、LocalPaths.PEDIGREE_FORM_STATE_PATHに保存されている状態
+        （PedigreeFormState）から求める。対象は、状態の集計済みの最後の日付より後のレース（当日のレースなど）だけ。
+        状態がない場合・対象の行がない場合はNoneを返す（欠損値のまま）。
+        祖先は、血統（self._peds）の祖先辞書のコードで引く。血統がない馬は欠損値。
         """
-        return horse_results.groupby(['horse_id', group_col])[target_cols].mean()
\ No newline at end of file
+        state = PedigreeFormState.load_if_exists()
+        if state is None:
+            return None
+        target = rows['date'].notna()
+        if state.as_of is not None:
+            target &= rows['date'] > state.as_of
+        rows = rows[target]
+        if len(rows) == 0:
+            return None
+
+        peds = self._peds[~self._peds.index.duplicated(keep='last')]
+        positions = pd.Index(peds.index.astype(str)).get_indexer(rows['horse_id'].astype(str))
+        has_peds = positions >= 0
+        matrix = np.column_stack([peds[column].cat.codes.to_numpy() for column in peds.columns])
+        features = state.query(matrix[positions[has_peds]], index=rows.index[has_peds])
+        return features.reindex(rows.index)[stats_cols]
+
+    @property
+    def merged_data(self):
+        return self._merged_data
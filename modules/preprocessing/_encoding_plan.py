@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+
+from modules.constants import HorseResultsCols, Master
+
+
+class EncodingPlan:
+    """
+    カテゴリ変数（天気・race_type・馬場・性・開催・around・race_class）のエンコーディングを、
+    Masterの語彙とともに1か所で宣言し、1回の処理で変換するクラス。
+
+    - native=False: ダミー変数化。dumminize_*を同じ順に呼んだ場合と同じ列（{列名}_{値}、bool型）を、
+      1つのブロックとして1回の結合で追加する（dumminize_*は呼ぶごとにテーブル全体をコピーする）。
+    - native=True: 各列を、Masterの語彙をカテゴリとするCategorical型にする（列数は増えない）。
+      カテゴリはMasterの語彙で固定されているため、学習時と予測時でコードが一致する。
+      学習時はfeature_matrix()でコードに変換し、categorical_indices()の列をLightGBMのカテゴリ変数として渡す。
+      列数・変換時間は減るが、学習・予測の時間は短くならない（benchmarks/bench_encoding_plan.py）。
+      オプトインで、notebookの特徴量エンジニアリングはダミー変数化を使う（DataSplitterは、native=Trueの列がある場合だけ
+      カテゴリ変数として渡す）。
+    """
+    # (列名, 語彙)。ダミー変数の列は、この順に追加する
+    CATEGORICALS = (
+        ('ground_state', Master.GROUND_STATE_LIST),
+        ('race_type', tuple(Master.RACE_TYPE_DICT.values())),
+        ('性', Master.SEX_LIST),
+        ('weather', Master.WEATHER_LIST),
+        (HorseResultsCols.PLACE, tuple(Master.PLACE_DICT.values())),
+        ('around', Master.AROUND_LIST),
+        ('race_class', Master.RACE_CLASS_LIST),
+        )
+
+    def __init__(self, native: bool = False, columns: list = None):
+        """
+        初期処理
+
+        columnsで、変換する列をCATEGORICALSの一部に絞り込める（Noneなら全て）。
+        columnsを指定した場合、ダミー変数の列はcolumnsの順に追加する。
+        """
+        self.__native = native
+        vocabularies = dict(self.CATEGORICALS)
+        self.__categoricals = [
+            (col, vocabularies[col]) for col in (columns if columns is not None else vocabularies)
+            ]
+
+    @property
+    def native(self) -> bool:
+        return self.__native
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        dfのカテゴリ変数を変換した新しいDataFrameを返す（dfにない列は飛ばす）。
+        """
+        categoricals = [(col, vocabulary) for col, vocabulary in self.__categoricals if col in df.columns]
+        if self.__native:
+            return df.assign(**{
+                col: pd.Categorical(df[col], categories=list(vocabulary)) for col, vocabulary in categoricals
+                })
+
+        return pd.concat([df.drop(columns=[col for col, _ in categoricals]), self.dummies(df)], axis=1)
+
+    def dummies(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        dfのカテゴリ変数のダミー変数だけのDataFrame。全ての列のダミー変数を、1つのbool配列に書き込んで作る。
+        """
+        categoricals = [(col, vocabulary) for col, vocabulary in self.__categoricals if col in df.columns]
+        names, offsets = [], [0]
+        for col, vocabulary in categoricals:
+            names += self.dummy_names(col)
+            offsets.append(offsets[-1] + len(vocabulary))
+        block = np.zeros((len(df), len(names)), dtype=bool)
+        rows = np.arange(len(df))
+        for (col, vocabulary), offset in zip(categoricals, offsets):
+            codes = pd.Categorical(df[col], categories=list(vocabulary)).codes
+            block[rows[codes >= 0], offset + codes[codes >= 0]] = True
+        return pd.DataFrame(block, index=df.index, columns=names)
+
+    @classmethod
+    def dummy_names(cls, col: str) -> list:
+        """colのダミー変数の列名（get_dummiesと同じ {列名}_{値}）"""
+        return ['{}_{}'.format(col, value) for value in dict(cls.CATEGORICALS)[col]]
+
+    @classmethod
+    def native_columns(cls, X: pd.DataFrame) -> list:
+        """Xのうち、native=Trueで変換したカテゴリ変数の列（Categorical型のもの）"""
+        return [
+            col for col, _ in cls.CATEGORICALS
+            if col in X.columns and isinstance(X[col].dtype, pd.CategoricalDtype)
+            ]
+
+    @classmethod
+    def categorical_indices(cls, X: pd.DataFrame) -> list:
+        """LightGBMのcategorical_featureに渡す、native_columns()の列の位置"""
+        return [X.columns.get_loc(col) for col in cls.native_columns(X)]
+
+    @classmethod
+    def feature_matrix(cls, X: pd.DataFrame, dtype=None) -> np.ndarray:
+        """
+        学習用の配列（X.values）。native_columns()の列は、カテゴリのコード（欠損値はNaN）にする。
+        dtype（np.float32など）を指定した場合は、列ごとにdtypeの配列に書き込む（object型の配列を経由しない）。
+        その場合、native_columns()以外のCategorical型の列（ラベルエンコーディングしたIDなど）は、X.valuesと同じくカテゴリの値にする。
+        """
+        native_columns = cls.native_columns(X)
+        if dtype is None:
+            if not native_columns:
+                return X.values
+            return X.assign(**{
+                col: X[col].cat.codes.astype(float).where(X[col].cat.codes >= 0) for col in native_columns
+                }).values
+
+        matrix = np.empty((len(X), X.shape[1]), dtype=dtype)
+        for i, col in enumerate(X.columns):
+            s = X.iloc[:, i]
+            if col in native_columns:
+                codes = s.cat.codes.to_numpy()
+                matrix[:, i] = np.where(codes >= 0, codes, np.nan)
+            else:
+                matrix[:, i] = s.to_numpy(dtype=float, na_value=np.nan)
+        return matrix
@@ -0,0 +1,195 @@
+import numpy as np
+import pandas as pd
+
+from ._abstract_data_processor import AbstractDataProcessor
+from . import _string_kernels as kernels
+from modules.constants import HorseResultsCols as Cols
+from modules.constants import ResultsCols
+
+
+class EntityFormProcessor(AbstractDataProcessor):
+    """騎手・調教師・馬主・生産者・種牡馬（エンティティ）ごとの、直近成績の特徴量を計算する前処理クラス。
+
+    入力:
+        - filepath: 馬の成績データ（horse_results）のrawデータのパス。騎手は騎手列を使う。
+        - horse_info_filepath: 馬の基本情報（horse_info）のrawデータのパス。
+          調教師・馬主・生産者（trainer_id, owner_id, breeder_id）を使う。省略した場合は計算しない。
+        - peds_filepath: 血統（peds）のrawデータのパス。種牡馬（peds_0）を使う。省略した場合は計算しない。
+        - results_filepath: レース結果（results）のrawデータのパス（省略可）。
+          指定した場合、騎手を 騎手名 ではなく、レース結果の 騎手名 → jockey_id の対応で netkeiba の騎手IDで区別する
+          （DataMergerが、当日のレースの特徴量をEntityFormStateから出馬表の jockey_id で求められるようにするため）。
+
+    出力 (preprocessed_data プロパティ):
+        - インデックス: date, horse_id
+        - カラム: エンティティ・集計期間ごとに
+            - {entity}_starts_{window}:     集計期間内の出走数
+            - {entity}_place_rate_{window}: 複勝率（1〜3着）
+            - {entity}_win_rate_{window}:   勝率
+            - {entity}_roi_{window}:        単勝を1ずつ買った場合の回収率（単勝オッズ × 1着フラグの平均）
+          集計期間（window）は、直近n走（'{n}R'）と、直近n日（'{n}D'）。
+
+        すべて "対象レースの日付より前のレースのみ" を用いて計算する（同じ日のレースは含めない）。
+        エンティティ・日付順に並べた配列に対し、各期間の先頭位置をsearchsortedで求め、
+        累積和の差分で集計するため、期間を1つ増やしても線形時間で済む。
+
+    当日のレース（この特徴量テーブルにない日付）の特徴量は、DataMerger・ShutubaDataMergerが
+    LocalPaths.ENTITY_FORM_STATE_PATHの状態（EntityFormState）から求める。結果を取り込んだ後に、次のように状態を保存しておく。
+        EntityFormState.rebuild(entity_form_processor.runs).save()
+    """
+    ENTITY_COLS = {
+        'jockey': Cols.JOCKEY,
+        'trainer': 'trainer_id',
+        'owner': 'owner_id',
+        'breeder': 'breeder_id',
+        'sire': 'peds_0',
+        }
+    # エンティティ・日付を1つのint64にまとめる時の、日付部分のビット数
+    _DAY_BITS = 20
+
+    def __init__(self, filepath: str, horse_info_filepath: str = None, peds_filepath: str = None,
+                 n_starts_list: tuple = (10, 50), n_days_list: tuple = (30, 90, 365),
+                 results_filepath: str = None, copy: bool = False, use_cache: bool = True):
+        self.__horse_info_filepath = horse_info_filepath
+        self.__peds_filepath = peds_filepath
+        self.__results_filepath = results_filepath
+        self.__n_starts_list = tuple(n_starts_list)
+        self.__n_days_list = tuple(n_days_list)
+        super().__init__(filepath, copy, use_cache)
+
+    def _cache_params(self) -> dict:
+        return {
+            'files': [self.__horse_info_filepath, self.__peds_filepath, self.__results_filepath],
+            'n_starts_list': self.__n_starts_list,
+            'n_days_list': self.__n_days_list,
+            }
+
+    def _preprocess(self) -> pd.DataFrame:
+        """エンティティごとの直近成績の特徴量を計算して返す。"""
+        df = self.runs
+        entities = [entity for entity in self.ENTITY_COLS if entity in df.columns]
+
+        metrics = {
+            'place': df['rank'].between(1, 3).to_numpy(dtype=float),
+            'win': (df['rank'] == 1).to_numpy(dtype=float),
+            'roi': ((df['rank'] == 1) * df['odds'].fillna(0)).to_numpy(dtype=float),
+            }
+        days = (df['date'].to_numpy().astype('datetime64[D]').astype(np.int64))
+
+        features = [self._entity_form(entity, df[entity].to_numpy(), days, metrics,
+                                      self.__n_starts_list, self.__n_days_list)
+                    for entity in entities]
+        out = pd.concat([df[['date', 'horse_id']]] + features, axis=1)
+        out = out.set_index(['date', 'horse_id']).sort_index()
+
+        # マージ時にキーが一意になるよう、(date, horse_id) が重複している行は後ろを優先して残す
+        out = out[~out.index.duplicated(keep='last')]
+        return out
+
+    @property
+    def runs(self) -> pd.DataFrame:
+        """
+        集計に使う出走の一覧（build_runs()の形式）。EntityFormState.rebuild()に渡すと、この特徴量と同じ状態になる。
+        """
+        horse_info = self.read_by_horse_id(self.__horse_info_filepath) \
+            if self.__horse_info_filepath is not None else None
+        peds = self.read_by_horse_id(self.__peds_filepath) if self.__peds_filepath is not None else None
+        jockey_ids = self.read_jockey_ids(self.__results_filepath) if self.__results_filepath is not None else None
+        return self.build_runs(self.raw_data, horse_info, peds, jockey_ids)
+
+    @classmethod
+    def build_runs(cls, raw: pd.DataFrame, horse_info: pd.DataFrame = None, peds: pd.DataFrame = None,
+                   jockey_ids: pd.Series = None) -> pd.DataFrame:
+        """
+        horse_resultsのrawデータから、集計に使う出走の一覧（date, horse_id, rank, odds, 各エンティティ列）を作る。
+        エンティティ列は、jockey（騎手名。jockey_ids（read_jockey_ids()）を渡した場合は、対応がある騎手はjockey_id）と、
+        horse_info・pedsを渡した場合はtrainer, owner, breeder, sire。
+        着順が数値でない（取消、中止など）・日付がないレースは除く。
+        """
+        rank = kernels.map_unique(raw[Cols.RANK], lambda u: pd.to_numeric(u, errors='coerce'))
+        df = pd.DataFrame({
+            'date': kernels.to_datetime_unique(raw[Cols.DATE]).to_numpy(),
+            'horse_id': raw.index.astype(str),
+            'rank': rank.to_numpy(),
+            'odds': pd.to_numeric(raw[Cols.TANSHO_ODDS], errors='coerce').to_numpy(),
+            'jockey': raw[cls.ENTITY_COLS['jockey']].to_numpy(),
+            })
+        df = df[df['rank'].notna() & df['date'].notna()].reset_index(drop=True)
+        if jockey_ids is not None:
+            df['jockey'] = df['jockey'].astype(str).map(jockey_ids).fillna(df['jockey'])
+
+        # 調教師・馬主・生産者、種牡馬は、horse_idで対応付ける
+        if horse_info is not None:
+            for entity in ('trainer', 'owner', 'breeder'):
+                col = cls.ENTITY_COLS[entity]
+                if col in horse_info.columns:
+                    df[entity] = df['horse_id'].map(horse_info[col])
+        if peds is not None:
+            df['sire'] = df['horse_id'].map(peds[cls.ENTITY_COLS['sire']])
+        return df
+
+    @classmethod
+    def _entity_form(cls, entity: str, values: np.ndarray, days: np.ndarray, metrics: dict,
+                     n_starts_list: tuple, n_days_list: tuple) -> pd.DataFrame:
+        """
+        1つのエンティティについて、各行（出走）より前の日付の成績を、各集計期間で集計する。
+        エンティティが欠損している行は、全て欠損値になる。
+        """
+        codes, _ = pd.factorize(values, use_na_sentinel=True)
+        n_rows = len(codes)
+        # エンティティ・日付順に並べる（エンティティが欠損している行は除く）
+        order = np.lexsort((days, codes))
+        order = order[codes[order] >= 0]
+        # 日付は、最も長い集計期間を引いても負にならないようにずらす
+        day_offset = days.min() - max(n_days_list, default=0) if n_rows > 0 else 0
+        entity_key = codes[order].astype(np.int64) << cls._DAY_BITS
+        sorted_days = days[order] - day_offset
+        key = entity_key + sorted_days
+
+        # 各行のエンティティの先頭位置と、同じエンティティ・同じ日付の先頭位置（それより前が対象行の過去の成績）
+        group_start = np.searchsorted(key, entity_key, side='left')
+        prior_end = np.searchsorted(key, key, side='left')
+        # cum[i]: 並べ替え後の先頭からi-1行目までの合計
+        cum_starts = np.arange(len(order) + 1)
+        cums = {name: np.r_[0, np.cumsum(metric[order])] for name, metric in metrics.items()}
+
+        windows = {'{}R'.format(n): np.maximum(group_start, prior_end - n) for n in n_starts_list}
+        for n in n_days_list:
+            windows['{}D'.format(n)] = np.searchsorted(key, entity_key + sorted_days - n, side='left')
+
+        features = {}
+        for window, window_start in windows.items():
+            starts = cum_starts[prior_end] - cum_starts[window_start]
+            features['{}_starts_{}'.format(entity, window)] = starts
+            with np.errstate(invalid='ignore', divide='ignore'):
+                for name, cum in cums.items():
+                    rate = np.where(starts > 0, (cum[prior_end] - cum[window_start]) / starts, np.nan)
+                    col = '{}_{}_{}'.format(entity, name if name == 'roi' else name + '_rate', window)
+                    features[col] = rate
+
+        # 元の行の順番に戻す
+        out = {}
+        for col, sorted_values in features.items():
+            if col.startswith('{}_starts_'.format(entity)):
+                values_ = np.zeros(n_rows, dtype=np.int64)
+            else:
+                values_ = np.full(n_rows, np.nan)
+            values_[order] = sorted_values
+            out[col] = values_
+        return pd.DataFrame(out)
+
+    @staticmethod
+    def read_by_horse_id(filepath: str) -> pd.DataFrame:
+        """
+        horse_idをインデックスとするrawデータを読み込む（重複しているhorse_idは後ろを優先する）
+        """
+        df = pd.read_pickle(filepath)
+        df.index = df.index.astype(str)
+        return df[~df.index.duplicated(keep='last')]
+
+    @staticmethod
+    def read_jockey_ids(results_filepath: str) -> pd.Series:
+        """レース結果のrawデータの 騎手名 → jockey_id の対応（同じ騎手名が複数ある場合は後ろの行を優先）"""
+        results = pd.read_pickle(results_filepath)
+        pairs = results[[ResultsCols.JOCKEY, 'jockey_id']].dropna().astype(str)
+        pairs = pairs.drop_duplicates(ResultsCols.JOCKEY, keep='last')
+        return pd.Series(pairs['jockey_id'].to_numpy(), index=pairs[ResultsCols.JOCKEY].to_numpy())
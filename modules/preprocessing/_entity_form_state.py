@@ -0,0 +1,284 @@
+import pickle
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from ._entity_form_processor import EntityFormProcessor
+from modules.constants import LocalPaths
+
+
+class _EntityBuffer:
+    """
+    1つのエンティティ（騎手など）の直近成績。
+
+    - 直近n走: 最大の走数分の固定長リングバッファと、走数ごとの合計
+    - 直近n日: 最も長い期間内の出走のキューと、期間ごとの合計（期間の先頭の位置を持ち、日付が進んだ分だけ引く）
+    合計は [出走数, 複勝数, 勝利数, 単勝払戻の合計（オッズ×10の整数）] の順。
+    """
+    __slots__ = ('ring', 'count', 'start_sums', 'events', 'offset', 'day_ptrs', 'day_sums')
+
+    def __init__(self, n_starts_list: tuple, n_days_list: tuple):
+        self.ring = [None] * max(n_starts_list, default=0)
+        self.count = 0
+        self.start_sums = [[0, 0, 0, 0] for _ in n_starts_list]
+        # (日, 複勝, 勝利, 払戻)。offsetは、これまでに左から捨てた数（day_ptrsは捨てた分も含めた位置）
+        self.events = deque()
+        self.offset = 0
+        self.day_ptrs = [0] * len(n_days_list)
+        self.day_sums = [[0, 0, 0, 0] for _ in n_days_list]
+
+    def push(self, event: tuple, n_starts_list: tuple) -> None:
+        """1走分の成績を追加する"""
+        size = len(self.ring)
+        if size > 0:
+            for n, sums in zip(n_starts_list, self.start_sums):
+                _add(sums, event, 1)
+                if self.count >= n:
+                    # n走前の成績が期間から外れる（上書きする前に引く）
+                    _add(sums, self.ring[(self.count - n) % size], -1)
+            self.ring[self.count % size] = event
+        self.count += 1
+        if self.day_sums:
+            self.events.append(event)
+            for sums in self.day_sums:
+                _add(sums, event, 1)
+
+    def advance(self, day: int, n_days_list: tuple) -> None:
+        """dayを基準に、直近n日の期間から外れた出走を合計から引き、どの期間にも入らなくなった出走を捨てる"""
+        end = self.offset + len(self.events)
+        for i, n in enumerate(n_days_list):
+            ptr = self.day_ptrs[i]
+            while ptr < end and self.events[ptr - self.offset][0] < day - n:
+                _add(self.day_sums[i], self.events[ptr - self.offset], -1)
+                ptr += 1
+            self.day_ptrs[i] = ptr
+        while self.events and self.offset < min(self.day_ptrs):
+            self.events.popleft()
+            self.offset += 1
+
+
+def _add(sums: list, event: tuple, sign: int) -> None:
+    sums[0] += sign
+    sums[1] += sign * event[1]
+    sums[2] += sign * event[2]
+    sums[3] += sign * event[3]
+
+
+class EntityFormState:
+    """
+    騎手・調教師・馬主・生産者・種牡馬（エンティティ）ごとの直近成績を、
+    レース結果を取り込むたびに差分で更新していく状態。当日のレースの特徴量を、出走1頭あたりO(1)で返す。
+
+    - ingest(): 1日分のレース結果を取り込む。日付は取り込み済みの日付より後でなければならない。
+    - query() / query_frame(): 指定した日付より前のレースだけを使った特徴量
+      （EntityFormProcessorの出力と同じカラム名・同じ値）を返す。
+      日付は、取り込み済みの日付より後、かつ前回の問い合わせ以降でなければならない。
+    - rebuild(): horse_resultsのrawデータから、状態を作り直す。
+    - save() / load(): pickleで保存・読み込みする。
+
+    出走の一覧（runs）は、EntityFormProcessor.build_runs()の形式（date, rank, odds, 各エンティティ列）。
+    DataMerger・ShutubaDataMergerは、LocalPaths.ENTITY_FORM_STATE_PATHに保存されている状態を読み込み、
+    特徴量テーブル（EntityFormProcessor）に行がない当日のレースの特徴量を求める。
+    """
+    ENTITIES = tuple(EntityFormProcessor.ENTITY_COLS)
+
+    def __init__(self, n_starts_list: tuple = (10, 50), n_days_list: tuple = (30, 90, 365)):
+        """
+        初期処理
+        """
+        self.__n_starts_list = tuple(n_starts_list)
+        self.__n_days_list = tuple(n_days_list)
+        self.__buffers = {entity: {} for entity in self.ENTITIES}
+        # 取り込み済みの最後の日付、問い合わせ・取り込みで進めた最後の日付（1970-01-01からの日数）
+        self.__last_ingested_day = None
+        self.__current_day = None
+
+    @property
+    def last_ingested_date(self):
+        """取り込み済みの最後の日付"""
+        if self.__last_ingested_day is None:
+            return None
+        return pd.Timestamp(np.datetime64(self.__last_ingested_day, 'D'))
+
+    @property
+    def current_date(self):
+        """問い合わせ・取り込みで進めた最後の日付（これより前の日付は問い合わせできない）"""
+        if self.__current_day is None:
+            return None
+        return pd.Timestamp(np.datetime64(self.__current_day, 'D'))
+
+    @property
+    def feature_columns(self) -> list:
+        """query_frame()が返すカラム（EntityFormProcessorの出力と同じ順番）"""
+        return [col for entity in self.ENTITIES for col in self.__entity_columns(entity)]
+
+    def n_entities(self, entity: str) -> int:
+        return len(self.__buffers[entity])
+
+    @classmethod
+    def rebuild(cls, runs: pd.DataFrame, n_starts_list: tuple = (10, 50),
+                n_days_list: tuple = (30, 90, 365)) -> 'EntityFormState':
+        """
+        出走の一覧から状態を作り直す。
+        各エンティティについて、以降の特徴量に影響する出走（直近の最大走数分と、最後の日付から最も長い期間内）
+        だけを古い順に取り込むので、全履歴を1日ずつ取り込むより速い。
+        """
+        state = cls(n_starts_list, n_days_list)
+        runs = runs.dropna(subset=['date']).sort_values('date', kind='stable')
+        if len(runs) == 0:
+            return state
+        days = cls.__to_days(runs['date'])
+        events = cls.__to_events(runs)
+        last_day = int(days.max())
+        max_starts = max(state.__n_starts_list, default=0)
+        recent = days >= last_day - max(state.__n_days_list, default=0)
+        for entity in cls.ENTITIES:
+            if entity not in runs.columns:
+                continue
+            values = runs[entity]
+            notna = values.notna().to_numpy()
+            # 後ろから数えたエンティティ内の順番
+            rank_from_last = values[notna].groupby(values[notna], sort=False).cumcount(ascending=False)
+            keep = notna.copy()
+            keep[notna] = (rank_from_last.to_numpy() < max_starts) | recent[notna]
+            buffers = state.__buffers[entity]
+            for entity_id, day, event in zip(values.to_numpy()[keep], days[keep].tolist(), events[keep].tolist()):
+                state.__buffer(buffers, entity_id).push((day, *event), state.__n_starts_list)
+        state.__last_ingested_day = state.__current_day = last_day
+        return state
+
+    def ingest(self, runs: pd.DataFrame, date=None) -> None:
+        """
+        1日分の出走を取り込む。dateを省略した場合はruns['date']（すべて同じ日付）を使う。
+        """
+        if date is None:
+            dates = runs['date'].dropna().unique()
+            if len(dates) == 0:
+                return
+            if len(dates) > 1:
+                raise ValueError('ingest() には1日分のレース結果を渡してください: {}'.format(sorted(dates)))
+            date = dates[0]
+        day = self.__to_day(date)
+        if self.__last_ingested_day is not None and day <= self.__last_ingested_day:
+            raise ValueError('{} は取り込み済みです（最後に取り込んだ日付: {}）'.format(
+                pd.Timestamp(date).date(), self.last_ingested_date.date()))
+        events = self.__to_events(runs)
+        for entity in self.ENTITIES:
+            if entity not in runs.columns:
+                continue
+            buffers = self.__buffers[entity]
+            for entity_id, event in zip(runs[entity].to_numpy(), events.tolist()):
+                if pd.isna(entity_id):
+                    continue
+                self.__buffer(buffers, entity_id).push((day, *event), self.__n_starts_list)
+        self.__last_ingested_day = day
+        self.__current_day = max(day, self.__current_day) if self.__current_day is not None else day
+
+    def ingest_runs(self, runs: pd.DataFrame) -> None:
+        """
+        複数日分の出走を、日付順に1日ずつ取り込む。取り込み済みの日付以前の出走は無視する。
+        """
+        runs = runs.dropna(subset=['date'])
+        if self.__last_ingested_day is not None:
+            runs = runs[self.__to_days(runs['date']) > self.__last_ingested_day]
+        for date, day_runs in runs.groupby('date', sort=True):
+            self.ingest(day_runs, date)
+
+    def query(self, entity: str, entity_id, date) -> dict:
+        """
+        1つのエンティティについて、dateより前のレースだけを使った直近成績の特徴量を返す。
+        """
+        day = self.__check_query_day(date)
+        return dict(zip(self.__entity_columns(entity), self.__query_values(entity, entity_id, day)))
+
+    def query_frame(self, runners: pd.DataFrame, date) -> pd.DataFrame:
+        """
+        出走馬（エンティティ列を持つDataFrame）ごとに、dateより前のレースだけを使った特徴量を返す。
+        インデックスはrunnersと同じ。runnersにないエンティティの特徴量は欠損値（出走数は0）になる。
+        """
+        day = self.__check_query_day(date)
+        out = {}
+        for entity in self.ENTITIES:
+            columns = self.__entity_columns(entity)
+            values = runners[entity].to_numpy() if entity in runners.columns else [None] * len(runners)
+            rows = [self.__query_values(entity, entity_id, day) for entity_id in values]
+            matrix = np.array(rows, dtype=float).reshape(len(runners), len(columns))
+            for i, col in enumerate(columns):
+                if '_starts_' in col:
+                    out[col] = matrix[:, i].astype(np.int64)
+                else:
+                    out[col] = matrix[:, i]
+        return pd.DataFrame(out, index=runners.index)
+
+    def save(self, filepath: str = LocalPaths.ENTITY_FORM_STATE_PATH) -> None:
+        with open(filepath, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filepath: str = LocalPaths.ENTITY_FORM_STATE_PATH) -> 'EntityFormState':
+        with open(filepath, 'rb') as f:
+            state = pickle.load(f)
+        if not isinstance(state, cls):
+            raise TypeError('{} は {} ではありません'.format(filepath, cls.__name__))
+        return state
+
+    def __query_values(self, entity: str, entity_id, day: int) -> list:
+        """
+        [出走数, 複勝率, 勝率, 回収率] を、直近n走・直近n日の順に並べたもの
+        """
+        buffer = None if entity_id is None or pd.isna(entity_id) else self.__buffers[entity].get(entity_id)
+        if buffer is None:
+            return [0, np.nan, np.nan, np.nan] * (len(self.__n_starts_list) + len(self.__n_days_list))
+        buffer.advance(day, self.__n_days_list)
+        values = []
+        for sums in buffer.start_sums + buffer.day_sums:
+            starts = sums[0]
+            if starts > 0:
+                values += [starts, sums[1] / starts, sums[2] / starts, sums[3] / 10 / starts]
+            else:
+                values += [0, np.nan, np.nan, np.nan]
+        return values
+
+    def __entity_columns(self, entity: str) -> list:
+        windows = ['{}R'.format(n) for n in self.__n_starts_list] + ['{}D'.format(n) for n in self.__n_days_list]
+        columns = []
+        for window in windows:
+            columns += ['{}_starts_{}'.format(entity, window), '{}_place_rate_{}'.format(entity, window),
+                        '{}_win_rate_{}'.format(entity, window), '{}_roi_{}'.format(entity, window)]
+        return columns
+
+    def __check_query_day(self, date) -> int:
+        day = self.__to_day(date)
+        if self.__last_ingested_day is not None and day <= self.__last_ingested_day:
+            raise ValueError('{} の結果は取り込み済みのため、リークのない特徴量を返せません'.format(
+                pd.Timestamp(date).date()))
+        if self.__current_day is not None and day < self.__current_day:
+            raise ValueError('問い合わせの日付は、前回（{}）以降にしてください'.format(
+                pd.Timestamp(np.datetime64(self.__current_day, 'D')).date()))
+        self.__current_day = day
+        return day
+
+    def __buffer(self, buffers: dict, entity_id) -> _EntityBuffer:
+        buffer = buffers.get(entity_id)
+        if buffer is None:
+            buffer = buffers[entity_id] = _EntityBuffer(self.__n_starts_list, self.__n_days_list)
+        return buffer
+
+    @staticmethod
+    def __to_events(runs: pd.DataFrame) -> np.ndarray:
+        """
+        各出走の [複勝, 勝利, 単勝払戻] の整数の配列（行数×3）。払戻は誤差が積み重ならないよう、オッズ×10の整数にする。
+        """
+        rank = runs['rank'].to_numpy(dtype=float)
+        win = rank == 1
+        payout = np.where(win, np.rint(runs['odds'].fillna(0).to_numpy(dtype=float) * 10), 0)
+        return np.column_stack([(rank >= 1) & (rank <= 3), win, payout]).astype(np.int64)
+
+    @staticmethod
+    def __to_days(dates: pd.Series) -> np.ndarray:
+        return pd.to_datetime(dates).to_numpy().astype('datetime64[D]').astype(np.int64)
+
+    @staticmethod
+    def __to_day(date) -> int:
+        return int(np.datetime64(pd.Timestamp(date), 'D').astype(np.int64))
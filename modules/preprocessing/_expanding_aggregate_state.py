@@ -0,0 +1,242 @@
+import os
+import numpy as np
+import pandas as pd
+
+from modules.constants import LocalPaths
+
+
+class ExpandingAggregateState:
+    """
+    馬ごと、(馬, group_colの値) ごとの過去成績（target_cols）の合計・個数と、馬ごとの前走の日付を持つ状態。
+    馬ごとに、集計済みの最後の日付（前走の日付）と集計済みの行数を持ち、新しい過去成績が増えた分だけupdate()で足し込む。
+
+    - update(): 各馬の、集計済みの最後の日付より後の行だけを足し込む。各行の馬の最後の日付との比較は
+      ベクトル化した1回の検索で行い、キーごとの処理は足し込む行だけに行う（増えた行数に比例する処理時間）。
+      新しく取得した馬（新馬・地方からの転入など）の過去成績は、as_of以前の日付でも全て足し込まれる。
+    - lookup(): as_ofより後の日付のレースについて、*_allR、*_{group_col}_allR、latestを出走馬ごとに返す
+      （AsOfWindowAggregatorの全レースの集計と同じ値）。
+    - row_counts(): 馬ごとの集計済みの行数。AsOfWindowAggregatorは、過去成績の行数と一致しない馬
+      （集計済みの日付より前の過去成績が後から増えた馬など）には状態を使わず、過去成績から計算する。
+    - save() / load(): 1行1キーのテーブル（horse_id, group_col, group_value, count_*, sum_*, latest, n_rows）で保存する。
+      保存した形式のバージョン（VERSION）が違う状態は読み込まない（load_if_existsはNoneを返すので、作り直す）。
+
+    DataMerger・ShutubaDataMergerは、LocalPaths.EXPANDING_STATE_PATHに保存されている状態を読み込んで使う。
+    過去成績を更新した後に、次のように状態を進めておく。
+        state = ExpandingAggregateState.load_if_exists(TARGET_COLS, GROUP_COLS)
+        if state is None:
+            state = ExpandingAggregateState(TARGET_COLS, GROUP_COLS)
+        for chunk in horse_results_processor.iter_chunks():
+            state.update(chunk)
+        state.save()
+    （チャンクには馬ごとの全ての行が入っているため、チャンクごとに足し込んでも全体を1度に足し込んだ場合と同じになる）
+    """
+    # 保存する形式のバージョン（形式を変えたら上げる）
+    VERSION = 2
+
+    def __init__(self, target_cols: list, group_cols: list):
+        """
+        初期処理
+        """
+        self.__target_cols = list(target_cols)
+        self.__group_cols = list(group_cols)
+        # キー（(horse_id, '', None) または (horse_id, group_col, 値)）-> 行の位置
+        self.__rows = {}
+        # 馬のキーの行だけの索引（horse_id -> 行の位置）。ベクトル化した検索に使う
+        self.__horse_ids = pd.Index([], dtype=object)
+        self.__horse_rows = np.zeros(0, dtype=np.int64)
+        self.__sums = np.zeros((0, len(self.__target_cols)))
+        self.__counts = np.zeros((0, len(self.__target_cols)), dtype=np.int64)
+        # 前走の日付（1970-01-01からの日数）と集計済みの行数（馬のキーの行だけ使う）
+        self.__latest = np.zeros(0, dtype=np.int64)
+        self.__n_rows = np.zeros(0, dtype=np.int64)
+        self.__as_of = None
+
+    @property
+    def target_cols(self):
+        return self.__target_cols
+
+    @property
+    def group_cols(self):
+        return self.__group_cols
+
+    @property
+    def as_of(self):
+        """集計済みの最後の日付"""
+        return self.__as_of
+
+    def __len__(self):
+        return len(self.__rows)
+
+    def update(self, horse_results: pd.DataFrame) -> int:
+        """
+        前処理済みの過去成績（インデックスがhorse_id）のうち、各馬の集計済みの最後の日付より後の行を足し込み、
+        足し込んだ行数を返す。集計済みの最後の日付以前の行は集計済みとして無視する。
+        """
+        horse_results = horse_results[horse_results['date'].notna()]
+        days = horse_results['date'].to_numpy().astype('datetime64[D]').astype(np.int64)
+        horse_ids = horse_results.index.astype(str).to_numpy()
+        # 各行の馬の、集計済みの最後の日付（まだ集計していない馬は全ての行を足し込む）
+        known = self.__horse_positions(horse_ids)
+        last_days = np.full(len(horse_ids), np.iinfo(np.int64).min, dtype=np.int64)
+        last_days[known >= 0] = self.__latest[known[known >= 0]]
+        is_new = days > last_days
+        if not is_new.any():
+            return 0
+        horse_results, horse_ids, days = horse_results[is_new], horse_ids[is_new], days[is_new]
+
+        values = horse_results[self.__target_cols].to_numpy(dtype=float)
+        notna = ~np.isnan(values)
+        values = np.where(notna, values, 0.0)
+
+        keys = [(horse_id, '', None) for horse_id in horse_ids]
+        positions = self.__positions(keys)
+        np.add.at(self.__sums, positions, values)
+        np.add.at(self.__counts, positions, notna)
+        np.maximum.at(self.__latest, positions, days)
+        np.add.at(self.__n_rows, positions, 1)
+        # 新しい馬を、馬のキーの索引に追加する
+        new_horses = pd.unique(horse_ids[known[is_new] < 0])
+        if len(new_horses) > 0:
+            self.__horse_ids = self.__horse_ids.append(pd.Index(new_horses, dtype=object))
+            self.__horse_rows = np.r_[self.__horse_rows,
+                                      [self.__rows[(horse_id, '', None)] for horse_id in new_horses]]
+        for group_col in self.__group_cols:
+            group_values = horse_results[group_col].tolist()
+            has_value = np.flatnonzero(horse_results[group_col].notna().to_numpy())
+            keys = [(horse_ids[i], group_col, group_values[i]) for i in has_value]
+            positions = self.__positions(keys)
+            np.add.at(self.__sums, positions, values[has_value])
+            np.add.at(self.__counts, positions, notna[has_value])
+
+        as_of = horse_results['date'].max()
+        self.__as_of = as_of if self.__as_of is None else max(self.__as_of, as_of)
+        return len(horse_results)
+
+    def row_counts(self, horse_ids) -> np.ndarray:
+        """
+        馬ごとの集計済みの過去成績の行数（日付が欠損している行を除く）。集計していない馬は0。
+        """
+        positions = self.__horse_positions(horse_ids)
+        counts = np.zeros(len(positions), dtype=np.int64)
+        counts[positions >= 0] = self.__n_rows[positions[positions >= 0]]
+        return counts
+
+    def lookup(self, results: pd.DataFrame) -> pd.DataFrame:
+        """
+        resultsの各行（horse_id, group_colsを持つ）について、*_allR、*_{group_col}_allR、latestを返す。
+        インデックスはresultsと同じ。集計済みの過去成績がない場合は欠損値。
+        """
+        horse_ids = results['horse_id'].astype(str).tolist()
+        positions = self.__horse_positions(horse_ids)
+        features = {}
+        means = self.__means_at(positions)
+        for i, col in enumerate(self.__target_cols):
+            features['{}_allR'.format(col)] = means[:, i]
+        for group_col in self.__group_cols:
+            group_values = results[group_col].tolist()
+            keys = [(horse_id, group_col, value) if not pd.isna(value) else None
+                    for horse_id, value in zip(horse_ids, group_values)]
+            means = self.__means(keys)
+            for i, col in enumerate(self.__target_cols):
+                features['{}_{}_allR'.format(col, group_col)] = means[:, i]
+        latest = np.full(len(results), np.datetime64('NaT'), dtype='datetime64[ns]')
+        latest[positions >= 0] = self.__latest[positions[positions >= 0]].astype('datetime64[D]')
+        features['latest'] = latest
+        return pd.DataFrame(features, index=results.index)
+
+    def save(self, filepath: str = LocalPaths.EXPANDING_STATE_PATH) -> None:
+        keys = list(self.__rows)
+        n = len(keys)
+        table = pd.DataFrame({
+            'horse_id': [key[0] for key in keys],
+            'group_col': [key[1] for key in keys],
+            'group_value': pd.Series([key[2] for key in keys], dtype=object),
+            })
+        for i, col in enumerate(self.__target_cols):
+            table['count_{}'.format(col)] = self.__counts[:n, i]
+            table['sum_{}'.format(col)] = self.__sums[:n, i]
+        table['latest'] = self.__latest[:n].astype('datetime64[D]').astype('datetime64[ns]')
+        table['n_rows'] = self.__n_rows[:n]
+        table.attrs = {'target_cols': self.__target_cols, 'group_cols': self.__group_cols, 'as_of': self.__as_of,
+                       'version': self.VERSION}
+        table.to_pickle(filepath)
+
+    @classmethod
+    def load(cls, filepath: str = LocalPaths.EXPANDING_STATE_PATH) -> 'ExpandingAggregateState':
+        table = pd.read_pickle(filepath)
+        if table.attrs.get('version') != cls.VERSION:
+            raise ValueError('{} は以前の形式の状態です。作り直してください'.format(filepath))
+        state = cls(table.attrs['target_cols'], table.attrs['group_cols'])
+        keys = list(zip(table['horse_id'], table['group_col'], table['group_value']))
+        state.__rows = {key: i for i, key in enumerate(keys)}
+        state.__sums = table[['sum_{}'.format(col) for col in state.__target_cols]].to_numpy(dtype=float)
+        state.__counts = table[['count_{}'.format(col) for col in state.__target_cols]].to_numpy(dtype=np.int64)
+        state.__latest = table['latest'].to_numpy().astype('datetime64[D]').astype(np.int64)
+        state.__n_rows = table['n_rows'].to_numpy(dtype=np.int64)
+        is_horse = (table['group_col'] == '').to_numpy()
+        state.__horse_ids = pd.Index(table['horse_id'].to_numpy()[is_horse], dtype=object)
+        state.__horse_rows = np.flatnonzero(is_horse).astype(np.int64)
+        state.__as_of = table.attrs['as_of']
+        return state
+
+    @classmethod
+    def load_if_exists(cls, target_cols: list, group_cols: list,
+                       filepath: str = LocalPaths.EXPANDING_STATE_PATH) -> 'ExpandingAggregateState':
+        """
+        保存されている状態が、同じtarget_cols・group_cols・形式のものであれば読み込む。なければNoneを返す。
+        """
+        if not os.path.isfile(filepath):
+            return None
+        try:
+            state = cls.load(filepath)
+        except ValueError as e:
+            print(e)
+            return None
+        if state.target_cols != list(target_cols) or state.group_cols != list(group_cols):
+            return None
+        return state
+
+    def __positions(self, keys: list) -> np.ndarray:
+        """keysの行の位置。ない場合は行を追加する（配列は容量を倍々に増やす）"""
+        rows = self.__rows
+        positions = np.empty(len(keys), dtype=np.int64)
+        for i, key in enumerate(keys):
+            position = rows.get(key)
+            if position is None:
+                position = rows[key] = len(rows)
+            positions[i] = position
+        if len(rows) > len(self.__sums):
+            capacity = max(len(rows), 2 * len(self.__sums))
+            self.__sums = self.__grow(self.__sums, capacity)
+            self.__counts = self.__grow(self.__counts, capacity)
+            self.__latest = self.__grow(self.__latest, capacity, np.iinfo(np.int64).min)
+            self.__n_rows = self.__grow(self.__n_rows, capacity)
+        return positions
+
+    def __horse_positions(self, horse_ids) -> np.ndarray:
+        """馬のキーの行の位置（ベクトル化した検索）。ない場合は-1"""
+        found = self.__horse_ids.get_indexer(pd.Index(horse_ids, dtype=object).astype(str))
+        positions = np.full(len(found), -1, dtype=np.int64)
+        positions[found >= 0] = self.__horse_rows[found[found >= 0]]
+        return positions
+
+    def __means(self, keys: list) -> np.ndarray:
+        """keysごとの平均（行がない・個数が0の場合は欠損値）"""
+        positions = np.array([self.__rows.get(key, -1) if key is not None else -1 for key in keys], dtype=np.int64)
+        return self.__means_at(positions)
+
+    def __means_at(self, positions: np.ndarray) -> np.ndarray:
+        """行の位置ごとの平均（-1・個数が0の場合は欠損値）"""
+        means = np.full((len(positions), len(self.__target_cols)), np.nan)
+        found = positions >= 0
+        sums = self.__sums[positions[found]]
+        counts = self.__counts[positions[found]]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[found] = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+        return means
+
+    @staticmethod
+    def __grow(array: np.ndarray, capacity: int, fill_value=0) -> np.ndarray:
+        grown = np.full((capacity,) + array.shape[1:], fill_value, dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
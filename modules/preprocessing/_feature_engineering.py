@@ -1,186 +1,250 @@
 import os
+import time
+import numpy as np
 import pandas as pd
 
 from ._data_merger import DataMerger
-from modules.constants import LocalPaths, HorseResultsCols, Master
+from ._encoding_plan import EncodingPlan
+from ._feature_requirements import FeatureRequirements
+from ._id_dictionary import IdDictionary
+from modules.constants import LocalPaths, HorseResultsCols
 
 class FeatureEngineering:
     """
     使うテーブルを全てマージした後の処理をするクラス。
     新しい特徴量を作りたいときは、メソッド単位で追加していく。
     各メソッドは依存関係を持たないよう注意。
+
+    各メソッドはその場では実行せず、処理（ステップ）を計画に追加するだけで、featured_dataを参照した時に1回で実行する。
+        - 列を「列名 → 列」の辞書で持ち、各ステップは列の追加・置き換え・削除だけをする（テーブル全体をコピーしない）。
+          latest・birthdayなどの途中の列は、辞書から外すだけ。
+        - ダミー変数化は、全てのdumminize_*の列をまとめて、EncodingPlanで1回で作る。
+        - 最後に辞書から1回だけDataFrameを作る。列の順番・型は、各メソッドを順に実行した場合と同じ。
+    そのため、メソッドのエラー（列がないなど）はfeatured_dataの参照時に起きる。
+    各ステップの実行時間と、作った列のメモリ量はreportで確認できる。
+    require()でモデルが使う特徴量（FeatureRequirements）を渡すと、新しい列を作るステップ（add_*・dumminize_*）のうち
+    モデルが使う列を作らないものは実行しない（ステップの元の列（latestなど）は残るが、スコア計算時の列の整列で落とされる）。
     """
     def __init__(self, data_merger: DataMerger):
-        self.__data = data_merger.merged_data.copy()
-        
+        self.__data = data_merger.merged_data
+        self.__steps = []
+        self.__executed = False
+        self.__requirements = None
+        self.__report = pd.DataFrame(columns=['step', 'seconds', 'memory_mb'])
+
     @property
     def featured_data(self):
+        if self.__steps or not self.__executed:
+            self.__execute()
         return self.__data
-    
+
+    @property
+    def report(self) -> pd.DataFrame:
+        """
+        最後に実行した計画の、ステップごとの実行時間（秒）と作った列のメモリ量（MB）。
+        dumminizeはダミー変数をまとめて作るステップ、buildはDataFrameを作るステップ（メモリ量はテーブル全体）。
+        """
+        return self.__report
+
+    def require(self, requirements: FeatureRequirements):
+        """
+        モデルが使う特徴量（FeatureRequirements）を作るステップだけを実行するようにする（当日の予測用）。
+        元の列を置き換えるステップ（encode_*_id、native=Trueのencode_categoricals）は常に実行する。
+        """
+        self.__requirements = requirements
+        return self
+
+    def __add_step(self, name: str, step, outputs: list):
+        """
+        ステップを計画に追加する。outputsはステップが作る列
+        """
+        self.__steps.append((name, step, outputs))
+        return self
+
+    def __execute(self):
+        """
+        計画を実行する
+        """
+        columns = {col: self.__data[col] for col in self.__data.columns}
+        # ダミー変数化する列（元の列）。列の位置には、ダミー変数の列名を仮に入れておく
+        dummy_sources = {}
+        records = []
+        for name, step, outputs in self.__steps:
+            # 新しい列を作るステップのうち、モデルが使う列を作らないものは飛ばす
+            # （元の列を置き換えるステップ（IDのエンコードなど）は、元の列がスコア計算に渡らないよう常に実行する）
+            if self.__requirements is not None and not self.__requirements.requires_any(outputs) \
+                    and not any(col in columns for col in outputs):
+                continue
+            start = time.perf_counter()
+            produced = step(columns, dummy_sources)
+            records.append((name, time.perf_counter() - start, self.__nbytes(columns, produced)))
+
+        if dummy_sources:
+            start = time.perf_counter()
+            dummies = EncodingPlan(columns=list(dummy_sources)).dummies(
+                pd.DataFrame(dummy_sources, index=self.__data.index))
+            columns.update({col: dummies[col] for col in dummies.columns})
+            records.append(('dumminize', time.perf_counter() - start, self.__nbytes(columns, dummies.columns)))
+
+        start = time.perf_counter()
+        data = pd.DataFrame(
+            {col: value.array if isinstance(value, pd.Series) else value for col, value in columns.items()},
+            index=self.__data.index)
+        records.append(('build', time.perf_counter() - start, data.memory_usage(index=False).sum() / 1024 ** 2))
+
+        self.__data = data
+        self.__steps = []
+        self.__executed = True
+        self.__report = pd.DataFrame(records, columns=['step', 'seconds', 'memory_mb'])
+
+    @staticmethod
+    def __nbytes(columns: dict, produced) -> float:
+        """作った列のメモリ量（MB）"""
+        return sum(getattr(columns[col], 'nbytes', 0) for col in produced) / 1024 ** 2
+
     def add_interval(self):
         """
         前走からの経過日数
         """
-        self.__data['interval'] = (self.__data['date'] - self.__data['latest']).dt.days
-        self.__data.drop('latest', axis=1, inplace=True)
-        return self
+        def step(columns, dummy_sources):
+            columns['interval'] = (columns['date'] - columns.pop('latest')).dt.days
+            return ['interval']
+        return self.__add_step('add_interval', step, ['interval'])
 
     def add_agedays(self):
         """
         レース出走日から日齢を算出
         """
-        # 日齢を算出
-        self.__data['age_days'] = (self.__data['date'] - self.__data['birthday']).dt.days
-        self.__data.drop('birthday', axis=1, inplace=True)
-        return self
-    
+        def step(columns, dummy_sources):
+            # 日齢を算出
+            columns['age_days'] = (columns['date'] - columns.pop('birthday')).dt.days
+            return ['age_days']
+        return self.__add_step('add_agedays', step, ['age_days'])
+
+    def __dumminize(self, col: str):
+        """
+        colをダミー変数化するステップを追加する（ダミー変数は、計画の実行時に他の列とまとめて作る）
+        """
+        def step(columns, dummy_sources):
+            FeatureEngineering.__reserve_dummies(columns, dummy_sources, col)
+            return []
+        return self.__add_step('dumminize_' + col, step, EncodingPlan.dummy_names(col))
+
+    @staticmethod
+    def __reserve_dummies(columns: dict, dummy_sources: dict, col: str):
+        """colをdummy_sourcesに移し、colの位置にダミー変数の列名を仮に入れる"""
+        dummy_sources[col] = columns.pop(col)
+        columns.update(dict.fromkeys(EncodingPlan.dummy_names(col)))
+
     def dumminize_weather(self):
         """
         weatherカラムをダミー変数化する
         """
-        self.__data['weather'] = pd.Categorical(self.__data['weather'], Master.WEATHER_LIST)
-        self.__data = pd.get_dummies(self.__data, columns=['weather'])
-        return self
-    
+        return self.__dumminize('weather')
+
     def dumminize_race_type(self):
         """
         race_typeカラムをダミー変数化する
         """
-        self.__data['race_type'] = pd.Categorical(
-            self.__data['race_type'], list(Master.RACE_TYPE_DICT.values())
-            )
-        self.__data = pd.get_dummies(self.__data, columns=['race_type'])
-        return self
-    
+        return self.__dumminize('race_type')
+
     def dumminize_ground_state(self):
         """
         ground_stateカラムをダミー変数化する
         """
-        self.__data['ground_state'] = pd.Categorical(
-            self.__data['ground_state'], Master.GROUND_STATE_LIST
-            )
-        self.__data = pd.get_dummies(self.__data, columns=['ground_state'])
-        return self
-    
+        return self.__dumminize('ground_state')
+
     def dumminize_sex(self):
         """
         sexカラムをダミー変数化する
         """
-        self.__data['性'] = pd.Categorical(self.__data['性'], Master.SEX_LIST)
-        self.__data = pd.get_dummies(self.__data, columns=['性'])
-        return self
-    
+        return self.__dumminize('性')
+
     def __label_encode(self, target_col: str):
         """
         引数で指定されたID（horse_id/jockey_id/trainer_id/owner_id/breeder_id）を
         ラベルエンコーディングして、Categorical型に変換する。
+        コードは data/master/{target_col}.csv のIDの辞書（IdDictionary）で振り、
+        辞書にないIDは末尾に追記する。辞書はプロセス内で共有するため、CSVを読むのは最初の1回だけ。
         """
-        csv_path = os.path.join(LocalPaths.MASTER_DIR, target_col + '.csv')
-        # ファイルが存在しない場合、空のDataFrameを作成
-        if not os.path.isfile(csv_path):
-            target_master = pd.DataFrame(columns=[target_col, 'encoded_id'])
-        else:
-            target_master = pd.read_csv(csv_path, dtype=object)
-
-        # マスタ整形: NaN/重複を除去し、型を保証
-        if len(target_master) > 0:
-            target_master = target_master.dropna(subset=[target_col])
-            target_master = target_master.drop_duplicates(subset=[target_col], keep='first')
-            target_master['encoded_id'] = pd.to_numeric(target_master['encoded_id'], errors='coerce')
-            target_master = target_master.dropna(subset=['encoded_id'])
-            target_master['encoded_id'] = target_master['encoded_id'].astype(int)
-        else:
-            target_master = pd.DataFrame(columns=[target_col, 'encoded_id'])
-
-        # 現在データ側の抽出（NaN除去）
-        curr_vals = self.__data[[target_col]].dropna(subset=[target_col]).copy()
-
-        # masterに存在しない、新しい情報を抽出
-        if len(target_master) > 0:
-            known = set(target_master[target_col].astype(str).tolist())
-            new_target = curr_vals[~curr_vals[target_col].astype(str).isin(known)]
-        else:
-            new_target = curr_vals
-        new_target = new_target.drop_duplicates(subset=[target_col], keep='first')
-
-        # 新しい情報に連番を付与
-        if len(target_master) > 0:
-            start = int(target_master['encoded_id'].max()) + 1
-            new_target = new_target.assign(encoded_id=range(start, start + len(new_target)))
-        else:  # まだ1行も登録されていない場合
-            new_target = new_target.assign(encoded_id=range(len(new_target)))
-
-        # マスタ更新（インデックスが一意になるよう整理）
-        updated_master = pd.concat([target_master, new_target], ignore_index=True)
-        updated_master = updated_master.dropna(subset=[target_col])
-        updated_master = updated_master.drop_duplicates(subset=[target_col], keep='first')
-        updated_master[[target_col, 'encoded_id']].to_csv(csv_path, index=False)
-
-        # マッピングSeries（インデックス一意）
-        mapping = updated_master.set_index(target_col)['encoded_id']
-        mapping = mapping[~mapping.index.duplicated(keep='first')]
-
-        # ラベルエンコーディング実行
-        self.__data[target_col] = pd.Categorical(self.__data[target_col].map(mapping))
-        return self
-    
+        def step(columns, dummy_sources):
+            csv_path = os.path.join(LocalPaths.MASTER_DIR, target_col + '.csv')
+            codes = IdDictionary.open(csv_path, target_col).encode(np.asarray(columns[target_col], dtype=object))
+
+            # ラベルエンコーディング実行（カテゴリはデータに含まれるコード（int64）。欠損値はコード-1）
+            categories = np.unique(codes[codes >= 0]).astype(np.int64)
+            columns[target_col] = pd.Categorical.from_codes(
+                np.where(codes >= 0, np.searchsorted(categories, codes), -1), categories)
+            return [target_col]
+        return self.__add_step('encode_' + target_col, step, [target_col])
+
     def encode_horse_id(self):
         """
         horse_idをラベルエンコーディングして、Categorical型に変換する。
         """
-        self.__label_encode('horse_id')
-        return self
-    
+        return self.__label_encode('horse_id')
+
     def encode_jockey_id(self):
         """
         jockey_idをラベルエンコーディングして、Categorical型に変換する。
         """
-        self.__label_encode('jockey_id')
-        return self
-    
+        return self.__label_encode('jockey_id')
+
     def encode_trainer_id(self):
         """
         trainer_idをラベルエンコーディングして、Categorical型に変換する。
         """
-        self.__label_encode('trainer_id')
-        return self
+        return self.__label_encode('trainer_id')
 
     def encode_owner_id(self):
         """
         owner_idをラベルエンコーディングして、Categorical型に変換する。
         """
-        self.__label_encode('owner_id')
-        return self
+        return self.__label_encode('owner_id')
 
     def encode_breeder_id(self):
         """
         breeder_idをラベルエンコーディングして、Categorical型に変換する。
         """
-        self.__label_encode('breeder_id')
-        return self
+        return self.__label_encode('breeder_id')
 
     def dumminize_kaisai(self):
         """
         開催カラムをダミー変数化する
         """
-        self.__data[HorseResultsCols.PLACE] = pd.Categorical(
-            self.__data[HorseResultsCols.PLACE], list(Master.PLACE_DICT.values())
-            )
-        self.__data = pd.get_dummies(self.__data, columns=[HorseResultsCols.PLACE])
-        return self
+        return self.__dumminize(HorseResultsCols.PLACE)
 
     def dumminize_around(self):
         """
         aroundカラムをダミー変数化する
         """
-        self.__data['around'] = pd.Categorical(self.__data['around'], Master.AROUND_LIST)
-        self.__data = pd.get_dummies(self.__data, columns=['around'])
-        return self
+        return self.__dumminize('around')
 
     def dumminize_race_class(self):
         """
         race_classカラムをダミー変数化する
         """
-        self.__data['race_class'] = pd.Categorical(self.__data['race_class'], Master.RACE_CLASS_LIST)
-        self.__data = pd.get_dummies(self.__data, columns=['race_class'])
-        return self
\ No newline at end of file
+        return self.__dumminize('race_class')
+
+    def encode_categoricals(self, native: bool = False, columns: list = None):
+        """
+        カテゴリ変数（EncodingPlan.CATEGORICALS）をまとめて変換する。
+        native=Falseの場合はdumminize_*を全て呼んだ場合と同じダミー変数を1回の結合で追加し、
+        native=Trueの場合はMasterの語彙のCategorical型にする（LightGBMのカテゴリ変数として学習する）。
+        """
+        targets = [col for col, _ in EncodingPlan.CATEGORICALS if columns is None or col in columns]
+        if not native:
+            def step(columns, dummy_sources):
+                for col in targets:
+                    if col in columns:
+                        FeatureEngineering.__reserve_dummies(columns, dummy_sources, col)
+                return []
+            return self.__add_step('encode_categoricals', step,
+                                   [name for col in targets for name in EncodingPlan.dummy_names(col)])
+
+        def step(columns, dummy_sources):
+            encoded = EncodingPlan(native=True, columns=targets).apply(
+                pd.DataFrame({col: np.asarray(columns[col], dtype=object) for col in targets if col in columns}))
+            columns.update({col: encoded[col].array for col in encoded.columns})
+            return list(encoded.columns)
+        return self.__add_step('encode_categoricals', step, targets)
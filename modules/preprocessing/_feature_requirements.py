@@ -0,0 +1,44 @@
+import numpy as np
+
+
+class FeatureRequirements:
+    """
+    モデルが使う特徴量（列名）の集合。当日の予測で、DataMergerとFeatureEngineeringに渡すと、
+    モデルが使わない特徴量を作る処理（過去成績の集計の列・直接対決・特徴量テーブルの列・FeatureEngineeringのステップ）を省く。
+
+    importancesを渡した場合は、重要度がmin_importanceより大きい特徴量だけを使うものとする。
+    min_importance=0（デフォルト）では、分岐に1度も使われていない特徴量だけを省くため、予測値は変わらない
+    （省いた列は、スコア計算時の列の整列で0埋めされる）。
+    """
+    def __init__(self, features: list, importances=None, min_importance: float = 0):
+        """
+        初期処理
+
+        importancesは、featuresと同じ順の重要度（LightGBMのfeature_importances_）。
+        """
+        features = list(features)
+        if importances is not None:
+            importances = np.asarray(importances, dtype=float)
+            if len(importances) != len(features):
+                raise ValueError('特徴量の数（{}）と重要度の数（{}）が一致しません'.format(
+                    len(features), len(importances)))
+            features = [col for col, importance in zip(features, importances) if importance > min_importance]
+        self.__features = frozenset(features)
+
+    @property
+    def features(self) -> frozenset:
+        return self.__features
+
+    def __contains__(self, col) -> bool:
+        return col in self.__features
+
+    def __len__(self):
+        return len(self.__features)
+
+    def select(self, columns) -> list:
+        """columnsのうち、モデルが使うもの（順番はそのまま）"""
+        return [col for col in columns if col in self.__features]
+
+    def requires_any(self, columns) -> bool:
+        """columnsのどれかを、モデルが使うかどうか"""
+        return any(col in self.__features for col in columns)
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import hashlib
+import inspect
+import numpy as np
+import pandas as pd
+
+from modules.constants import LocalPaths
+from ._as_of_join import read_stats_table
+from ._horse_history_index import HorseHistoryIndex
+
+
+class FeatureStore:
+    """
+    学習用の特徴量テーブル（FeatureEngineering.featured_data）を、レース日ごとのパーティションに分けて保持するクラス。
+
+    特徴量は全てレース日より前の情報（as-of）から作るため、ある日付の特徴量は、その日付の入力が変わらない限り変わらない。
+    update()では、日付ごとの入力のフィンガープリント（input_fingerprints()）をマニフェストに記録しておき、
+        - まだパーティションがない日付
+        - 入力のフィンガープリントが変わった日付
+    の特徴量だけをbuildで作って保存し、全ての日付のパーティションを並べて学習用のテーブルを返す。
+    特徴量を作るコード（DataMerger・FeatureEngineeringなど）・パラメータ・buildが変わった場合は、全ての日付を作り直す。
+
+    使い方:
+        def build(dates):
+            data_merger = DataMerger(...).select_dates(dates)
+            data_merger.merge()
+            return FeatureEngineering(data_merger).add_interval()....featured_data
+
+        feature_store = FeatureStore()
+        fingerprints = FeatureStore.input_fingerprints(
+            results_processor, race_info_processor, horse_results_processor, horse_info_processor, peds_processor)
+        featured_data = feature_store.update(fingerprints, build, params={'target_cols': TARGET_COLS, ...})
+    """
+    MANIFEST_FILENAME = '_manifest.json'
+    # 特徴量を作るコードのモジュール（ソースが変わったら全ての日付を作り直す）
+    PIPELINE_MODULES = (
+        '_data_merger', '_shutuba_data_merger', '_feature_engineering', '_as_of_window_aggregator',
+        '_horse_history_index', '_expanding_aggregate_state', '_as_of_join', '_head_to_head_index',
+        '_standard_time_table', '_encoding_plan', '_id_dictionary', '_feature_requirements',
+        '_entity_form_state', '_pedigree_form_state',
+        )
+    # 内容が変わったら全ての日付を作り直すファイル（全ての日付の特徴量に効く表）
+    PIPELINE_FILES = (LocalPaths.STANDARD_TIME_PATH,)
+    # 日付ごとのフィンガープリントに含める特徴量テーブル（(date, horse_id) インデックス）
+    STATS_PATHS = (LocalPaths.JOCKEY_STATS_PATH, LocalPaths.ENTITY_FORM_PATH, LocalPaths.PEDIGREE_FORM_PATH)
+
+    def __init__(self, store_dir: str = LocalPaths.FEATURE_STORE_DIR):
+        """
+        初期処理
+        """
+        self.__store_dir = store_dir
+        self.__manifest = self.__read_manifest()
+
+    @property
+    def store_dir(self):
+        return self.__store_dir
+
+    @property
+    def partitions(self) -> pd.DataFrame:
+        """
+        パーティション一覧（日付、ファイル名、入力のフィンガープリント、行数）
+        """
+        rows = [dict(date=pd.Timestamp(date), **partition)
+                for date, partition in self.__manifest['partitions'].items()]
+        return pd.DataFrame(rows, columns=['date', 'file', 'fingerprint', 'n_rows'])
+
+    def stale_dates(self, fingerprints: pd.Series) -> list:
+        """
+        特徴量を作る（作り直す）必要がある日付のリスト
+        """
+        partitions = self.__manifest['partitions']
+        return sorted(date for date, fingerprint in fingerprints.items()
+                      if partitions.get(self.__date_key(date), {}).get('fingerprint') != fingerprint)
+
+    def update(self, fingerprints: pd.Series, build, params: dict = None, rebuild: bool = False) -> pd.DataFrame:
+        """
+        fingerprints（input_fingerprints()の戻り値）のうち、特徴量を作る必要がある日付だけbuild(dates)で作って保存し、
+        fingerprintsの全ての日付の特徴量を日付順に並べて返す。fingerprintsにない日付のパーティションは削除する。
+        buildは、日付のリストを受け取り、その日付のレースの特徴量（date列を持つ）を返す関数。
+        paramsには、特徴量を作る時のパラメータ（target_colsなど）を渡す。rebuild=Trueの場合は全ての日付を作り直す。
+        """
+        pipeline_key = self.pipeline_key(build, params)
+        if rebuild or pipeline_key != self.__manifest['pipeline']:
+            # 作り方が変わった場合、古いパーティションは使えない
+            for date_key in list(self.__manifest['partitions']):
+                self.__remove_partition(date_key)
+            self.__manifest['pipeline'] = pipeline_key
+        keep = {self.__date_key(date) for date in fingerprints.index}
+        for date_key in [date_key for date_key in self.__manifest['partitions'] if date_key not in keep]:
+            self.__remove_partition(date_key)
+
+        stale = self.stale_dates(fingerprints)
+        print('FeatureStore: {}日分を作成、{}日分を再利用'.format(len(stale), len(fingerprints) - len(stale)))
+        if stale:
+            featured = build(stale)
+            os.makedirs(self.__store_dir, exist_ok=True)
+            for date, df in featured.groupby('date', sort=True):
+                date_key = self.__date_key(date)
+                filename = 'date={}.pickle'.format(date_key)
+                df.to_pickle(os.path.join(self.__store_dir, filename))
+                self.__manifest['partitions'][date_key] = {
+                    'file': filename, 'fingerprint': fingerprints[date], 'n_rows': int(len(df))}
+            # 特徴量の行がなかった日付も、作成済みとして記録する
+            for date in stale:
+                self.__manifest['partitions'].setdefault(self.__date_key(date), {
+                    'file': None, 'fingerprint': fingerprints[date], 'n_rows': 0})
+        self.__write_manifest()
+        return self.load()
+
+    def load(self, date_from=None, date_to=None) -> pd.DataFrame:
+        """
+        期間（date_from <= date < date_to）のパーティションを日付順に並べて返す。引数を省略した場合は全て。
+        ラベルエンコーディングした列など、パーティションごとにカテゴリが違うカテゴリ列は、カテゴリを揃えてから並べる。
+        """
+        frames = []
+        for date, partition in sorted(self.__manifest['partitions'].items()):
+            if partition['file'] is None:
+                continue
+            if date_from is not None and pd.Timestamp(date) < pd.Timestamp(date_from):
+                continue
+            if date_to is not None and pd.Timestamp(date) >= pd.Timestamp(date_to):
+                continue
+            frames.append(pd.read_pickle(os.path.join(self.__store_dir, partition['file'])))
+        if not frames:
+            return pd.DataFrame()
+        for col in frames[0].columns:
+            dtypes = [df[col].dtype for df in frames if col in df.columns]
+            if isinstance(dtypes[0], pd.CategoricalDtype) and any(dtype != dtypes[0] for dtype in dtypes):
+                categories = np.unique(np.concatenate([dtype.categories.to_numpy() for dtype in dtypes]))
+                dtype = pd.CategoricalDtype(categories, ordered=dtypes[0].ordered)
+                for df in frames:
+                    df[col] = df[col].astype(dtype)
+        return pd.concat(frames, ignore_index=True)
+
+    def pipeline_key(self, build=None, params: dict = None) -> str:
+        """
+        特徴量を作るコード（PIPELINE_MODULESとbuildのソース）、PIPELINE_FILESの内容とparamsのハッシュ
+        """
+        h = hashlib.blake2b(digest_size=16)
+        for name in self.PIPELINE_MODULES:
+            module = sys.modules.get('{}.{}'.format(__package__, name))
+            if module is not None:
+                h.update(inspect.getsource(module).encode())
+        for path in self.PIPELINE_FILES:
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    h.update(hashlib.blake2b(f.read(), digest_size=16).digest())
+        if build is not None:
+            try:
+                h.update(inspect.getsource(build).encode())
+            except (OSError, TypeError):
+                # ソースを取得できない場合は、関数名だけを使う（作り方を変えた場合はrebuild=Trueで作り直す）
+                h.update(getattr(build, '__qualname__', repr(build)).encode())
+        h.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def input_fingerprints(results_processor, race_info_processor, horse_results_processor,
+                           horse_info_processor, peds_processor, stats_paths: tuple = None) -> pd.Series:
+        """
+        レース日ごとの、特徴量の入力のフィンガープリント（インデックスが日付、値がハッシュ値の文字列）。
+        各出走について、
+            - レース結果・レース情報の行
+            - その馬の、レース日より前の過去成績の行（HorseHistoryIndexの範囲の、行のハッシュ値の差分）
+            - 馬の基本情報・血統の行
+            - 特徴量テーブル（stats_paths。省略した場合はSTATS_PATHS）の (date, horse_id) の行
+        のハッシュ値をまとめ、日付ごとに足し合わせる。レース日より後の過去成績が増えても、その日付の値は変わらない。
+        """
+        race_info = race_info_processor.preprocessed_data
+        results = results_processor.preprocessed_data
+        results = results.merge(race_info, left_index=True, right_index=True, how='left')
+        results = results[results['date'].notna()]
+        horse_ids = results['horse_id'].astype(str)
+        components = {'results': FeatureStore.__row_hashes(results)}
+
+        horse_results = horse_results_processor.fetch(horse_id_list=horse_ids.unique(),
+                                                      date_to=results['date'].max())
+        horse_results = horse_results.assign(_hash=FeatureStore.__row_hashes(horse_results))
+        index = HorseHistoryIndex(horse_results, ['_hash'])
+        # uint64の累積和（桁あふれは2**64を法とした和として扱う）の差分が、範囲の行のハッシュ値の和
+        cumulative = np.r_[np.uint64(0), np.cumsum(index.column('_hash').astype(np.uint64))]
+        start, end = index.bounds(horse_ids, results['date'])
+        components['horse_results'] = cumulative[end] - cumulative[start]
+
+        for name, processor in (('horse_info', horse_info_processor), ('peds', peds_processor)):
+            table = processor.preprocessed_data
+            hashes = pd.Series(FeatureStore.__row_hashes(table), index=table.index.astype(str))
+            hashes = hashes[~hashes.index.duplicated(keep='last')]
+            components[name] = hashes.reindex(horse_ids.to_numpy()).fillna(0).to_numpy(dtype=np.uint64)
+
+        keys = pd.MultiIndex.from_arrays([results['date'], horse_ids])
+        for path in FeatureStore.STATS_PATHS if stats_paths is None else stats_paths:
+            if not os.path.isfile(path):
+                continue
+            stats = read_stats_table(path)
+            hashes = pd.Series(FeatureStore.__row_hashes(stats),
+                               index=pd.MultiIndex.from_arrays([stats['date'], stats['horse_id'].astype(str)]))
+            hashes = hashes[~hashes.index.duplicated(keep='last')]
+            components[os.path.basename(path)] = hashes.reindex(keys).fillna(0).to_numpy(dtype=np.uint64)
+
+        # 出走ごとに各成分をまとめたハッシュ値を、日付ごとに足し合わせる
+        row_hashes = pd.util.hash_pandas_object(pd.DataFrame(components), index=False).to_numpy()
+        dates, codes = np.unique(results['date'].to_numpy(), return_inverse=True)
+        sums = np.zeros(len(dates), dtype=np.uint64)
+        np.add.at(sums, codes.ravel(), row_hashes)
+        counts = np.bincount(codes.ravel(), minlength=len(dates))
+        return pd.Series(['{:016x}-{}'.format(int(s), int(c)) for s, c in zip(sums, counts)],
+                         index=pd.DatetimeIndex(dates, name='date'))
+
+    @staticmethod
+    def __row_hashes(df: pd.DataFrame) -> np.ndarray:
+        """行ごとのハッシュ値（インデックスを含む）"""
+        return pd.util.hash_pandas_object(df, index=True).to_numpy()
+
+    @staticmethod
+    def __date_key(date) -> str:
+        return pd.Timestamp(date).strftime('%Y-%m-%d')
+
+    def __remove_partition(self, date_key: str):
+        partition = self.__manifest['partitions'].pop(date_key)
+        if partition['file'] is not None:
+            path = os.path.join(self.__store_dir, partition['file'])
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def __read_manifest(self) -> dict:
+        path = os.path.join(self.__store_dir, self.MANIFEST_FILENAME)
+        if not os.path.isfile(path):
+            return {'pipeline': None, 'partitions': {}}
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def __write_manifest(self):
+        os.makedirs(self.__store_dir, exist_ok=True)
+        path = os.path.join(self.__store_dir, self.MANIFEST_FILENAME)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.__manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
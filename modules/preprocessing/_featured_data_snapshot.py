@@ -0,0 +1,220 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from pandas.api.types import (
+    is_datetime64_dtype,
+    is_numeric_dtype,
+    is_timedelta64_dtype,
+)
+
+
+class FeaturedDataSnapshot:
+    """
+    特徴量テーブル（FeatureEngineering.featured_data）を、メモリマップで読み込める形式で保存・読み込みするクラス。
+
+    保存先ディレクトリの構成:
+        - block_<dtype>.npy: 同じdtypeの列をまとめた2次元配列（列数 × 行数）。1列が連続領域になる。
+        - meta.json: 列の順番、各列のブロック・位置、カテゴリ、インデックスなどのメタデータ。
+
+    読み込み時はnp.load(mmap_mode=...)で各ブロックを開き、列ごとのビューからDataFrameを組み立てるため、
+    数値列・bool列・日時列・カテゴリ列（コード部分）はコピーされない。
+    ページはOSのページキャッシュ上にあるため、同じスナップショットを読む複数プロセス
+    （チューニングのワーカーやシミュレーション）の間で共有される。
+    文字列などのobject列とインデックスは、カテゴリ＋コードで保存し、読み込み時に復元する（この部分はコピーになる）。
+    前処理済みデータのキャッシュ（PreprocessingCache）の保存形式としても使う。
+    """
+    META_FILENAME = 'meta.json'
+    VERSION = 2
+
+    @staticmethod
+    def save(df: pd.DataFrame, dirpath: str) -> None:
+        """
+        dfをdirpathにスナップショットとして保存する。
+        """
+        os.makedirs(dirpath, exist_ok=True)
+        columns_meta = []
+        # ブロック名 -> 列の配列のリスト
+        blocks = {}
+
+        def add_to_block(block_name, values):
+            blocks.setdefault(block_name, []).append(values)
+            return len(blocks[block_name]) - 1
+
+        for name, s in df.items():
+            meta = {'name': name}
+            if isinstance(s.dtype, pd.CategoricalDtype):
+                codes = s.cat.codes.to_numpy()
+                meta.update(kind='category', categories=FeaturedDataSnapshot.__to_json_list(s.cat.categories),
+                            categories_dtype=str(s.cat.categories.dtype),
+                            ordered=bool(s.cat.ordered), block='codes_' + codes.dtype.name)
+                meta['pos'] = add_to_block(meta['block'], codes)
+            elif s.dtype == bool:
+                meta.update(kind='bool', block='bool')
+                meta['pos'] = add_to_block('bool', s.to_numpy())
+            elif is_datetime64_dtype(s.dtype):
+                values = s.to_numpy().astype('datetime64[ns]')
+                meta.update(kind='datetime', block='datetime64[ns]')
+                meta['pos'] = add_to_block('datetime64[ns]', values.view('int64'))
+            elif is_timedelta64_dtype(s.dtype):
+                values = s.to_numpy().astype('timedelta64[ns]')
+                meta.update(kind='timedelta', block='timedelta64[ns]')
+                meta['pos'] = add_to_block('timedelta64[ns]', values.view('int64'))
+            elif is_numeric_dtype(s.dtype) and isinstance(s.dtype, np.dtype):
+                meta.update(kind='numeric', block=s.dtype.name)
+                meta['pos'] = add_to_block(s.dtype.name, s.to_numpy())
+            elif s.dtype == object:
+                # 文字列などは、カテゴリ＋コードにして保存する
+                codes, uniques = pd.factorize(s, use_na_sentinel=True)
+                codes = codes.astype(FeaturedDataSnapshot.__codes_dtype(len(uniques)))
+                meta.update(kind='object', categories=FeaturedDataSnapshot.__to_json_list(uniques),
+                            block='codes_' + codes.dtype.name)
+                meta['pos'] = add_to_block(meta['block'], codes)
+            else:
+                raise TypeError('FeaturedDataSnapshot: 保存できない型の列です: {} ({})'.format(name, s.dtype))
+            columns_meta.append(meta)
+
+        # インデックス（MultiIndexの場合はレベルごとに保存する）
+        index_meta = FeaturedDataSnapshot.__save_index(df.index, dirpath)
+
+        # ブロックの書き出し（列数 × 行数の2次元配列。1列が連続領域になる）
+        for block_name, arrays in blocks.items():
+            path = os.path.join(dirpath, 'block_{}.npy'.format(block_name))
+            out = np.lib.format.open_memmap(path, mode='w+', dtype=arrays[0].dtype, shape=(len(arrays), len(df)))
+            for i, values in enumerate(arrays):
+                out[i] = values
+            out.flush()
+            del out
+
+        meta = {
+            'version': FeaturedDataSnapshot.VERSION,
+            'n_rows': int(len(df)),
+            'columns': columns_meta,
+            'index': index_meta,
+            }
+        tmp_path = os.path.join(dirpath, FeaturedDataSnapshot.META_FILENAME + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(dirpath, FeaturedDataSnapshot.META_FILENAME))
+
+    @staticmethod
+    def load(dirpath: str, mmap_mode: str = 'r') -> pd.DataFrame:
+        """
+        スナップショットを読み込む。
+        mmap_mode='r'の場合は読み取り専用のメモリマップ（複数プロセスで共有可）、
+        'c'の場合はコピーオンライト（書き込んだページだけがプロセス固有になる）、
+        Noneの場合は通常のメモリに読み込む。
+        """
+        with open(os.path.join(dirpath, FeaturedDataSnapshot.META_FILENAME), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != FeaturedDataSnapshot.VERSION:
+            raise ValueError('スナップショットの形式が古いため読み込めません。保存し直してください: {}'.format(dirpath))
+
+        blocks = {}
+        def block(block_name):
+            if block_name not in blocks:
+                # np.memmapのサブクラスのままだとpandas側で扱いが変わるため、ndarrayのビューにする
+                blocks[block_name] = np.load(
+                    os.path.join(dirpath, 'block_{}.npy'.format(block_name)), mmap_mode=mmap_mode
+                    ).view(np.ndarray)
+            return blocks[block_name]
+
+        data = {}
+        for col in meta['columns']:
+            values = block(col['block'])[col['pos']]
+            kind = col['kind']
+            if kind == 'category':
+                categories = pd.Index(col['categories'])
+                if col.get('categories_dtype', 'object') != 'object':
+                    categories = categories.astype(col['categories_dtype'])
+                dtype = pd.CategoricalDtype(categories, ordered=col['ordered'])
+                data[col['name']] = pd.Categorical.from_codes(values, dtype=dtype)
+            elif kind == 'datetime':
+                data[col['name']] = values.view('datetime64[ns]')
+            elif kind == 'timedelta':
+                data[col['name']] = values.view('timedelta64[ns]')
+            elif kind == 'object':
+                uniques = np.array(col['categories'] + [np.nan], dtype=object)
+                # コード-1（欠損）は末尾のNaNを指す
+                data[col['name']] = uniques[values]
+            else:
+                data[col['name']] = values
+
+        index = FeaturedDataSnapshot.__load_index(meta['index'], dirpath, mmap_mode)
+
+        columns = [col['name'] for col in meta['columns']]
+        return pd.DataFrame(data, index=index, columns=columns, copy=False)
+
+    @staticmethod
+    def __save_index(index: pd.Index, dirpath: str) -> dict:
+        """
+        インデックスを保存し、メタデータを返す
+        """
+        if isinstance(index, pd.MultiIndex):
+            levels = []
+            for i in range(index.nlevels):
+                level_meta = FeaturedDataSnapshot.__save_index_values(
+                    index.get_level_values(i), os.path.join(dirpath, 'index_{}.npy'.format(i)))
+                level_meta['file'] = 'index_{}.npy'.format(i)
+                levels.append(level_meta)
+            return {'kind': 'multi', 'levels': levels}
+        if isinstance(index, pd.RangeIndex):
+            return {'kind': 'range', 'name': index.name, 'start': index.start, 'stop': index.stop, 'step': index.step}
+        index_meta = FeaturedDataSnapshot.__save_index_values(index, os.path.join(dirpath, 'index.npy'))
+        index_meta['file'] = 'index.npy'
+        return index_meta
+
+    @staticmethod
+    def __save_index_values(index: pd.Index, path: str) -> dict:
+        """
+        1レベル分のインデックスの値を保存する
+        """
+        index_meta = {'name': index.name}
+        if is_datetime64_dtype(index.dtype):
+            index_meta['kind'] = 'datetime'
+            np.save(path, index.to_numpy().astype('datetime64[ns]').view('int64'))
+        elif is_numeric_dtype(index.dtype) and isinstance(index.dtype, np.dtype):
+            index_meta['kind'] = 'numeric'
+            np.save(path, index.to_numpy())
+        else:
+            codes, uniques = pd.factorize(index, use_na_sentinel=True)
+            index_meta.update(kind='object', values=FeaturedDataSnapshot.__to_json_list(uniques))
+            np.save(path, codes.astype(FeaturedDataSnapshot.__codes_dtype(len(uniques))))
+        return index_meta
+
+    @staticmethod
+    def __load_index(index_meta: dict, dirpath: str, mmap_mode) -> pd.Index:
+        """
+        保存したインデックスを復元する
+        """
+        if index_meta['kind'] == 'multi':
+            levels = [FeaturedDataSnapshot.__load_index(level_meta, dirpath, mmap_mode)
+                      for level_meta in index_meta['levels']]
+            return pd.MultiIndex.from_arrays(levels)
+        if index_meta['kind'] == 'range':
+            return pd.RangeIndex(index_meta['start'], index_meta['stop'], index_meta['step'],
+                                 name=index_meta['name'])
+        values = np.load(os.path.join(dirpath, index_meta['file']), mmap_mode=mmap_mode).view(np.ndarray)
+        if index_meta['kind'] == 'datetime':
+            return pd.DatetimeIndex(values.view('datetime64[ns]'), name=index_meta['name'])
+        if index_meta['kind'] == 'numeric':
+            return pd.Index(values, name=index_meta['name'])
+        uniques = np.array(index_meta['values'] + [np.nan], dtype=object)
+        return pd.Index(uniques[values], name=index_meta['name'], dtype=object)
+
+    @staticmethod
+    def __to_json_list(values) -> list:
+        """
+        カテゴリ・ユニーク値をJSONで保存できるリストに変換する
+        """
+        values = pd.Index(values)
+        if is_datetime64_dtype(values.dtype):
+            return [v.isoformat() for v in values]
+        return [v.item() if isinstance(v, np.generic) else v for v in values.tolist()]
+
+    @staticmethod
+    def __codes_dtype(n_categories: int):
+        for dtype in ('int8', 'int16', 'int32'):
+            if n_categories < np.iinfo(dtype).max:
+                return dtype
+        return 'int64'
@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+
+from ._horse_history_index import HorseHistoryIndex
+from modules.constants import HorseResultsCols as Cols
+
+
+class HeadToHeadIndex:
+    """
+    馬の過去成績から作る、出走馬どうしの過去の直接対決の転置索引。
+        - レース → 出走馬: レース（日付, 開催, R）ごとの出走馬と着順（runners()）
+        - 馬 → レース: 馬ごと・日付順の、出走したレースと着順（HorseHistoryIndex）
+    features()では、各レースの出走馬について、同じレースの他の出走馬と過去に同じレースを走った時の成績を集計する。
+    レース日より前（同じ日付は含まない）の過去成績だけを使うため、リークしない。
+
+    計算は、出走馬ごとの過去のレースを「馬 → レース」の索引で取り出し、(今回のレース, 過去のレース) ごとに並べて、
+    同じグループの中の組（= 今回の出走馬どうしの過去の対戦）を配列の演算でまとめて作る。
+    出走馬の組を馬の過去成績全体とマージする必要がないため、学習データ全体でも出馬表1レースでも同じ処理で計算できる。
+
+    過去成績にはrace_idがないため、レースは（日付, 開催, R）で識別する。HorseResultsProcessorで開催がその他（'99'）に
+    まとめられた行（PLACE_DICTにない開催場所）と、Rが欠損している行は、別のレースが同じキーになり、
+    対戦していない馬どうしを対戦したことにしてしまうため、索引に含めない。
+    """
+    # 開催場所を識別できない過去成績の開催（HorseResultsProcessorがPLACE_DICTにない開催場所に付ける値）
+    UNKNOWN_PLACE = '99'
+    # features()で作る列
+    FEATURES = ('h2h_meetings', 'h2h_opponents', 'h2h_win_rate')
+    # 1度に展開する過去成績の行数の目安（メモリの使用量を抑えるため、これを超える場合はレース単位で分けて計算する）
+    CHUNK_ROWS = 2000000
+
+    def __init__(self, horse_results: pd.DataFrame):
+        """
+        初期処理
+
+        horse_resultsは、インデックスがhorse_idで、date・開催・R・着順の列を持つ前処理済みの過去成績。
+        """
+        horse_results = horse_results[horse_results['date'].notna() & horse_results[Cols.R].notna()
+                                      & (horse_results[Cols.PLACE].astype(str) != self.UNKNOWN_PLACE)]
+        race_keys = pd.MultiIndex.from_arrays(
+            [horse_results['date'], horse_results[Cols.PLACE].astype(str), horse_results[Cols.R]])
+        race_codes, races = pd.factorize(race_keys, sort=True)
+        self.__races = races.set_names(['date', Cols.PLACE, Cols.R])
+
+        ranks = pd.to_numeric(horse_results[Cols.RANK], errors='coerce').to_numpy(dtype=float)
+        # 馬 → レース
+        self.__history = HorseHistoryIndex(
+            pd.DataFrame({'date': horse_results['date'].to_numpy(), 'race_code': race_codes, 'rank': ranks},
+                         index=horse_results.index),
+            ['race_code', 'rank'])
+
+        # レース → 出走馬（レースのコード順、同じレースの中は着順）
+        order = np.lexsort((ranks, race_codes))
+        self.__race_offsets = np.r_[0, np.cumsum(np.bincount(race_codes, minlength=len(races)))].astype(np.int64)
+        self.__race_horse_ids = horse_results.index.astype(str).to_numpy()[order]
+        self.__race_ranks = ranks[order]
+
+    @property
+    def races(self) -> pd.MultiIndex:
+        """レース（日付, 開催, R）の一覧（コードの順）"""
+        return self.__races
+
+    @property
+    def history(self) -> HorseHistoryIndex:
+        """馬 → レースの索引（列はrace_code, rank）"""
+        return self.__history
+
+    def runners(self, date, place: str, race_no: int) -> pd.DataFrame:
+        """
+        レースの出走馬と着順（着順の順）
+        """
+        code = self.__races.get_indexer([(pd.Timestamp(date), str(place), race_no)])[0]
+        if code < 0:
+            return pd.DataFrame({'horse_id': [], 'rank': []})
+        start, end = self.__race_offsets[code], self.__race_offsets[code + 1]
+        return pd.DataFrame({'horse_id': self.__race_horse_ids[start:end], 'rank': self.__race_ranks[start:end]})
+
+    def features(self, results: pd.DataFrame) -> pd.DataFrame:
+        """
+        resultsの各行（インデックスがrace_idで、horse_id・date列を持つ）について、同じrace_idの他の出走馬との
+        レース日より前の直接対決の成績を返す。インデックスはresultsと同じ。
+            - h2h_meetings:  同じレースを走った回数（相手・レースごとに1回。両方の着順がある場合のみ）
+            - h2h_opponents: 過去に対戦したことのある、今回の出走馬の数
+            - h2h_win_rate:  対戦で相手より先着した割合（対戦がない場合は欠損値）
+        """
+        n = len(results)
+        fields = pd.factorize(results.index)[0].astype(np.int64)
+        horse_codes = self.__history.horse_codes(results['horse_id'])
+        start, end = self.__history.bounds(results['horse_id'], results['date'])
+
+        meetings = np.zeros(n, dtype=np.int64)
+        wins = np.zeros(n, dtype=np.int64)
+        opponents = np.zeros(n, dtype=np.int64)
+        # レースごとにまとめて、展開する過去成績の行数がCHUNK_ROWS程度になるように分ける
+        rows = np.argsort(fields, kind='stable')
+        n_runs = (end - start)[rows]
+        field_end = np.flatnonzero(np.r_[fields[rows][1:] != fields[rows][:-1], True]) + 1
+        cum_runs = np.r_[0, np.cumsum(n_runs)]
+        chunk_start = 0
+        while chunk_start < n:
+            limit = np.searchsorted(cum_runs, cum_runs[chunk_start] + self.CHUNK_ROWS, side='right') - 1
+            chunk_end = field_end[max(np.searchsorted(field_end, limit, side='right') - 1, 0)]
+            if chunk_end <= chunk_start:
+                chunk_end = field_end[np.searchsorted(field_end, chunk_start, side='right')]
+            chunk = rows[chunk_start:chunk_end]
+            self.__count_meetings(chunk, fields, horse_codes, start, end, meetings, wins, opponents)
+            chunk_start = chunk_end
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            win_rate = np.where(meetings > 0, wins / np.maximum(meetings, 1), np.nan)
+        return pd.DataFrame({'h2h_meetings': meetings, 'h2h_opponents': opponents, 'h2h_win_rate': win_rate},
+                            index=results.index)
+
+    def __count_meetings(self, rows: np.ndarray, fields: np.ndarray, horse_codes: np.ndarray,
+                         start: np.ndarray, end: np.ndarray, meetings: np.ndarray, wins: np.ndarray,
+                         opponents: np.ndarray) -> None:
+        """
+        rows（resultsの行の位置。レースごとにまとまっている）の過去成績を展開して、直接対決を集計する
+        """
+        counts = end[rows] - start[rows]
+        # 出走馬ごとの過去成績の行（HorseHistoryIndexの位置）
+        owner = np.repeat(rows, counts)
+        offsets = np.r_[0, np.cumsum(counts)[:-1]]
+        positions = np.repeat(start[rows] - offsets, counts) + np.arange(int(counts.sum()))
+        race_codes = self.__history.column('race_code')[positions].astype(np.int64)
+        ranks = self.__history.column('rank')[positions]
+        valid = ~np.isnan(ranks) & (ranks > 0)
+        owner, race_codes, ranks = owner[valid], race_codes[valid], ranks[valid]
+
+        # (今回のレース, 過去のレース) ごとに並べる。同じグループの行どうしが、今回の出走馬どうしの過去の対戦
+        order = np.lexsort((race_codes, fields[owner]))
+        owner, race_codes, ranks = owner[order], race_codes[order], ranks[order]
+        group_fields = fields[owner]
+        is_start = np.r_[True, (group_fields[1:] != group_fields[:-1]) | (race_codes[1:] != race_codes[:-1])]
+        group_start = np.flatnonzero(is_start)
+        group_size = np.diff(np.r_[group_start, len(owner)])
+        size = np.repeat(group_size, group_size)
+        first = np.repeat(group_start, group_size)
+        paired = size > 1
+        if not paired.any():
+            return
+
+        # グループ内の全ての組（自分自身との組を含む）を作ってから、同じ馬どうしの組を除く
+        members = np.flatnonzero(paired)
+        n_pairs = size[members]
+        pair_offsets = np.r_[0, np.cumsum(n_pairs)[:-1]]
+        self_idx = np.repeat(members, n_pairs)
+        partner_idx = np.repeat(first[members] - pair_offsets, n_pairs) + np.arange(int(n_pairs.sum()))
+        self_rows, partner_rows = owner[self_idx], owner[partner_idx]
+        distinct = horse_codes[self_rows] != horse_codes[partner_rows]
+        self_rows, partner_rows = self_rows[distinct], partner_rows[distinct]
+        won = ranks[self_idx[distinct]] < ranks[partner_idx[distinct]]
+
+        meetings += np.bincount(self_rows, minlength=len(meetings))
+        wins += np.bincount(self_rows, weights=won, minlength=len(wins)).astype(np.int64)
+        met = np.unique(self_rows * np.int64(len(meetings)) + partner_rows)
+        opponents += np.bincount(met // len(meetings), minlength=len(opponents))
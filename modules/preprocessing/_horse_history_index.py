@@ -0,0 +1,117 @@
+import bisect
+import numpy as np
+import pandas as pd
+
+
+class HorseHistoryIndex:
+    """
+    馬の過去成績を、馬ごとに日付順に並べた列ごとのnumpy配列と、馬ごとの先頭位置（offsets）で持つ索引
+    （疎行列のCSR形式と同じ持ち方）。
+    horse_ids[i] の過去成績は、各配列の [offsets[i], offsets[i + 1]) の範囲に日付順で並んでいる。
+
+    「ある馬の、ある日付より前の直近nレース」は、馬の範囲のスライスと日付の二分探索で求まる。
+    bounds()は、多数の（馬, 日付）について、その範囲をまとめて求める（学習データ作成時のマージなど）。
+    """
+    def __init__(self, horse_results: pd.DataFrame, columns: list = None):
+        """
+        初期処理
+
+        horse_resultsは、インデックスがhorse_idで、date列を持つ前処理済みの過去成績。
+        columnsは保持する列（省略した場合は全ての列）。日付が欠損している行は除く。
+        """
+        horse_results = horse_results[horse_results['date'].notna()]
+        columns = [col for col in horse_results.columns if col != 'date'] if columns is None else list(columns)
+
+        codes, uniques = pd.factorize(horse_results.index.astype(str).to_numpy(), sort=True)
+        days = horse_results['date'].to_numpy().astype('datetime64[D]').astype(np.int64)
+        # (horse_id, date) 順。同じ馬・同じ日付の行は元の順番のまま
+        order = np.lexsort((days, codes))
+        self.__horse_ids = pd.Index(uniques, name='horse_id')
+        self.__offsets = np.r_[0, np.cumsum(np.bincount(codes, minlength=len(uniques)))].astype(np.int64)
+        self.__days = days[order]
+        self.__columns = {col: horse_results[col].to_numpy()[order] for col in columns}
+        self.__key = None
+
+    @property
+    def horse_ids(self) -> pd.Index:
+        """馬のid（コードの順）"""
+        return self.__horse_ids
+
+    @property
+    def offsets(self) -> np.ndarray:
+        """馬ごとの先頭位置（長さは馬の数 + 1）"""
+        return self.__offsets
+
+    @property
+    def days(self) -> np.ndarray:
+        """各行の日付（1970-01-01からの日数）"""
+        return self.__days
+
+    @property
+    def columns(self) -> list:
+        return list(self.__columns)
+
+    def __len__(self):
+        return len(self.__days)
+
+    def column(self, name: str) -> np.ndarray:
+        """列の値（馬・日付順）"""
+        return self.__columns[name]
+
+    def row_horse_codes(self) -> np.ndarray:
+        """各行の馬のコード"""
+        return np.repeat(np.arange(len(self.__horse_ids), dtype=np.int64), np.diff(self.__offsets))
+
+    def horse_codes(self, horse_ids) -> np.ndarray:
+        """馬のidをコードにする。索引にない馬は-1"""
+        return self.__horse_ids.get_indexer(pd.Index(horse_ids).astype(str)).astype(np.int64)
+
+    def bounds(self, horse_ids, dates) -> tuple:
+        """
+        各（馬, 日付）について、その馬の先頭位置と、その日付より前の最後の行の次の位置を返す。
+        [start, end) がその日付より前の全ての過去成績で、直近nレースは [max(start, end - n), end)。
+        索引にない馬は start == end になる。
+        """
+        codes = self.horse_codes(horse_ids)
+        known = codes >= 0
+        start = np.where(known, self.__offsets[np.where(known, codes, 0)], 0)
+        if len(self.__days) == 0:
+            return start, start.copy()
+        day_offset, day_bits = self.__day_packing()
+        days = pd.to_datetime(pd.Series(dates)).to_numpy().astype('datetime64[D]').astype(np.int64) - day_offset
+        # 過去成績の範囲外の日付は、searchsortedの結果が変わらない値に丸める（最初の日付より前は範囲が空）
+        shifted = np.clip(days, 0, (1 << day_bits) - 1)
+        end = np.searchsorted(self.__packed_key(), (np.where(known, codes, 0) << day_bits) + shifted, side='left')
+        end = np.where(known & (days >= 0), end, start)
+        return start, end
+
+    def history(self, horse_id: str, date=None, n: int = None, columns: list = None) -> pd.DataFrame:
+        """
+        1頭の過去成績（dateより前の直近nレース。省略した場合は全て）を、日付順のDataFrameで返す。
+        """
+        code = self.__horse_ids.get_indexer([str(horse_id)])[0]
+        columns = self.columns if columns is None else list(columns)
+        if code < 0:
+            start = end = 0
+        else:
+            start, end = self.__offsets[code], self.__offsets[code + 1]
+            if date is not None:
+                day = int(np.datetime64(pd.Timestamp(date), 'D').astype(np.int64))
+                end = bisect.bisect_left(self.__days, day, start, end)
+            if n is not None:
+                start = max(start, end - n)
+        data = {'date': self.__days[start:end].astype('datetime64[D]').astype('datetime64[ns]')}
+        data.update({col: self.__columns[col][start:end] for col in columns})
+        return pd.DataFrame(data, index=pd.Index([str(horse_id)] * (end - start), name='horse_id'))
+
+    def __day_packing(self) -> tuple:
+        """馬のコードと日付を1つのint64にまとめる時の、日付の基準と日付部分のビット数"""
+        day_offset = int(self.__days.min())
+        return day_offset, max(int(self.__days.max() - day_offset + 1).bit_length(), 1)
+
+    def __packed_key(self) -> np.ndarray:
+        """各行の (馬のコード << 日付のビット数) + 日付。馬・日付順なので昇順に並んでいる"""
+        if self.__key is None:
+            day_offset, day_bits = self.__day_packing()
+            self.__key = (self.row_horse_codes() << day_bits) + (self.__days - day_offset)
+        return self.__key
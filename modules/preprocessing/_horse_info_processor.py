@@ -5,11 +5,11 @@ from modules.constants import HorseInfoCols as Cols
 
 
 class HorseInfoProcessor(AbstractDataProcessor):
-    def __init__(self, filepath):
+    def __init__(self, filepath, copy: bool = False, use_cache: bool = True):
         """
         初期処理
         """
-        super().__init__(filepath)
+        super().__init__(filepath, copy, use_cache)
     
     def _preprocess(self):
         """
@@ -21,7 +21,7 @@ class HorseInfoProcessor(AbstractDataProcessor):
         df['birthday'] = pd.to_datetime(df[Cols.BIRTHDAY], format="%Y年%m月%d日")
 
         # インデックス名を与える
-        df.index.name = 'horse_id'
+        df = df.rename_axis('horse_id')
 
         # カラム抽出
         df = self._select_columns(df)
@@ -32,7 +32,7 @@ class HorseInfoProcessor(AbstractDataProcessor):
         """
         カラム抽出
         """
-        df = raw.copy()[[
+        df = raw[[
             #Cols.BIRTHDAY, # 生年月日
             #Cols.TRAINER, # 調教師
             #Cols.OWNER, # 馬主
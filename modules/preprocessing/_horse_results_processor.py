@@ -1,23 +1,108 @@
 import pandas as pd
-import re
 
 from ._abstract_data_processor import AbstractDataProcessor
-from modules.constants import Master
+from ._horse_results_store import HorseResultsStore, filter_horse_results
+from ._horse_history_index import HorseHistoryIndex
+from . import _string_kernels as kernels
+from modules.constants import Master, LocalPaths
 from modules.constants import HorseResultsCols as Cols
 
 
 class HorseResultsProcessor(AbstractDataProcessor):
-    def __init__(self, filepath):
+    def __init__(self, filepath, out_of_core: bool = False, chunk_size: int = 200000,
+                 store_dir: str = LocalPaths.HORSE_RESULTS_STORE_DIR, copy: bool = False, use_cache: bool = True):
         """
         初期処理
+
+        out_of_core=Trueの場合は、前処理をchunk_size行程度のパーティションごとに行い、
+        結果をstore_dirに保存したままにする（HorseResultsStore）。
+        rawデータが前回から変わっていなければ、前処理をやり直さずにストアをそのまま使う。
+        前処理済みデータは、fetch()で必要な馬・期間だけを読み込む
+        （過去成績全体を使う集計は、iter_chunks()で馬単位のパーティションごとに読み込む）。
+        いずれの場合も、前処理はデータに初めてアクセスした時に行う。
+        （out_of_coreの場合はストア自体がキャッシュになるため、use_cacheは使わない）
+        """
+        super().__init__(filepath, copy, use_cache and not out_of_core)
+        self.__out_of_core = out_of_core
+        self.__chunk_size = chunk_size
+        self.__store = HorseResultsStore(store_dir) if out_of_core else None
+
+    @property
+    def out_of_core(self):
+        return self.__out_of_core
+
+    @property
+    def store(self):
+        if self.__out_of_core and self.__store.is_stale(self.filepath):
+            self.__store.build(self.filepath, self._preprocess_frame, self.__chunk_size)
+        return self.__store
+
+    @property
+    def raw_data(self):
+        if self.__out_of_core:
+            return pd.read_pickle(self.filepath)
+        return super().raw_data
+
+    @property
+    def preprocessed_data(self):
+        if self.__out_of_core:
+            # 全てのパーティションを結合するとテーブル全体がメモリに載るため、out_of_coreでは使わない
+            raise ValueError('out_of_core=Trueの場合は、preprocessed_dataではなくfetch()・iter_chunks()を使ってください')
+        return super().preprocessed_data
+
+    def fetch(self, horse_id_list=None, date_from=None, date_to=None, columns=None):
+        """
+        前処理済みの過去成績のうち、指定した馬・期間（date_from <= date < date_to）だけを返す。
+        out_of_coreの場合は、該当するパーティションだけをディスクから読み込む。
+        """
+        if self.__out_of_core:
+            return self.store.read(horse_id_list, date_from, date_to, columns)
+        return filter_horse_results(self.preprocessed_data, horse_id_list, date_from, date_to, columns)
+
+    def iter_chunks(self, columns=None):
+        """
+        前処理済みの過去成績を、馬単位のチャンク（各チャンクに、含まれる馬の全ての行が入っている）ごとに返すジェネレータ。
+        out_of_coreの場合はパーティションを1つずつ読み込み、そうでない場合はテーブル全体を1つのチャンクとして返す。
         """
-        super().__init__(filepath)
-    
+        if self.__out_of_core:
+            yield from self.store.iter_partitions(columns)
+        else:
+            yield filter_horse_results(self.preprocessed_data, columns=columns)
+
+    def history_index(self, horse_id_list=None, date_from=None, date_to=None, columns=None) -> HorseHistoryIndex:
+        """
+        fetch()で絞り込んだ過去成績の、馬ごと・日付順の索引（HorseHistoryIndex）を作る。
+        """
+        if columns is not None and 'date' not in columns:
+            columns = ['date'] + list(columns)
+        horse_results = self.fetch(horse_id_list, date_from, date_to, columns)
+        return HorseHistoryIndex(horse_results, [col for col in horse_results.columns if col != 'date'])
+
+    def update(self, new_raw: pd.DataFrame):
+        """
+        out_of_coreの場合に、新たに取得した過去成績（get_rawdata_horse_resultsの出力）をストアに反映する。
+        update_rawdataでpickleを更新した後に呼ぶと、ストア全体を作り直さずに済む。
+        """
+        if not self.__out_of_core:
+            raise ValueError('HorseResultsProcessor.update はout_of_core=Trueの場合のみ使用できます')
+        if not self.__store.exists():
+            # ストアが未作成の場合は、更新後のrawデータから作る
+            self.__store.build(self.filepath, self._preprocess_frame, self.__chunk_size)
+            return
+        # rawデータ（pickle）は更新済みでストアとずれているため、staleでも作り直さずに差分だけ反映する
+        self.__store.update(new_raw, self._preprocess_frame, raw_filepath=self.filepath)
+
     def _preprocess(self):
         """
         前処理
         """
-        df = self.raw_data
+        return self._preprocess_frame(self.raw_data)
+
+    def _preprocess_frame(self, raw):
+        """
+        rawデータ（全体、または馬単位のチャンク）の前処理
+        """
+        df = raw
 
         # 着順に数字以外の文字列が含まれているものは、欠損値（NaN）に置き換える
         # サイト上のテーブルに存在する列名は、HorseResultsColsクラスで定数化している。
@@ -27,56 +112,39 @@ class HorseResultsProcessor(AbstractDataProcessor):
         df[Cols.RANK] = df[Cols.RANK].astype(int)
 
         # 日付をdatetime型に設定
-        df['date'] = pd.to_datetime(df[Cols.DATE])
+        df['date'] = kernels.to_datetime_unique(df[Cols.DATE])
         
         # 賞金のNaNを0で埋める
-        df[Cols.PRIZE].fillna(0, inplace=True)
+        df[Cols.PRIZE] = df[Cols.PRIZE].fillna(0)
         
         # 1着の着差を0にする（xが0より小さい場合は、0、xが0以上の場合、xを返す）
-        df[Cols.RANK_DIFF] = df[Cols.RANK_DIFF].map(lambda x: 0 if x<0 else x)
+        df[Cols.RANK_DIFF] = kernels.clip_negative(df[Cols.RANK_DIFF])
         
         # レース展開データ
         # n=1: 最初のコーナー位置, n=4: 最終コーナー位置
-        def corner(x, n):
-            if type(x) != str:
-                return x
-            elif n==4:
-                return int(re.findall(r'\d+', x)[-1])
-            elif n==1:
-                return int(re.findall(r'\d+', x)[0])
-
-        df['first_corner'] = df[Cols.CORNER].map(lambda x: corner(x, 1))
-        df['final_corner'] = df[Cols.CORNER].map(lambda x: corner(x, 4))
+        df['first_corner'] = kernels.first_number(df[Cols.CORNER])
+        df['final_corner'] = kernels.last_number(df[Cols.CORNER])
         
         df['final_to_rank'] = df['final_corner'] - df[Cols.RANK]
         df['first_to_rank'] = df['first_corner'] - df[Cols.RANK]
         df['first_to_final'] = df['first_corner'] - df['final_corner']
         
         # 開催場所（数字以外の文字列を抽出）中央開催・地方開催・海外開催以外をその他（'99'）とする
-        df[Cols.PLACE] = df[Cols.PLACE].str.extract(r'(\D+)')[0].map(Master.PLACE_DICT).fillna('99')
+        df[Cols.PLACE] = kernels.map_unique(
+            df[Cols.PLACE], lambda u: u.str.extract(r'(\D+)')[0].map(Master.PLACE_DICT)).fillna('99')
         
         # race_type（数字以外の文字列を抽出）
-        df['race_type'] = df[Cols.RACE_TYPE_COURSE_LEN].str.extract(r'(\D+)')[0].map(Master.RACE_TYPE_DICT)
+        df['race_type'] = kernels.map_unique(
+            df[Cols.RACE_TYPE_COURSE_LEN], lambda u: u.str.extract(r'(\D+)')[0].map(Master.RACE_TYPE_DICT))
         # 距離は10の位を切り捨てる（数字の文字列を抽出）
-        df['course_len'] = df[Cols.RACE_TYPE_COURSE_LEN].str.extract(r'(\d+)').astype(float) // 100
-
-        # タイムの値を秒単位に変換
-        # 準備
-        baseformat = '%M:%S.%f'
-        basetime = pd.to_datetime("00:00.0", format=baseformat)
-        to_datetime = lambda x: pd.to_datetime(df[Cols.TIME], format=x, errors='coerce')
-        # 秒単位へのフォーマット変換処理
-        datetime_s = to_datetime(baseformat)
-        # 「x:xx.x」フォーマット以外、許容するフォーマットを定義
-        formats_additional = ['%M.%S.%f', '%M:%S:%f']
-        for format_ in formats_additional:
-            # 秒単位へのフォーマット変換処理
-            datetime_s = datetime_s.fillna(to_datetime(format_))
-        # フォーマット例外は欠損値になる
-        df['time_seconds'] = (datetime_s - basetime).dt.total_seconds()
+        df['course_len'] = kernels.map_unique(
+            df[Cols.RACE_TYPE_COURSE_LEN], lambda u: u.str.extract(r'(\d+)')[0].astype(float) // 100)
+
+        # タイムの値を秒単位に変換（「x:xx.x」以外に「x.xx.x」「x:xx:x」も許容し、フォーマット例外は欠損値になる）
+        df['time_seconds'] = kernels.race_time_to_seconds(df[Cols.TIME])
 
         # インデックス名を与える
-        df.index.name = 'horse_id'
+        df = df.rename_axis('horse_id')
 
         # カラム抽出
         df = self._select_columns(df)
@@ -87,7 +155,7 @@ class HorseResultsProcessor(AbstractDataProcessor):
         """
         カラム抽出
         """
-        df = raw.copy()[[
+        df = raw[[
             #Cols.DATE, # 日付
             Cols.PLACE, # 開催
             Cols.WEATHER, # 天気
@@ -0,0 +1,267 @@
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+from modules.constants import LocalPaths
+
+
+def iter_horse_chunks(df: pd.DataFrame, chunk_size: int):
+    """
+    horse_id（インデックス）順に、1頭分の行が分割されないようにしながら
+    おおよそchunk_size行ずつのDataFrameを返すジェネレータ。
+    全体をソートしたコピーは作らず、チャンク分だけ取り出す。
+    """
+    if len(df) == 0:
+        return
+    horse_ids = df.index.astype(str).to_numpy()
+    order = np.argsort(horse_ids, kind='stable')
+    sorted_ids = horse_ids[order]
+    # 各馬の先頭位置（この位置でのみチャンクを区切る）
+    boundaries = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    n = len(order)
+    start = 0
+    while start < n:
+        if start + chunk_size >= n:
+            stop = n
+        else:
+            # start + chunk_size 以下で最も近い馬の境界で区切る
+            i = np.searchsorted(boundaries, start + chunk_size, side='right') - 1
+            stop = boundaries[i]
+            if stop <= start:
+                # 1頭でchunk_sizeを超える場合は、その馬の終わりまでを1チャンクにする
+                stop = boundaries[i + 1] if i + 1 < len(boundaries) else n
+        yield df.iloc[order[start:stop]]
+        start = stop
+
+
+def filter_horse_results(df: pd.DataFrame, horse_id_list=None, date_from=None, date_to=None,
+                         columns=None) -> pd.DataFrame:
+    """
+    前処理済みの馬の過去成績を、馬・期間（date_from <= date < date_to）で絞り込む。
+    """
+    mask = np.ones(len(df), dtype=bool)
+    if horse_id_list is not None:
+        mask &= df.index.isin(horse_id_list)
+    if date_from is not None:
+        mask &= (df['date'] >= pd.Timestamp(date_from)).to_numpy()
+    if date_to is not None:
+        mask &= (df['date'] < pd.Timestamp(date_to)).to_numpy()
+    filtered = df[mask]
+    if columns is not None:
+        filtered = filtered[[c for c in columns if c in filtered.columns]]
+    return filtered
+
+
+class HorseResultsStore:
+    """
+    前処理済みの馬の過去成績テーブルを、horse_id順のパーティションに分けてディスク上に保持するクラス。
+
+    - 前処理はパーティション（chunk_size行程度、馬単位で区切る）ごとに実行するため、
+      前処理の途中のコピー・前処理済みのデータは、チャンクの大きさの分しかメモリに置かない。
+      ただし、rawデータは1つのpickleなので、build()ではrawデータのテーブル全体を1度読み込む
+      （必要なメモリは、rawデータのテーブル全体 + 1チャンク分）。
+    - 作成後は、read()・iter_partitions()でパーティション単位に読み込むため、テーブル全体をメモリに置かない。
+    - 各パーティションのhorse_id・日付の範囲をマニフェストに持っておき、
+      read()では指定された馬・期間を含むパーティションだけを読み込む。
+    """
+    MANIFEST_FILENAME = '_manifest.json'
+
+    def __init__(self, store_dir: str = LocalPaths.HORSE_RESULTS_STORE_DIR):
+        """
+        初期処理
+        """
+        self.__store_dir = store_dir
+        self.__manifest = self.__read_manifest()
+
+    @property
+    def store_dir(self):
+        return self.__store_dir
+
+    @property
+    def partitions(self) -> pd.DataFrame:
+        """
+        パーティション一覧（ファイル名、horse_id・日付の範囲、行数）
+        """
+        return pd.DataFrame(self.__manifest['partitions'],
+                            columns=['file', 'horse_id_min', 'horse_id_max', 'date_min', 'date_max', 'n_rows'])
+
+    @property
+    def n_rows(self) -> int:
+        return int(sum(p['n_rows'] for p in self.__manifest['partitions']))
+
+    def exists(self) -> bool:
+        return os.path.isfile(os.path.join(self.__store_dir, self.MANIFEST_FILENAME))
+
+    def is_stale(self, raw_filepath: str) -> bool:
+        """
+        rawデータ（pickle）がストア作成時から変わっているかどうか
+        """
+        if not self.exists():
+            return True
+        return self.__manifest.get('source') != self.__source_stat(raw_filepath)
+
+    def build(self, raw_filepath: str, preprocess, chunk_size: int = 200000):
+        """
+        rawデータのpickleを読み込み、馬単位のチャンクごとに前処理してストアを作り直す。
+        preprocessには、rawデータのチャンクを受け取って前処理済みDataFrameを返す関数を渡す。
+        rawデータのテーブルは全体を読み込む（前処理済みのデータは、チャンクごとに書き出して手放す）。
+        """
+        raw = pd.read_pickle(raw_filepath)
+        self.__clear()
+        partitions = []
+        for raw_chunk in iter_horse_chunks(raw, chunk_size):
+            partitions += self.__write_partitions(preprocess(raw_chunk), chunk_size)
+        del raw
+        self.__manifest = {
+            'source': self.__source_stat(raw_filepath),
+            'chunk_size': chunk_size,
+            'partitions': partitions,
+            }
+        self.__write_manifest()
+
+    def update(self, new_raw: pd.DataFrame, preprocess, raw_filepath: str = None):
+        """
+        新たにスクレイピングした馬の過去成績（rawデータ）をストアに反映する。
+        new_rawに含まれる馬の行は全て置き換える（update_rawdataのmode='replace'と同じ扱い）。
+        影響するパーティションだけを読み書きするため、ストア全体は読み込まない。
+        raw_filepathを渡すと、反映後のrawデータを最新として記録し、is_staleがFalseになる。
+        """
+        chunk_size = self.__manifest.get('chunk_size', 200000)
+        if len(new_raw) > 0:
+            new_data = pd.concat([preprocess(c) for c in iter_horse_chunks(new_raw, chunk_size)])
+            new_data = new_data.iloc[np.argsort(new_data.index.astype(str).to_numpy(), kind='stable')]
+            new_ids = new_data.index.astype(str).to_numpy()
+            # 元のrawに含まれていた馬は、前処理で全行が落ちても古い行を消す必要がある
+            replaced_ids = np.unique(new_raw.index.astype(str).to_numpy())
+
+            partitions = self.__manifest['partitions']
+            id_max = np.array([p['horse_id_max'] for p in partitions], dtype=object)
+            # 各馬が属するパーティション（horse_id_max以下で最初のもの。末尾より大きい馬は最後のパーティション）
+            target = np.minimum(np.searchsorted(id_max.astype(str), replaced_ids, side='left'),
+                                max(len(partitions) - 1, 0))
+            new_target = np.minimum(np.searchsorted(id_max.astype(str), new_ids, side='left'),
+                                    max(len(partitions) - 1, 0))
+
+            updated = []
+            for i, partition in enumerate(partitions):
+                if not (target == i).any():
+                    updated.append(partition)
+                    continue
+                old = pd.read_pickle(os.path.join(self.__store_dir, partition['file']))
+                old = old[~old.index.isin(replaced_ids[target == i])]
+                merged = pd.concat([old, new_data[new_target == i]])
+                merged = merged.iloc[np.argsort(merged.index.astype(str).to_numpy(), kind='stable')]
+                os.remove(os.path.join(self.__store_dir, partition['file']))
+                updated += self.__write_partitions(merged, chunk_size)
+            if len(partitions) == 0:
+                updated += self.__write_partitions(new_data, chunk_size)
+            self.__manifest['partitions'] = updated
+        if raw_filepath is not None:
+            self.__manifest['source'] = self.__source_stat(raw_filepath)
+        self.__write_manifest()
+
+    def read(self, horse_id_list=None, date_from=None, date_to=None, columns=None) -> pd.DataFrame:
+        """
+        指定した馬・期間（date_from <= date < date_to）を含むパーティションだけを読み込んで返す。
+        引数を省略した場合は全件を読み込む。
+        """
+        if horse_id_list is not None:
+            horse_id_list = np.unique(np.asarray(horse_id_list).astype(str))
+        frames = []
+        for partition in self.__manifest['partitions']:
+            if not self.__overlaps(partition, horse_id_list, date_from, date_to):
+                continue
+            df = pd.read_pickle(os.path.join(self.__store_dir, partition['file']))
+            frames.append(filter_horse_results(df, horse_id_list, date_from, date_to, columns))
+            del df
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames)
+
+    def iter_partitions(self, columns=None):
+        """
+        パーティションを1つずつ（horse_id順に）読み込んで返すジェネレータ。
+        各パーティションには、それに含まれる馬の全ての行が入っている。
+        """
+        for partition in self.__manifest['partitions']:
+            df = pd.read_pickle(os.path.join(self.__store_dir, partition['file']))
+            yield filter_horse_results(df, columns=columns)
+            del df
+
+    def __overlaps(self, partition, horse_id_list, date_from, date_to) -> bool:
+        """
+        パーティションが指定された馬・期間を含む可能性があるか（マニフェストだけで判定）
+        """
+        if horse_id_list is not None:
+            lo = np.searchsorted(horse_id_list, partition['horse_id_min'], side='left')
+            hi = np.searchsorted(horse_id_list, partition['horse_id_max'], side='right')
+            if lo >= hi:
+                return False
+        if partition['date_min'] is None:
+            return date_from is None and date_to is None
+        if date_from is not None and pd.Timestamp(partition['date_max']) < pd.Timestamp(date_from):
+            return False
+        if date_to is not None and pd.Timestamp(partition['date_min']) >= pd.Timestamp(date_to):
+            return False
+        return True
+
+    def __write_partitions(self, df: pd.DataFrame, chunk_size: int) -> list:
+        """
+        horse_id順に並んだ前処理済みデータをchunk_size行程度のパーティションに分けて保存し、
+        マニフェストの行（dictのリスト）を返す。
+        """
+        os.makedirs(self.__store_dir, exist_ok=True)
+        rows = []
+        for chunk in iter_horse_chunks(df, chunk_size):
+            if len(chunk) == 0:
+                continue
+            filename = 'part-{:05d}.pickle'.format(self.__next_partition_no())
+            chunk.to_pickle(os.path.join(self.__store_dir, filename))
+            horse_ids = chunk.index.astype(str)
+            dates = chunk['date'].dropna()
+            rows.append({
+                'file': filename,
+                'horse_id_min': horse_ids.min(),
+                'horse_id_max': horse_ids.max(),
+                'date_min': dates.min().isoformat() if len(dates) else None,
+                'date_max': dates.max().isoformat() if len(dates) else None,
+                'n_rows': int(len(chunk)),
+                })
+        return sorted(rows, key=lambda x: x['horse_id_min'])
+
+    def __next_partition_no(self) -> int:
+        """
+        未使用のパーティション番号
+        """
+        numbers = [int(f[5:10]) for f in os.listdir(self.__store_dir)
+                   if f.startswith('part-') and f.endswith('.pickle')]
+        return max(numbers) + 1 if numbers else 0
+
+    def __clear(self):
+        if os.path.isdir(self.__store_dir):
+            shutil.rmtree(self.__store_dir)
+        os.makedirs(self.__store_dir, exist_ok=True)
+
+    def __read_manifest(self) -> dict:
+        path = os.path.join(self.__store_dir, self.MANIFEST_FILENAME)
+        if not os.path.isfile(path):
+            return {'source': None, 'partitions': []}
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def __write_manifest(self):
+        os.makedirs(self.__store_dir, exist_ok=True)
+        path = os.path.join(self.__store_dir, self.MANIFEST_FILENAME)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.__manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def __source_stat(raw_filepath: str):
+        if raw_filepath is None or not os.path.isfile(raw_filepath):
+            return None
+        stat = os.stat(raw_filepath)
+        return {'path': os.path.abspath(raw_filepath), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
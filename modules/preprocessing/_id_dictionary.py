@@ -0,0 +1,180 @@
+import io
+import os
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+
+# open()で開いた辞書（(ファイルの絶対パス, 列名) → IdDictionary）。プロセス内で共有する
+_OPEN_DICTIONARIES = {}
+
+
+class IdDictionary:
+    """
+    ID（文字列）に、0から始まる連番のコードを振る辞書。ファイル（CSV）に保存し、追記だけで拡張していく。
+
+    - 一度振ったコードは変わらないため、学習時と当日の予測時で同じIDは同じコードになる。
+    - encode()は、ユニークな値だけを辞書と突き合わせてから元の配列に割り当てる（1回のベクトル化した検索）。
+    - 新しいIDは、現れた順にコードを振ってファイルの末尾に追記する（既存の行は書き換えない）。
+      追記は、新しい行をまとめて1回のO_APPENDの書き込みで行う。
+    - 複数のプロセスが同じ辞書に追記しても同じコードを振らないよう、ファイルの読み直し・コードの割り当て・追記は、
+      ロックファイル（{ファイル名}.lock。O_CREAT | O_EXCLで作るため、Windowsでも使える）を作ってから行う。
+      LOCK_STALE_SECONDSより古いロックファイルは、異常終了したプロセスが残したものとして削除する。
+    - open()で開いた辞書はプロセス内で共有してメモリに置いておき、ファイルは他から書き換えられた場合だけ読み直す。
+    ファイルの形式は、masterディレクトリの他のCSVと同じ（{name}, encoded_id の2列）。
+    以前の形式のマスタ（IDが欠損値の行や、重複した行を含むもの）は、欠損値の行を除き、重複は先の行を使って読み込む。
+    そのため、コードには使われていない番号（欠番）がありうる。新しいIDには、最大のコード + 1 から振る。
+    """
+    # ロックファイルを待つ最大の秒数・異常終了したプロセスが残したものとみなす秒数
+    LOCK_TIMEOUT_SECONDS = 60
+    LOCK_STALE_SECONDS = 300
+
+    def __init__(self, filepath: str, name: str):
+        """
+        初期処理
+        """
+        self.__filepath = filepath
+        self.__name = name
+        self.__read()
+
+    @classmethod
+    def open(cls, filepath: str, name: str) -> 'IdDictionary':
+        """
+        (filepath, name) の辞書を、プロセス内で共有しているものから返す（なければ読み込む）。
+        """
+        key = (os.path.abspath(filepath), name)
+        dictionary = _OPEN_DICTIONARIES.get(key)
+        if dictionary is None:
+            dictionary = _OPEN_DICTIONARIES[key] = cls(filepath, name)
+        return dictionary
+
+    @property
+    def filepath(self):
+        return self.__filepath
+
+    @property
+    def ids(self) -> pd.Index:
+        """コードの順に並べたID（ids[code] がそのコードのID。欠番はNone）"""
+        return pd.Index(self.decode(np.arange(self.__size)), dtype=object)
+
+    def __len__(self):
+        """コードの数（最大のコード + 1）"""
+        return self.__size
+
+    def encode(self, values, extend: bool = True) -> np.ndarray:
+        """
+        valuesをコード（int32）の配列に変換する。欠損値は-1。
+        extend=Trueの場合は辞書にないIDを追加し、Falseの場合は-1にする。
+        """
+        self.__reload_if_modified()
+        values = np.asarray(values, dtype=object)
+        codes, uniques = pd.factorize(values.ravel(), use_na_sentinel=True)
+        uniques = pd.Index(uniques).astype(str)
+        unique_codes = self.__lookup_codes(uniques)
+        if extend and (unique_codes < 0).any():
+            with self.__locked():
+                # 他のプロセスが追記したIDを読み込んでから、まだないIDにコードを振る
+                self.__reload_if_modified()
+                unique_codes = self.__lookup_codes(uniques)
+                unknown = unique_codes < 0
+                if unknown.any():
+                    unique_codes[unknown] = self.__extend(uniques[unknown])
+        out = np.full(len(codes), -1, dtype=np.int32)
+        out[codes >= 0] = unique_codes[codes[codes >= 0]]
+        return out.reshape(values.shape)
+
+    def decode(self, codes) -> np.ndarray:
+        """コードをIDに戻す。-1と欠番は欠損値（None）"""
+        codes = np.asarray(codes)
+        table = np.full(self.__size, None, dtype=object)
+        table[self.__codes] = self.__lookup.to_numpy()
+        out = np.full(codes.shape, None, dtype=object)
+        out[codes >= 0] = table[codes[codes >= 0]]
+        return out
+
+    def __lookup_codes(self, ids: pd.Index) -> np.ndarray:
+        """idsのコード（int32）。辞書にないIDは-1"""
+        positions = self.__lookup.get_indexer(ids)
+        codes = np.full(len(ids), -1, dtype=np.int32)
+        codes[positions >= 0] = self.__codes[positions[positions >= 0]]
+        return codes
+
+    @contextmanager
+    def __locked(self):
+        """ロックファイルを作ってから処理し、終わったら削除する"""
+        lock_path = self.__filepath + '.lock'
+        os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+        deadline = time.monotonic() + self.LOCK_TIMEOUT_SECONDS
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(lock_path).st_mtime > self.LOCK_STALE_SECONDS:
+                        os.remove(lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.monotonic() > deadline:
+                    raise TimeoutError('{} のロックを取得できませんでした（{}）'.format(self.__filepath, lock_path))
+                time.sleep(0.05)
+        try:
+            try:
+                os.write(fd, str(os.getpid()).encode())
+            finally:
+                os.close(fd)
+            yield
+        finally:
+            os.remove(lock_path)
+
+    def __extend(self, new_ids: pd.Index) -> np.ndarray:
+        """新しいIDに連番を振り、ファイルの末尾に追記する（ロックを取得した状態で呼ぶ）"""
+        new_codes = np.arange(self.__size, self.__size + len(new_ids), dtype=np.int32)
+        new_rows = pd.DataFrame({self.__name: new_ids, 'encoded_id': new_codes})
+        os.makedirs(os.path.dirname(os.path.abspath(self.__filepath)), exist_ok=True)
+        stat = self.__stat()
+        buffer = io.StringIO()
+        new_rows.to_csv(buffer, header=stat is None or stat[0] == 0, index=False)
+        fd = os.open(self.__filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, buffer.getvalue().encode('utf-8'))
+        finally:
+            os.close(fd)
+        self.__lookup = self.__lookup.append(pd.Index(new_ids, dtype=object))
+        self.__codes = np.r_[self.__codes, new_codes.astype(np.int64)]
+        self.__size += len(new_ids)
+        self.__file_stat = self.__stat()
+        return new_codes
+
+    def __reload_if_modified(self):
+        """ファイルが、最後に読み書きした後に（他のプロセスなどから）変更されていれば読み直す"""
+        if self.__stat() != self.__file_stat:
+            self.__read()
+
+    def __stat(self):
+        try:
+            stat = os.stat(self.__filepath)
+        except FileNotFoundError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def __read(self):
+        self.__file_stat = self.__stat()
+        if self.__file_stat is None or self.__file_stat[0] == 0:
+            self.__lookup = pd.Index([], dtype=object)
+            self.__codes = np.zeros(0, dtype=np.int64)
+            self.__size = 0
+            return
+        master = pd.read_csv(self.__filepath, dtype=object)
+        master = master[[self.__name, 'encoded_id']]
+        master = master.assign(encoded_id=pd.to_numeric(master['encoded_id'], errors='coerce')).dropna()
+        master = master.drop_duplicates(subset=[self.__name], keep='first')
+        codes = master['encoded_id'].to_numpy(dtype=np.int64)
+        # 同じコードが複数のIDに振られている場合は、コードが一意に決まらないためエラーにする
+        if len(np.unique(codes)) != len(codes) or (codes < 0).any():
+            raise ValueError('{} のコードが重複しています'.format(self.__filepath))
+        self.__lookup = pd.Index(master[self.__name].to_numpy(), dtype=object)
+        self.__codes = codes
+        self.__size = int(codes.max()) + 1 if len(codes) > 0 else 0
@@ -1,6 +1,9 @@
+import numpy as np
 import pandas as pd
 
 from ._abstract_data_processor import AbstractDataProcessor
+from ._entity_form_processor import EntityFormProcessor
+from . import _string_kernels as kernels
 from modules.constants import HorseResultsCols as Cols
 
 
@@ -15,29 +18,51 @@ class JockeyStatsProcessor(AbstractDataProcessor):
                 - jockey_id もしくは 騎手を一意に識別できるID/名称カラム
                 - 日付列（HorseResultsCols.DATE）
                 - 着順列（HorseResultsCols.RANK）
+        - results_filepath: レース結果（results）のrawデータのパス（省略可）。
+          指定した場合、騎手名しかない成績データの jockey_id を、レース結果の 騎手名 → jockey_id の対応で netkeiba の
+          騎手IDにする（出馬表の jockey_id で騎手ごとの as-of join ができるようにするため）。
 
     出力 (preprocessed_data プロパティ):
         - インデックス: date, horse_id
         - カラム:
-            - jockey_id
+            - jockey_id（results_filepathを指定しない場合、騎手名しかない成績データでは騎手名）
             - jockey_plc_rate_10_all:  直近最大10レースの複勝率（1〜3着を1とした平均）
             - jockey_rides_10_all:     直近最大10レースの騎乗数
             - jockey_plc_rate_50_all:  直近最大50レースの複勝率
             - jockey_rides_50_all:     直近最大50レースの騎乗数
             - jockey_has_history_flag: 過去レースが1件以上あれば1、なければ0
+            - 上の5列それぞれに AFTER_DAY_SUFFIX を付けた列: その日の騎乗を全て含めた、その日の終わり時点の値
 
-        すべて "対象レースより前のレースのみ" を用いて計算する。
+        上の5列は "対象レースより前のレースのみ" を用いて計算する。
         具体的には jockey ごとに日付・レース順にソートし、
-        shift(1) + rolling(window) でリークを防いでいる。
+        shift(1) + rolling(window) と同じ集計を、累積和の差分で行っている（_add_rolling_stats）。
+        {列名}_after_day は特徴量としてはマージせず、(date, horse_id) の行がないレース（出馬表のレースなど）に、
+        騎手のレース日より前の最後の騎乗日の値を付けるのに使う（DataMerger._merge_jockey_stats）。
+        レース日より前の全ての騎乗を集計した値になるため、学習データでのその騎手のその日の最初の騎乗の値と一致する。
     """
-
-    def __init__(self, filepath: str):
-        super().__init__(filepath)
+    # その日の終わり時点の値の列に付ける接尾辞
+    AFTER_DAY_SUFFIX = '_after_day'
+    STATS_COLS = [
+        'jockey_plc_rate_10_all',
+        'jockey_rides_10_all',
+        'jockey_plc_rate_50_all',
+        'jockey_rides_50_all',
+        'jockey_has_history_flag',
+        ]
+
+    def __init__(self, filepath: str, results_filepath: str = None, copy: bool = False, use_cache: bool = True):
+        self.__results_filepath = results_filepath
+        super().__init__(filepath, copy, use_cache)
+
+    def _cache_params(self) -> dict:
+        if self.__results_filepath is None:
+            return {}
+        return {'files': [self.__results_filepath]}
 
     def _preprocess(self) -> pd.DataFrame:
         """騎手ごとの直近複勝率特徴量を計算して返す。"""
-        # 元データをコピー
-        df = self.raw_data.copy()
+        # 元データ（保持データと値を共有する浅いコピー。列の追加・置き換えのみ行う）
+        df = self.raw_data
 
         # 必須カラムの存在チェック
         required_cols = [Cols.DATE, Cols.RANK]
@@ -65,10 +90,10 @@ class JockeyStatsProcessor(AbstractDataProcessor):
         df['horse_id'] = horse_id_series.astype(str)
 
         # 日付を datetime 型に変換
-        df['date'] = pd.to_datetime(df[Cols.DATE])
+        df['date'] = kernels.to_datetime_unique(df[Cols.DATE])
 
         # 着順を数値化し、複勝フラグを作成（1〜3着を1、それ以外を0）
-        rank_numeric = pd.to_numeric(df[Cols.RANK], errors='coerce')
+        rank_numeric = kernels.map_unique(df[Cols.RANK], lambda u: pd.to_numeric(u, errors='coerce'))
         # 数値化できなかった着順（"除外", "中止" など）は NaN になるので除外する
         valid_mask = ~rank_numeric.isna()
         df = df[valid_mask].copy()
@@ -82,50 +107,66 @@ class JockeyStatsProcessor(AbstractDataProcessor):
         # 騎手ごとに日付順でソート
         df = df.sort_values(['_jockey_key', 'date'])
 
-        # 騎手ごとに直近10/50レースの複勝率・騎乗数を計算（リーク防止のため shift(1) 後に rolling）
-        def _calc_group(group: pd.DataFrame) -> pd.DataFrame:
-            # 現在レースを含めないために1行シフト
-            plc_shifted = group['plc_flag'].shift(1)
-            # 有効な過去レースの有無（NaNでないものをカウント）
-            ride_flag = (~plc_shifted.isna()).astype(int)
-
-            # 直近10レース
-            rides_10 = ride_flag.rolling(window=10, min_periods=1).sum()
-            rate_10 = plc_shifted.rolling(window=10, min_periods=1).mean()
-
-            # 直近50レース
-            rides_50 = ride_flag.rolling(window=50, min_periods=1).sum()
-            rate_50 = plc_shifted.rolling(window=50, min_periods=1).mean()
-
-            group['jockey_rides_10_all'] = rides_10.fillna(0).astype(int)
-            group['jockey_plc_rate_10_all'] = rate_10
-            group['jockey_rides_50_all'] = rides_50.fillna(0).astype(int)
-            group['jockey_plc_rate_50_all'] = rate_50
-
-            # 過去レースが1件以上あるかどうか（ここでは50レース窓を基準に判定）
-            group['jockey_has_history_flag'] = (rides_50 > 0).astype(int)
-            return group
-
-        df = df.groupby('_jockey_key', group_keys=False).apply(_calc_group)
+        # 騎手ごとに直近10/50レースの複勝率・騎乗数を計算（リーク防止のため、対象レースより前の行のみを使う）
+        # 騎手ごとのgroupby.applyの代わりに、ソート済みの全体に対する累積和の差分で求める
+        df = self._add_rolling_stats(df, df['_jockey_key'].to_numpy())
 
         # 出力用の DataFrame 整形
-        # jockey_id 列がない場合は _jockey_key をそのまま用いる
+        # jockey_id 列がない場合は _jockey_key（騎手名）を、レース結果に対応がある騎手はその jockey_id に置き換えて用いる
         if 'jockey_id' not in df.columns:
             df['jockey_id'] = df['_jockey_key']
+            if self.__results_filepath is not None:
+                jockey_ids = df['jockey_id'].map(EntityFormProcessor.read_jockey_ids(self.__results_filepath))
+                df['jockey_id'] = jockey_ids.fillna(df['jockey_id'])
 
         # date, horse_id をインデックスにした特徴量テーブルに変換
         out = df.set_index(['date', 'horse_id'])[
-            [
-                'jockey_id',
-                'jockey_plc_rate_10_all',
-                'jockey_rides_10_all',
-                'jockey_plc_rate_50_all',
-                'jockey_rides_50_all',
-                'jockey_has_history_flag',
-            ]
+            ['jockey_id'] + self.STATS_COLS + [col + self.AFTER_DAY_SUFFIX for col in self.STATS_COLS]
         ].sort_index()
 
         # マージ時にキーが一意になるよう、(date, horse_id) が重複している行は後ろを優先して残す
         out = out[~out.index.duplicated(keep='last')]
 
         return out
+
+    @staticmethod
+    def _add_rolling_stats(df: pd.DataFrame, keys: np.ndarray) -> pd.DataFrame:
+        """
+        騎手（keys）ごとに並んだdfに、直近10/50レースの複勝率・騎乗数の列を追加する。
+        各行について、同じ騎手の直前のwindow行（対象行は含まない）を集計する。
+            - 騎乗数: min(騎手内での行番号, window)
+            - 複勝数: plc_flagの累積和の差分（cum[i] - cum[i - 騎乗数]）
+        shift(1) + rolling(window, min_periods=1) と同じ結果になる（複勝数は整数なので、複勝率も一致する）。
+        dfは騎手ごとに日付順に並んでいる前提で、{列名}_after_day には、同じ騎手・同じ日付の最後の行の次の位置で
+        同じ集計をした値（その日の騎乗を全て含めた値）を追加する。
+        """
+        n = len(df)
+        row_no = np.arange(n)
+        # 騎手内での行番号（各騎手の先頭行からの位置）
+        is_start = np.ones(n, dtype=bool)
+        is_start[1:] = keys[1:] != keys[:-1]
+        group_start = np.maximum.accumulate(np.where(is_start, row_no, 0))
+        pos = row_no - group_start
+        # cum[i]: 先頭からi-1行目までのplc_flagの合計
+        cum = np.r_[0, np.cumsum(df['plc_flag'].to_numpy())]
+        # 各行と同じ騎手・同じ日付の、最後の行の次の位置
+        days = df['date'].to_numpy()
+        is_end = np.ones(n, dtype=bool)
+        is_end[:-1] = (keys[1:] != keys[:-1]) | (days[1:] != days[:-1])
+        ends = np.flatnonzero(is_end)
+        day_end = ends[np.searchsorted(ends, row_no)] + 1 if n > 0 else row_no
+
+        suffix = JockeyStatsProcessor.AFTER_DAY_SUFFIX
+        for window in (10, 50):
+            for at, col_suffix in ((row_no, ''), (day_end, suffix)):
+                rides = np.minimum(at - group_start, window)
+                plc_sum = cum[at] - cum[at - rides]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    rate = np.where(rides > 0, plc_sum / rides, np.nan)
+                df['jockey_rides_{}_all{}'.format(window, col_suffix)] = rides.astype(int)
+                df['jockey_plc_rate_{}_all{}'.format(window, col_suffix)] = rate
+
+        # 過去レースが1件以上あるかどうか（ここでは50レース窓を基準に判定）
+        df['jockey_has_history_flag'] = (pos > 0).astype(int)
+        df['jockey_has_history_flag' + suffix] = 1
+        return df
@@ -0,0 +1,171 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from ._abstract_data_processor import AbstractDataProcessor
+from ._entity_form_processor import EntityFormProcessor
+from ._peds_processor import PedsProcessor
+from modules.constants import LocalPaths
+
+
+def pedigree_generations(n_generations: int = 5) -> list:
+    """
+    血統テーブルの列（peds_0, peds_1, ...）ごとの世代（父・母が1）。
+    列は5代血統表のHTMLの順（父, 父父, 父父父, ..., 母, 母父, ...）で、父系・母系それぞれの行きがけ順になっている。
+    """
+    def subtree(generation):
+        if generation > n_generations:
+            return []
+        return [generation] + subtree(generation + 1) + subtree(generation + 1)
+
+    return subtree(1) + subtree(1)
+
+
+class PedigreeFormProcessor(AbstractDataProcessor):
+    """
+    父・母父・祖先全体の産駒成績の特徴量を計算する前処理クラス。
+
+    入力:
+        - filepath: 馬の成績データ（horse_results）のrawデータのパス
+        - peds_filepath: 血統（peds）のrawデータのパス
+        - ancestors_filepath: 祖先辞書のパス（PedsProcessorと同じもの）
+        - generation_decay: 祖先全体（ancestors）の集計で、世代が1つ離れるごとに掛ける重み（1なら全世代同じ重み）
+
+    出力 (preprocessed_data プロパティ):
+        - インデックス: date, horse_id
+        - カラム: 関係（sire: 父、damsire: 母父、ancestors: 5代までの祖先全体）ごとに
+            - {role}_progeny_starts:     その祖先を持つ馬の、対象レースの日付より前の出走数（ancestorsは重み付きの合計）
+            - {role}_progeny_place_rate: 同じく複勝率（1〜3着）
+            - {role}_progeny_win_rate:   同じく勝率
+
+        馬 → 祖先の関係を疎行列（馬 × 祖先辞書のコード、値は重み）で持ち、日付順に
+          1. その日に出走する馬の行 × 祖先ごとの累積成績 で特徴量を求め
+          2. その日の成績を、同じ行の転置で祖先ごとの累積成績に足し込む
+        を繰り返すため、同じ日付のレースは含まれず、全馬を1回の走査で計算できる。
+
+    当日のレース（この特徴量テーブルにない日付）の特徴量は、DataMerger・ShutubaDataMergerが
+    LocalPaths.PEDIGREE_FORM_STATE_PATHの状態（PedigreeFormState）から求める。結果を取り込んだ後に、次のように状態を保存しておく。
+        PedigreeFormState.rebuild(pedigree_form_processor).save()
+    """
+    ROLES = ('sire', 'damsire', 'ancestors')
+
+    def __init__(self, filepath: str, peds_filepath: str,
+                 ancestors_filepath: str = LocalPaths.MASTER_PEDS_ANCESTORS_PATH,
+                 generation_decay: float = 0.5, copy: bool = False, use_cache: bool = True):
+        self.__peds_filepath = peds_filepath
+        self.__ancestors_filepath = ancestors_filepath
+        self.__generation_decay = generation_decay
+        super().__init__(filepath, copy, use_cache)
+
+    def _cache_params(self) -> dict:
+        return {
+            'files': [self.__peds_filepath, self.__ancestors_filepath],
+            'generation_decay': self.__generation_decay,
+            }
+
+    @property
+    def generation_decay(self) -> float:
+        return self.__generation_decay
+
+    @property
+    def peds_processor(self) -> PedsProcessor:
+        """血統（祖先辞書のコード）の前処理"""
+        return PedsProcessor(self.__peds_filepath, self.__ancestors_filepath)
+
+    @property
+    def runs(self) -> pd.DataFrame:
+        """集計に使う出走の一覧（EntityFormProcessor.build_runs()の形式）を日付順に並べたもの"""
+        runs = EntityFormProcessor.build_runs(self.raw_data).sort_values('date', kind='stable')
+        return runs.reset_index(drop=True)
+
+    def _preprocess(self) -> pd.DataFrame:
+        """祖先ごとの産駒成績の特徴量を計算して返す。"""
+        peds_processor = self.peds_processor
+        matrix = peds_processor.ancestry_matrix
+        peds_horse_ids = pd.Index(peds_processor.preprocessed_data.index.astype(str))
+        n_ancestors = len(peds_processor.ancestors)
+
+        runs = self.runs
+        positions = peds_horse_ids.get_indexer(runs['horse_id'])
+        days = runs['date'].to_numpy().astype('datetime64[D]').astype(np.int64)
+        results = self._run_results(runs)
+
+        features = {}
+        for role in self.ROLES:
+            relation = self._relation_matrix(matrix, role, n_ancestors, self.__generation_decay)
+            features.update(self._role_features(role, self._aggregate(relation, positions, days, results)))
+
+        out = pd.DataFrame(features)
+        out.index = pd.MultiIndex.from_arrays([runs['date'], runs['horse_id']], names=['date', 'horse_id'])
+        out = out.sort_index()
+        # マージ時にキーが一意になるよう、(date, horse_id) が重複している行は後ろを優先して残す
+        return out[~out.index.duplicated(keep='last')]
+
+    @staticmethod
+    def _run_results(runs: pd.DataFrame) -> np.ndarray:
+        """出走ごとの [出走数, 複勝, 勝利]"""
+        return np.column_stack([
+            np.ones(len(runs)),
+            runs['rank'].between(1, 3).to_numpy(dtype=float),
+            (runs['rank'] == 1).to_numpy(dtype=float),
+            ])
+
+    @staticmethod
+    def _role_features(role: str, totals: np.ndarray) -> dict:
+        """[出走数, 複勝, 勝利] の合計（出走ごと）から、roleの特徴量（出走数・複勝率・勝率）を求める"""
+        starts = totals[:, 0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {
+                '{}_progeny_starts'.format(role): starts,
+                '{}_progeny_place_rate'.format(role): np.where(starts > 0, totals[:, 1] / starts, np.nan),
+                '{}_progeny_win_rate'.format(role): np.where(starts > 0, totals[:, 2] / starts, np.nan),
+                }
+
+    @staticmethod
+    def _relation_matrix(matrix: np.ndarray, role: str, n_ancestors: int,
+                         generation_decay: float) -> sparse.csr_matrix:
+        """
+        馬（血統テーブルの行）× 祖先のコード の疎行列。値は重み（同じ祖先が複数回現れる場合は合計）。
+        """
+        generations = np.array(pedigree_generations()[:matrix.shape[1]])
+        if role == 'sire':
+            columns, weights = [0], np.ones(1)
+        elif role == 'damsire':
+            # 母系の先頭（母）の次の列が母父
+            columns, weights = [len(generations) // 2 + 1], np.ones(1)
+        else:
+            columns = np.arange(matrix.shape[1])
+            weights = generation_decay ** (generations - 1.0)
+        columns = [column for column in columns if column < matrix.shape[1]]
+        codes = matrix[:, columns]
+        rows = np.broadcast_to(np.arange(len(matrix))[:, None], codes.shape)
+        data = np.broadcast_to(weights[:len(columns)], codes.shape)
+        valid = codes >= 0
+        relation = sparse.csr_matrix((data[valid], (rows[valid], codes[valid])), shape=(len(matrix), n_ancestors))
+        relation.sum_duplicates()
+        return relation
+
+    @staticmethod
+    def _aggregate(relation: sparse.csr_matrix, positions: np.ndarray, days: np.ndarray,
+                   results: np.ndarray) -> np.ndarray:
+        """
+        日付順に並んだ出走（positions: 血統テーブルの行、-1は血統がない馬）について、
+        その馬の祖先の、その日付より前の累積成績（relationの重みを掛けた合計）を求める。
+        血統がない馬の行は欠損値。
+        """
+        totals = np.full(results.shape, np.nan)
+        # 祖先ごとの累積成績
+        ancestor_totals = np.zeros((relation.shape[1], results.shape[1]))
+        bounds = np.flatnonzero(np.r_[True, days[1:] != days[:-1], True]) if len(days) > 0 else [0]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            rows = np.arange(start, stop)
+            rows = rows[positions[rows] >= 0]
+            if len(rows) == 0:
+                continue
+            day_relation = relation[positions[rows]]
+            totals[rows] = day_relation @ ancestor_totals
+            # その日の成績を祖先ごとに足し込む（day_relation.T @ results[rows] と同じ）
+            nnz_rows = np.repeat(np.arange(len(rows)), np.diff(day_relation.indptr))
+            np.add.at(ancestor_totals, day_relation.indices,
+                      day_relation.data[:, None] * results[rows][nnz_rows])
+        return totals
@@ -0,0 +1,96 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from ._pedigree_form_processor import PedigreeFormProcessor
+from modules.constants import LocalPaths
+
+
+class PedigreeFormState:
+    """
+    父・母父・祖先全体（PedigreeFormProcessor.ROLES）ごとの、祖先辞書のコードごとの産駒成績の合計
+    （[出走数, 複勝, 勝利]。祖先全体は世代の重み付き）を、as_ofまでの全ての出走について持つ状態。
+
+    as_ofより後の日付のレース（当日のレースなど）の特徴量は、出走馬の血統（祖先のコード）の重みと
+    祖先ごとの合計の積（疎行列の積）で求まり、PedigreeFormProcessorの出力と同じ値になる。
+    DataMerger・ShutubaDataMergerは、LocalPaths.PEDIGREE_FORM_STATE_PATHに保存されている状態を読み込み、
+    特徴量テーブル（PedigreeFormProcessor）に行がないレースの特徴量を求める。
+
+    - rebuild(): PedigreeFormProcessorと同じ出走・血統・重みから作る。
+    - query(): 出走馬の祖先のコードの配列から、特徴量を返す。
+    - save() / load() / load_if_exists(): pickleで保存・読み込みする。
+    """
+    def __init__(self, totals: dict, as_of, generation_decay: float):
+        """
+        初期処理
+
+        totalsは、roleごとの 祖先のコード × [出走数, 複勝, 勝利] の配列。
+        """
+        self.__totals = totals
+        self.__as_of = as_of
+        self.__generation_decay = generation_decay
+
+    @property
+    def as_of(self):
+        """集計済みの最後の日付"""
+        return self.__as_of
+
+    @property
+    def generation_decay(self) -> float:
+        return self.__generation_decay
+
+    @classmethod
+    def rebuild(cls, processor: PedigreeFormProcessor) -> 'PedigreeFormState':
+        """
+        processorの全ての出走を集計した状態を作る。
+        """
+        peds_processor = processor.peds_processor
+        matrix = peds_processor.ancestry_matrix
+        n_ancestors = len(peds_processor.ancestors)
+        runs = processor.runs
+        positions = pd.Index(peds_processor.preprocessed_data.index.astype(str)).get_indexer(runs['horse_id'])
+        has_peds = positions >= 0
+        results = PedigreeFormProcessor._run_results(runs)[has_peds]
+        totals = {}
+        for role in PedigreeFormProcessor.ROLES:
+            relation = PedigreeFormProcessor._relation_matrix(
+                matrix, role, n_ancestors, processor.generation_decay)[positions[has_peds]]
+            totals[role] = np.asarray(relation.T @ results)
+        as_of = runs['date'].max() if len(runs) > 0 else None
+        return cls(totals, as_of, processor.generation_decay)
+
+    def query(self, matrix: np.ndarray, index=None) -> pd.DataFrame:
+        """
+        出走馬ごとの祖先のコードの配列（PedsProcessor.ancestry_matrixの行。欠損値は-1）から、
+        as_ofまでの出走を使った特徴量を返す。状態を作った後に辞書に追加された祖先の産駒成績は0とする。
+        """
+        n_ancestors = max(int(matrix.max()) + 1 if matrix.size > 0 else 0,
+                          max(len(totals) for totals in self.__totals.values()))
+        features = {}
+        for role in PedigreeFormProcessor.ROLES:
+            totals = np.zeros((n_ancestors, 3))
+            totals[:len(self.__totals[role])] = self.__totals[role]
+            relation = PedigreeFormProcessor._relation_matrix(matrix, role, n_ancestors, self.__generation_decay)
+            features.update(PedigreeFormProcessor._role_features(role, np.asarray(relation @ totals)))
+        return pd.DataFrame(features, index=index)
+
+    def save(self, filepath: str = LocalPaths.PEDIGREE_FORM_STATE_PATH) -> None:
+        with open(filepath, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filepath: str = LocalPaths.PEDIGREE_FORM_STATE_PATH) -> 'PedigreeFormState':
+        with open(filepath, 'rb') as f:
+            state = pickle.load(f)
+        if not isinstance(state, cls):
+            raise TypeError('{} は {} ではありません'.format(filepath, cls.__name__))
+        return state
+
+    @classmethod
+    def load_if_exists(cls, filepath: str = LocalPaths.PEDIGREE_FORM_STATE_PATH) -> 'PedigreeFormState':
+        """保存されている状態があれば読み込む。なければNoneを返す。"""
+        if not os.path.isfile(filepath):
+            return None
+        return cls.load(filepath)
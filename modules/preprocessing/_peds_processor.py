@@ -1,22 +1,60 @@
-from sklearn.preprocessing import LabelEncoder
+import numpy as np
+import pandas as pd
+
 from ._abstract_data_processor import AbstractDataProcessor
+from ._id_dictionary import IdDictionary
+from modules.constants import LocalPaths
 
 
 class PedsProcessor(AbstractDataProcessor):
     """
-    初期処理
-    """
-    def __init__(self, filepath):
-        super().__init__(filepath)
-    
-    """
-    前処理
+    血統テーブルの前処理。
+
+    祖先のid（peds_0〜peds_61）を、全列で共通の祖先辞書（IdDictionary、ancestors_filepathに保存）のコードに変換する。
+    同じ馬は、どの列でも・学習時と当日の予測時でも、同じコードになる。
+    新しい祖先は辞書の末尾に追加するだけなので、既存のコードは変わらない。
+
+    出力:
+        - preprocessed_data: インデックスはhorse_id、各列は共通のCategoricalDtype（カテゴリは祖先のコード）。
+          祖先が不明の場合は欠損値。
+        - ancestry_matrix: 同じ内容の int32 の2次元配列（馬 × 祖先の列）。欠損値は-1。
     """
+    def __init__(self, filepath, ancestors_filepath: str = LocalPaths.MASTER_PEDS_ANCESTORS_PATH,
+                 copy: bool = False, use_cache: bool = True):
+        self.__ancestors_filepath = ancestors_filepath
+        super().__init__(filepath, copy, use_cache)
+
+    def _cache_params(self) -> dict:
+        # 祖先辞書が作り直された場合に、古いコードのキャッシュを使わないようにする
+        return {'files': [self.__ancestors_filepath]}
+
+    @property
+    def ancestry_matrix(self) -> np.ndarray:
+        """
+        祖先のコードの int32 配列（馬 × 祖先の列、preprocessed_dataと同じ並び）。欠損値は-1。
+        """
+        df = self.preprocessed_data
+        matrix = np.empty(df.shape, dtype=np.int32)
+        for i, column in enumerate(df.columns):
+            matrix[:, i] = df[column].cat.codes
+        return matrix
+
+    @property
+    def ancestors(self) -> IdDictionary:
+        """祖先辞書"""
+        return IdDictionary(self.__ancestors_filepath, 'ancestor_id')
+
     def _preprocess(self):
+        """
+        前処理
+        """
         df = self.raw_data
+        ancestors = self.ancestors
+        codes = ancestors.encode(df.to_numpy(dtype=object))
 
-        # カテゴリ変数に型変換を行う
-        for column in df.columns:
-            df[column] = LabelEncoder().fit_transform(df[column].fillna('Na'))
-        return df.astype('category')
- 
\ No newline at end of file
+        # 全列で同じカテゴリ（祖先辞書のコード）を使う
+        dtype = pd.CategoricalDtype(np.arange(len(ancestors), dtype=np.int32))
+        return pd.DataFrame(
+            {column: pd.Categorical.from_codes(codes[:, i], dtype=dtype) for i, column in enumerate(df.columns)},
+            index=df.index,
+            )
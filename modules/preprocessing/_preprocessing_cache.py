@@ -0,0 +1,197 @@
+import os
+import json
+import shutil
+import sys
+import hashlib
+import inspect
+
+from modules.constants import LocalPaths
+from ._featured_data_snapshot import FeaturedDataSnapshot
+
+
+class PreprocessingCache:
+    """
+    前処理済みデータをディスクに保存しておき、入力と前処理のコードが変わっていなければ再利用するためのクラス。
+
+    キャッシュのキーは以下から作る。いずれかが変わると別のキーになり、前処理をやり直す。
+        - rawデータ（pickle）の内容のハッシュ
+        - プロセッサのクラス名、_VERSION、前処理のコードのハッシュ
+          （クラスと継承元を定義したモジュール全体と、それらのモジュールが読み込んでいるmodules配下のモジュール
+          （_string_kernels・Masterなど）のソースコード）
+        - プロセッサのパラメータと、rawデータ以外に読み込むファイルの内容のハッシュ（_cache_params）
+
+    保存形式はFeaturedDataSnapshot（列ごとの.npy）で、読み込み時はコピーオンライトのメモリマップで開く。
+    dict（ReturnProcessor）の場合は、キーごとにサブディレクトリに保存する。
+    """
+    ENTRY_FILENAME = 'entry.json'
+    FINGERPRINTS_FILENAME = '_fingerprints.json'
+
+    def __init__(self, cache_dir: str = LocalPaths.PREPROCESSING_CACHE_DIR):
+        """
+        初期処理
+        """
+        self.__cache_dir = cache_dir
+
+    @property
+    def cache_dir(self):
+        return self.__cache_dir
+
+    def key(self, processor) -> str:
+        """
+        プロセッサのキャッシュキー
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(type(processor).__qualname__.encode())
+        h.update(str(getattr(processor, '_VERSION', 0)).encode())
+        h.update(self.__code_fingerprint(type(processor)).encode())
+        h.update(self.file_fingerprint(processor.filepath).encode())
+        params = dict(processor._cache_params())
+        for path in params.pop('files', []):
+            # まだ作られていないファイル（マスタなど）は、存在しないこと自体をキーに含める
+            exists = path is not None and os.path.isfile(path)
+            h.update(self.file_fingerprint(path).encode() if exists else b'None')
+        h.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def load(self, processor):
+        """
+        キャッシュがあれば前処理済みデータを返す。なければNoneを返す。
+        """
+        entry_dir = self.__entry_dir(processor)
+        entry_path = os.path.join(entry_dir, self.ENTRY_FILENAME)
+        if not os.path.isfile(entry_path):
+            return None
+        try:
+            with open(entry_path, encoding='utf-8') as f:
+                entry = json.load(f)
+            if entry['kind'] == 'dict':
+                return {key: FeaturedDataSnapshot.load(os.path.join(entry_dir, str(i)), mmap_mode='c')
+                        for i, key in enumerate(entry['keys'])}
+            return FeaturedDataSnapshot.load(os.path.join(entry_dir, 'data'), mmap_mode='c')
+        except (OSError, ValueError, KeyError) as e:
+            print('PreprocessingCache: キャッシュを読み込めないため、前処理をやり直します（{}）'.format(e))
+            return None
+
+    def save(self, processor, data):
+        """
+        前処理済みデータを保存する。同じクラス・同じrawデータのパスの古いキャッシュは削除する。
+        保存できない型の列を含む場合は、キャッシュせずにそのまま続行する。
+        """
+        entry_dir = self.__entry_dir(processor)
+        tmp_dir = entry_dir + '.tmp-{}'.format(os.getpid())
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        try:
+            if isinstance(data, dict):
+                entry = {'kind': 'dict', 'keys': list(data.keys())}
+                for i, value in enumerate(data.values()):
+                    FeaturedDataSnapshot.save(value, os.path.join(tmp_dir, str(i)))
+            else:
+                entry = {'kind': 'frame'}
+                FeaturedDataSnapshot.save(data, os.path.join(tmp_dir, 'data'))
+            entry['source'] = os.path.abspath(processor.filepath)
+            with open(os.path.join(tmp_dir, self.ENTRY_FILENAME), 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+        except (OSError, TypeError, ValueError) as e:
+            print('PreprocessingCache: 前処理済みデータをキャッシュできませんでした（{}）'.format(e))
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        self.__remove_old_entries(processor, entry['source'])
+        if os.path.isdir(entry_dir):
+            # 同じキーのキャッシュが残っている（別プロセスが保存した、削除できなかった）場合はそちらを使う
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        else:
+            os.replace(tmp_dir, entry_dir)
+
+    def clear(self):
+        """
+        キャッシュを全て削除する
+        """
+        shutil.rmtree(self.__cache_dir, ignore_errors=True)
+
+    def file_fingerprint(self, filepath: str) -> str:
+        """
+        ファイルの内容のハッシュ。
+        サイズ・更新日時が前回と同じであれば、記録しておいたハッシュを使う（ファイル全体を読まない）。
+        """
+        path = os.path.abspath(filepath)
+        stat = os.stat(path)
+        fingerprints_path = os.path.join(self.__cache_dir, self.FINGERPRINTS_FILENAME)
+        fingerprints = {}
+        if os.path.isfile(fingerprints_path):
+            try:
+                with open(fingerprints_path, encoding='utf-8') as f:
+                    fingerprints = json.load(f)
+            except ValueError:
+                fingerprints = {}
+        record = fingerprints.get(path)
+        if record is not None and record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+            return record['hash']
+
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        fingerprints[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': h.hexdigest()}
+        os.makedirs(self.__cache_dir, exist_ok=True)
+        tmp_path = fingerprints_path + '.tmp-{}'.format(os.getpid())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(fingerprints, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, fingerprints_path)
+        return h.hexdigest()
+
+    def __entry_dir(self, processor) -> str:
+        return os.path.join(self.__cache_dir, type(processor).__qualname__, self.key(processor))
+
+    def __remove_old_entries(self, processor, source: str):
+        """
+        同じクラス・同じrawデータのパスの、古いキーのキャッシュを削除する
+        """
+        class_dir = os.path.join(self.__cache_dir, type(processor).__qualname__)
+        if not os.path.isdir(class_dir):
+            return
+        for name in os.listdir(class_dir):
+            if '.tmp-' in name:
+                # 書き込み中のもの
+                continue
+            entry_path = os.path.join(class_dir, name, self.ENTRY_FILENAME)
+            if not os.path.isfile(entry_path):
+                continue
+            with open(entry_path, encoding='utf-8') as f:
+                if json.load(f).get('source') != source:
+                    continue
+            # メモリマップで開かれている場合（Windows）は削除できないので、次回以降に任せる
+            shutil.rmtree(os.path.join(class_dir, name), ignore_errors=True)
+
+    @staticmethod
+    def __code_fingerprint(cls) -> str:
+        """
+        前処理のコードのハッシュ（前処理のコードが変わったらキャッシュを無効にする）。
+        クラスと継承元を定義したモジュールのソースに加えて、それらのモジュールが読み込んでいるmodules配下のモジュール
+        （_string_kernels・Masterの定数など、_preprocess内で使うもの）のソースも含める。
+        それ以外（modules配下ではないライブラリ、ファイルから読み込むデータなど）の変更は検知しないため、
+        前処理の結果が変わる場合はプロセッサの_VERSIONを上げること。
+        """
+        modules = {}
+        for klass in cls.__mro__:
+            if klass is object or klass.__module__ == 'abc':
+                continue
+            module = sys.modules.get(klass.__module__)
+            if module is None or klass.__module__ == '__main__':
+                # ノートブック上で定義したクラスなどは、クラスのソース（取得できなければクラス名）だけを使う
+                modules[klass.__qualname__] = klass
+                continue
+            modules[module.__name__] = module
+            for value in vars(module).values():
+                dependency = value if inspect.ismodule(value) else inspect.getmodule(value)
+                if dependency is not None and dependency.__name__.startswith('modules.'):
+                    modules[dependency.__name__] = dependency
+
+        h = hashlib.blake2b(digest_size=16)
+        for name in sorted(modules):
+            h.update(name.encode())
+            try:
+                h.update(inspect.getsource(modules[name]).encode())
+            except (OSError, TypeError):
+                pass
+        return h.hexdigest()
@@ -1,12 +1,13 @@
 import pandas as pd
 from ._abstract_data_processor import AbstractDataProcessor
+from . import _string_kernels as kernels
 
 class RaceInfoProcessor(AbstractDataProcessor):
-    def __init__(self, filepath):
+    def __init__(self, filepath, copy: bool = False, use_cache: bool = True):
         """
         初期処理
         """
-        super().__init__(filepath)
+        super().__init__(filepath, copy, use_cache)
         
     def _preprocess(self):
         """
@@ -16,7 +17,7 @@ class RaceInfoProcessor(AbstractDataProcessor):
         # 距離は10の位を切り捨てる
         df["course_len"] = df["course_len"].astype(float) // 100
         # 日付型に変更
-        df["date"] = pd.to_datetime(df["date"], format="%Y年%m月%d日")
+        df["date"] = kernels.to_datetime_unique(df["date"], format="%Y年%m月%d日")
         # 開催場所
         df['開催'] = df.index.map(lambda x:str(x)[4:6])
         
@@ -1,38 +1,34 @@
 ﻿import pandas as pd
 
 from ._abstract_data_processor import AbstractDataProcessor
+from . import _string_kernels as kernels
 from modules.constants import ResultsCols as Cols
 
 
 class ResultsProcessor(AbstractDataProcessor):
-    def __init__(self, filepath):
+    def __init__(self, filepath, copy: bool = False, use_cache: bool = True):
         """
         初期処理
         """
-        super().__init__(filepath)
+        super().__init__(filepath, copy, use_cache)
     
     def _preprocess(self):
         """
         前処理
         """
-        df = self.raw_data.copy()
+        df = self.raw_data
         
         # 着順の前処理
         df = self._preprocess_rank(df)
         
         # 性齢を性と年齢に分ける
         # サイト上のテーブルに存在する列名は、ResultsColsクラスで定数化している。
-        df["性"] = df[Cols.SEX_AGE].map(lambda x: str(x)[0])
         # 年齢の変換時にエラーが発生する場合は欠損値にする
-        df["年齢"] = pd.to_numeric(df[Cols.SEX_AGE].map(lambda x: str(x)[1:]), errors='coerce')
+        df["性"], df["年齢"] = kernels.split_sex_age(df[Cols.SEX_AGE])
 
         # 馬体重を体重と体重変化に分ける
-        df["体重"] = df[Cols.WEIGHT_AND_DIFF].str.split("(", expand=True)[0]
-        df["体重変化"] = df[Cols.WEIGHT_AND_DIFF].str.split("(", expand=True)[1].str[:-1]
-        
-        # errors='coerce'で、"計不"など変換できない時に欠損値にする
-        df['体重'] = pd.to_numeric(df['体重'], errors='coerce')
-        df['体重変化'] = pd.to_numeric(df['体重変化'], errors='coerce')
+        # "計不"など変換できない時は欠損値にする
+        df["体重"], df["体重変化"] = kernels.split_weight_and_diff(df[Cols.WEIGHT_AND_DIFF])
 
         # 各列を数値型に変換（errors='coerce'で不正データを欠損値に変換）
         df[Cols.TANSHO_ODDS] = pd.to_numeric(df[Cols.TANSHO_ODDS], errors='coerce')
@@ -58,14 +54,13 @@ class ResultsProcessor(AbstractDataProcessor):
         """
         着順の前処理
         """
-        df = raw.copy()
+        df = raw
         # 着順に数字以外の文字列が含まれているものを取り除く
         # 取消を-1にし、数字以外の文字列を0に置換する（errors='coerce'で安全に変換）
-        df[Cols.RANK] = df[Cols.RANK].apply(lambda x: x if str(x).isdigit() else (-1 if x == "取消" else 0))
-        df[Cols.RANK] = pd.to_numeric(df[Cols.RANK], errors='coerce').fillna(0).astype(int)
+        df[Cols.RANK] = kernels.parse_rank(df[Cols.RANK])
         # -1(取消)を取り除く
         df = df[df[Cols.RANK] != -1]
-        df['rank'] = df[Cols.RANK].map(lambda x:1 if x>0 and x<4 else 0)
+        df['rank'] = ((df[Cols.RANK] > 0) & (df[Cols.RANK] < 4)).astype(int)
         print(df)
         return df
 
@@ -74,8 +69,7 @@ class ResultsProcessor(AbstractDataProcessor):
         各レースを馬番順にソートする。
         ※ 各レース内のソート。レースの順序自体はrace_idの名前順になる。
         """
-        df = raw.copy()
-        df = df.reset_index().sort_values(['index', Cols.UMABAN]).set_index('index')
+        df = raw.reset_index().sort_values(['index', Cols.UMABAN]).set_index('index')
         df.index.name = None
         # NOTE:
         # df.groupby(level=0, group_keys=False).apply(lambda x: x.sort_values(Cols.UMABAN))
@@ -86,7 +80,7 @@ class ResultsProcessor(AbstractDataProcessor):
         """
         カラム抽出
         """
-        df = raw.copy()[[
+        df = raw[[
             #Cols.RANK, # 着順
             Cols.WAKUBAN, # 枠番
             Cols.UMABAN, # 馬番
@@ -1,109 +1,67 @@
+import re
+import numpy as np
 import pandas as pd
 from ._abstract_data_processor import AbstractDataProcessor
+from modules.constants import Master
 
 class ReturnProcessor(AbstractDataProcessor):
-    def __init__(self, filepath):
+    """
+    払い戻し表の前処理。
+
+    出力（preprocessed_data）は、全券種の払い戻しを1行1組み合わせで持つテーブル。
+        - race_id: レースid（int64）
+        - bet_type: 券種のコード（Master.BET_TYPE_DICT）
+        - horse_1, horse_2, horse_3: 馬番（枠連は枠番）。使わない列は0。
+          着順を問わない券種（Master.UNORDERED_BET_TYPES）は昇順に並べる。
+        - payout: 100円あたりの払戻金
+    race_id, bet_typeの順に並んでいる。
+    """
+    # 組み合わせ（'8 - 6 - 10'、'8 → 6 → 10'など）の馬番
+    _HORSES_PATTERN = re.compile(r'^\s*(\d+)(?:\s*[-→]\s*(\d+))?(?:\s*[-→]\s*(\d+))?')
+    HORSE_COLS = ['horse_1', 'horse_2', 'horse_3']
+
+    def __init__(self, filepath, copy: bool = False, use_cache: bool = True):
         """
         初期処理
         """
-        super().__init__(filepath)
-    
+        super().__init__(filepath, copy, use_cache)
+
     def _preprocess(self):
         """
         前処理
         """
-        return_dict = {}
-        return_dict['tansho'] = self.__tansho()
-        return_dict['fukusho'] = self.__fukusho()
-        return_dict['umaren'] = self.__umaren()
-        return_dict['umatan'] = self.__umatan()
-        return_dict['wide'] = self.__wide()
-        return_dict['sanrentan'] = self.__sanrentan()
-        return_dict['sanrenpuku'] = self.__sanrenpuku()        
-        return return_dict
-    
-    def __tansho(self):
-        """
-        単勝
-        """
-        tansho = self.raw_data[self.raw_data[0]=='単勝'][[1,2]]
-        tansho.columns = ['win', 'return']
-        
-        for column in tansho.columns:
-            tansho[column] = pd.to_numeric(tansho[column], errors='coerce')
-            
-        return tansho
-    
-    def __fukusho(self):
-        """
-        複勝
-        """
-        fukusho = self.raw_data[self.raw_data[0]=='複勝'][[1,2]]
-        wins = fukusho[1].str.split('br', expand=True)[[0,1,2]]
-        
-        wins.columns = ['win_0', 'win_1', 'win_2']
-        returns = fukusho[2].str.split('br', expand=True)[[0,1,2]]
-        returns.columns = ['return_0', 'return_1', 'return_2']
-        
-        df = pd.concat([wins, returns], axis=1)
-        for column in df.columns:
-            df[column] = df[column].str.replace(',', '')
-        return df.fillna(0).astype(int)
-    
-    
-    def __umaren(self):
-        """
-        馬連
-        """
-        umaren = self.raw_data[self.raw_data[0]=='馬連'][[1,2]]
-        wins = umaren[1].str.split('-', expand=True)[[0,1]].add_prefix('win_')
-        return_ = umaren[2].rename('return')  
-        df = pd.concat([wins, return_], axis=1)        
-        return df.apply(lambda x: pd.to_numeric(x, errors='coerce'))
-    
-    
-    def __umatan(self):
-        """
-        馬単
-        """
-        umatan = self.raw_data[self.raw_data[0]=='馬単'][[1,2]]
-        wins = umatan[1].str.split('→', expand=True)[[0,1]].add_prefix('win_')
-        return_ = umatan[2].rename('return')  
-        df = pd.concat([wins, return_], axis=1)        
-        return df.apply(lambda x: pd.to_numeric(x, errors='coerce'))
-    
-    
-    def __wide(self):
-        """
-        ワイド
-        """
-        wide = self.raw_data[self.raw_data[0]=='ワイド'][[1,2]]
-        wins = wide[1].str.split('br', expand=True)[[0,1,2]]
-        wins = wins.stack().str.split('-', expand=True).add_prefix('win_')
-        return_ = wide[2].str.split('br', expand=True)[[0,1,2]]
-        return_ = return_.stack().rename('return')
-        df = pd.concat([wins, return_], axis=1)
-        return df.apply(lambda x: pd.to_numeric(x.str.replace(',',''), errors='coerce'))
-    
-    
-    def __sanrentan(self):
-        """
-        三連単
-        """
-        rentan = self.raw_data[self.raw_data[0]=='三連単'][[1,2]]
-        wins = rentan[1].str.split('→', expand=True)[[0,1,2]].add_prefix('win_')
-        return_ = rentan[2].rename('return')
-        df = pd.concat([wins, return_], axis=1) 
-        return df.apply(lambda x: pd.to_numeric(x, errors='coerce'))
-    
-    
-    def __sanrenpuku(self):
-        """
-        三連複
-        """
-        renpuku = self.raw_data[self.raw_data[0]=='三連複'][[1,2]]
-        wins = renpuku[1].str.split('-', expand=True)[[0,1,2]].add_prefix('win_')
-        return_ = renpuku[2].rename('return')
-        df = pd.concat([wins, return_], axis=1) 
-        return df.apply(lambda x: pd.to_numeric(x, errors='coerce'))
-    
\ No newline at end of file
+        raw = self.raw_data
+        bet_type = raw[0].map(Master.BET_TYPE_DICT)
+        raw = raw[bet_type.notna()]
+
+        # 複勝・ワイドなど1つのセルに複数の払い戻しがあるもの（'br'区切り）を、1組み合わせ1行に展開する
+        wins = raw[1].astype(str).str.split('br', expand=True)
+        returns = raw[2].astype(str).str.split('br', expand=True)
+        n_cols = max(wins.shape[1], returns.shape[1])
+        wins = wins.reindex(columns=range(n_cols)).to_numpy(dtype=object)
+        returns = returns.reindex(columns=range(n_cols)).to_numpy(dtype=object)
+        # rows: rawの行の位置、cols: セル内の位置
+        rows, cols = np.nonzero(pd.notna(wins) & pd.notna(returns))
+
+        horses = pd.Series(wins[rows, cols], dtype=object).str.extract(self._HORSES_PATTERN)
+        horses = horses.apply(pd.to_numeric, errors='coerce').fillna(0).astype('int8').to_numpy()
+        payout = pd.to_numeric(pd.Series(returns[rows, cols], dtype=object).str.replace(',', ''), errors='coerce')
+
+        out = pd.DataFrame({
+            'race_id': pd.to_numeric(raw.index.to_series().astype(str), errors='coerce').to_numpy()[rows],
+            'bet_type': bet_type[bet_type.notna()].astype('int8').to_numpy()[rows],
+            })
+        # 着順を問わない券種は、馬番を昇順にする（使わない列の0は末尾に残す）
+        unordered_codes = [Master.BET_TYPE_DICT[name] for name in Master.UNORDERED_BET_TYPES]
+        unordered = np.isin(out['bet_type'].to_numpy(), unordered_codes)
+        sorted_horses = np.sort(np.where(horses == 0, np.iinfo('int8').max, horses), axis=1)
+        sorted_horses[sorted_horses == np.iinfo('int8').max] = 0
+        horses[unordered] = sorted_horses[unordered]
+        for i, col in enumerate(self.HORSE_COLS):
+            out[col] = horses[:, i]
+        out['payout'] = payout.to_numpy()
+
+        # レースidか払戻金を数値にできないもの（特払いなど）、馬番がないものは除く
+        out = out[out['race_id'].notna() & out['payout'].notna() & (out['horse_1'] > 0)]
+        out = out.astype({'race_id': 'int64', 'payout': 'int64'})
+        return out.sort_values(['race_id', 'bet_type'], kind='stable').reset_index(drop=True)
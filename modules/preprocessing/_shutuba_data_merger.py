@@ -1,4 +1,3 @@
-import os
 import pandas as pd
 
 from ._data_merger import DataMerger
@@ -23,7 +22,9 @@ class ShutubaDataMerger(DataMerger):
         # レース結果テーブル（前処理後）
         self._results = shutuba_table_processor.preprocessed_data
         # 馬の過去成績テーブル（前処理後）
-        self._horse_results = horse_results_processor.preprocessed_data
+        # 出走馬の分だけを、_merge_horse_results実行時に読み込む
+        self._horse_results_processor = horse_results_processor
+        self._horse_results = pd.DataFrame()
         # 馬の基本情報テーブル（前処理後）
         self._horse_info = horse_info_processor.preprocessed_data
         # 血統テーブル（前処理後）
@@ -34,46 +35,17 @@ class ShutubaDataMerger(DataMerger):
         self._group_cols = group_cols
         # 全てのマージが完了したデータ
         self._merged_data = pd.DataFrame()
-        # 日付(date列)ごとに分かれたレース結果
-        self._separated_results_dict = {}
-        # レース結果データのdateごとに分かれた馬の過去成績
-        self._separated_horse_results_dict = {}
+        # モデルが使う特徴量（FeatureRequirements）。Noneなら全ての特徴量を作る
+        self._requirements = None
         
     def merge(self):
         """
         マージ処理
         """
         self._merge_horse_results()
+        self._merge_head_to_head()
         self._merge_horse_info()
         self._merge_peds()
         self._merge_jockey_stats()
-
-    def _merge_jockey_stats(self):
-        """\
-        騎手成績特徴量テーブルのマージ（出馬表ベース）
-
-        data/tmp/jockey_stats.pickle を (date, horse_id) 単位でマージする。
-        ファイルが存在しない場合は何もしない。
-        """
-        stats_path = LocalPaths.JOCKEY_STATS_PATH
-        if not os.path.isfile(stats_path):
-            return
-
-        stats = pd.read_pickle(stats_path)
-        stats = stats.reset_index()  # date, horse_id 列を取り出す
-
-        # 既存の self._merged_data 側にも jockey_id 列があるため、
-        # ここでは騎手特徴量テーブル側の jockey_id は使わずに削除しておく
-        # （重複した列名による "jockey_id_x" / "jockey_id_y" 化を防ぐ）
-        if 'jockey_id' in stats.columns:
-            stats = stats.drop(columns=['jockey_id'])
-
-        base = self._merged_data.copy()
-
-        base = base.merge(
-            stats,
-            on=['date', 'horse_id'],
-            how='left'
-        )
-
-        self._merged_data = base
\ No newline at end of file
+        self._merge_entity_form()
+        self._merge_pedigree_form()
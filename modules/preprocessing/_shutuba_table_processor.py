@@ -3,8 +3,11 @@ from ._results_processor import ResultsProcessor
 from modules.constants import ResultsCols as Cols
 
 class ShutubaTableProcessor(ResultsProcessor):
-    def __init__(self, filepath: str):
-        super().__init__(filepath)
+    # 出馬表はレースごとに取得し直すため、キャッシュしない
+    _CACHEABLE = False
+
+    def __init__(self, filepath: str, copy: bool = False, use_cache: bool = True):
+        super().__init__(filepath, copy, use_cache)
 
     def _preprocess(self):
         df = super()._preprocess()
@@ -125,6 +128,6 @@ class ShutubaTableProcessor(ResultsProcessor):
         
         # 存在する列のみ選択
         available_cols = [col for col in required_cols if col in raw.columns]
-        df = raw.copy()[available_cols]
+        df = raw[available_cols]
         return df
 
@@ -0,0 +1,170 @@
+import os
+import numpy as np
+import pandas as pd
+
+from modules.constants import LocalPaths, Master
+from modules.constants import HorseResultsCols as Cols
+
+
+class StandardTimeTable:
+    """
+    (開催, race_type, course_len, 馬場) ごとの基準タイム（走破タイムの平均）の表。
+    各キーの合計・件数を、4つの軸（開催・race_type・馬場はMasterの順、course_lenは出てきた順）の
+    密な配列で持つため、基準タイムの参照は各軸のコードから求めた位置の配列参照だけで済む（行ごとのマージをしない）。
+
+    - update(): as_ofより後の日付の過去成績の行を、件数・合計に足し込む（bincountによる1回の集計）。
+    - speed_figure(): 基準タイムとの差を1000mあたりの秒数にしたスピード指数（基準より速いほど大きい）。
+      件数がMIN_COUNT未満のキーは、開催を問わない (race_type, course_len, 馬場) の基準タイムを使う。
+    - save() / load(): 1行1キーのテーブル（開催, race_type, course_len, 馬場, count, sum）で保存する。
+
+    DataMergerは、target_colsにspeed_figureが含まれる場合、LocalPaths.STANDARD_TIME_PATHに保存されている表で
+    過去成績にspeed_figure列を追加してから集計する（表がない場合はエラー）。表は過去成績全体から作るため、基準タイムには
+    レース日より後のレースも含まれる（コースごとの定数として扱う）。過去成績を更新した後に、次のように表を進めておく。
+        table = StandardTimeTable.load_if_exists() or StandardTimeTable()
+        table.update(horse_results_processor.iter_chunks())
+        table.save()
+    （update()には、前処理済みの過去成績のDataFrameか、そのチャンクのイテラブルを渡す）
+    表を更新すると全ての日付のspeed_figureが変わるため、FeatureStoreは全ての日付を作り直す。
+    """
+    MIN_COUNT = 5
+    PLACES = tuple(Master.PLACE_DICT.values()) + ('99',)
+    RACE_TYPES = tuple(Master.RACE_TYPE_DICT.values())
+    GROUND_STATES = Master.GROUND_STATE_LIST
+
+    def __init__(self):
+        """
+        初期処理
+        """
+        self.__course_lens = pd.Index([], dtype=float)
+        self.__sums = np.zeros(self.__shape(0))
+        self.__counts = np.zeros(self.__shape(0), dtype=np.int64)
+        self.__as_of = None
+
+    @property
+    def as_of(self):
+        """集計済みの最後の日付"""
+        return self.__as_of
+
+    @property
+    def course_lens(self) -> pd.Index:
+        return self.__course_lens
+
+    def update(self, horse_results) -> int:
+        """
+        前処理済みの過去成績のうち、as_ofより後の日付でタイムのある行を足し込み、足し込んだ行数を返す。
+        horse_resultsには、DataFrameか、DataFrameのチャンクのイテラブル（HorseResultsProcessor.iter_chunks()など）を渡す。
+        チャンクの場合も、全てのチャンクを足し込んだ後にas_ofを進める。
+        """
+        if isinstance(horse_results, pd.DataFrame):
+            horse_results = [horse_results]
+        as_of = self.__as_of
+        n_rows = 0
+        for chunk in horse_results:
+            n_rows += self.__add(chunk, as_of)
+        return n_rows
+
+    def __add(self, horse_results: pd.DataFrame, as_of) -> int:
+        """horse_resultsのうち、as_ofより後の日付の行を足し込み、足し込んだ行数を返す（self.__as_ofは最大の日付に進める）"""
+        horse_results = horse_results[horse_results['date'].notna()]
+        if as_of is not None:
+            horse_results = horse_results[horse_results['date'] > as_of]
+        if len(horse_results) == 0:
+            return 0
+
+        # 新しい距離の分だけ、course_lenの軸を伸ばす
+        course_lens = pd.Index(horse_results['course_len'].dropna().unique()).astype(float)
+        new_lens = course_lens.difference(self.__course_lens)
+        if len(new_lens) > 0:
+            self.__course_lens = self.__course_lens.append(new_lens.sort_values())
+            self.__sums = self.__grow(self.__sums)
+            self.__counts = self.__grow(self.__counts)
+
+        positions = self.__positions(horse_results)
+        times = horse_results['time_seconds'].to_numpy(dtype=float)
+        valid = (positions >= 0) & ~np.isnan(times)
+        size = self.__sums.size
+        self.__sums += np.bincount(positions[valid], weights=times[valid], minlength=size).reshape(self.__sums.shape)
+        self.__counts += np.bincount(positions[valid], minlength=size).reshape(self.__counts.shape)
+        last_date = horse_results['date'].max()
+        self.__as_of = last_date if self.__as_of is None else max(self.__as_of, last_date)
+        return int(valid.sum())
+
+    def standard_times(self, horse_results: pd.DataFrame) -> np.ndarray:
+        """
+        各行（開催, race_type, course_len, 馬場の列を持つ）の基準タイム。基準タイムがない場合は欠損値。
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(self.__counts >= self.MIN_COUNT, self.__sums / np.maximum(self.__counts, 1), np.nan)
+            # 開催を問わない基準タイム（開催の軸で合計したもの）
+            sums, counts = self.__sums.sum(axis=0), self.__counts.sum(axis=0)
+            fallback = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+        fallback = np.broadcast_to(fallback, means.shape)
+        standard = np.where(np.isnan(means), fallback, means).ravel()
+
+        positions = self.__positions(horse_results)
+        out = np.full(len(horse_results), np.nan)
+        out[positions >= 0] = standard[positions[positions >= 0]]
+        return out
+
+    def speed_figure(self, horse_results: pd.DataFrame) -> np.ndarray:
+        """
+        (基準タイム - 走破タイム) を1000mあたりに換算したスピード指数（course_lenは100m単位）
+        """
+        course_len = horse_results['course_len'].to_numpy(dtype=float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (self.standard_times(horse_results) - horse_results['time_seconds'].to_numpy(dtype=float)) \
+                * 10 / course_len
+
+    def save(self, filepath: str = LocalPaths.STANDARD_TIME_PATH) -> None:
+        index = pd.MultiIndex.from_product(
+            [self.PLACES, self.RACE_TYPES, self.__course_lens, self.GROUND_STATES],
+            names=[Cols.PLACE, 'race_type', 'course_len', Cols.GROUND_STATE])
+        table = pd.DataFrame({'count': self.__counts.ravel(), 'sum': self.__sums.ravel()}, index=index)
+        table = table[table['count'] > 0].reset_index()
+        table.attrs = {'as_of': self.__as_of, 'course_lens': self.__course_lens.tolist()}
+        table.to_pickle(filepath)
+
+    @classmethod
+    def load(cls, filepath: str = LocalPaths.STANDARD_TIME_PATH) -> 'StandardTimeTable':
+        table = pd.read_pickle(filepath)
+        standard_time_table = cls()
+        standard_time_table.__course_lens = pd.Index(table.attrs['course_lens'], dtype=float)
+        shape = cls.__shape(len(standard_time_table.__course_lens))
+        standard_time_table.__sums = np.zeros(shape)
+        standard_time_table.__counts = np.zeros(shape, dtype=np.int64)
+        positions = standard_time_table.__positions(table)
+        standard_time_table.__sums.ravel()[positions] = table['sum'].to_numpy()
+        standard_time_table.__counts.ravel()[positions] = table['count'].to_numpy()
+        standard_time_table.__as_of = table.attrs['as_of']
+        return standard_time_table
+
+    @classmethod
+    def load_if_exists(cls, filepath: str = LocalPaths.STANDARD_TIME_PATH) -> 'StandardTimeTable':
+        """
+        保存されている表があれば読み込む。なければNoneを返す。
+        """
+        if not os.path.isfile(filepath):
+            return None
+        return cls.load(filepath)
+
+    def __positions(self, df: pd.DataFrame) -> np.ndarray:
+        """各行のキーの、配列（ravelしたもの）での位置。どれかの軸にない値の場合は-1"""
+        codes = [
+            pd.Categorical(df[Cols.PLACE].astype(str), categories=self.PLACES).codes.astype(np.int64),
+            pd.Categorical(df['race_type'], categories=self.RACE_TYPES).codes.astype(np.int64),
+            self.__course_lens.get_indexer(df['course_len'].astype(float)).astype(np.int64),
+            pd.Categorical(df[Cols.GROUND_STATE], categories=self.GROUND_STATES).codes.astype(np.int64),
+            ]
+        valid = np.logical_and.reduce([code >= 0 for code in codes])
+        positions = np.ravel_multi_index([np.where(valid, code, 0) for code in codes], self.__sums.shape)
+        return np.where(valid, positions, -1)
+
+    def __grow(self, array: np.ndarray) -> np.ndarray:
+        """course_lenの軸を、現在の距離の数まで伸ばす"""
+        grown = np.zeros(self.__shape(len(self.__course_lens)), dtype=array.dtype)
+        grown[:, :, :array.shape[2], :] = array
+        return grown
+
+    @classmethod
+    def __shape(cls, n_course_lens: int) -> tuple:
+        return (len(cls.PLACES), len(cls.RACE_TYPES), n_course_lens, len(cls.GROUND_STATES))
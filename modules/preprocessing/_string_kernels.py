@@ -0,0 +1,135 @@
+"""
+前処理で使う、文字列のパース処理をまとめたモジュール。
+行ごとのlambda・applyの代わりに、ユニークな値だけをパースして元の行に割り当てる（map_unique）。
+レースの日付・タイム・通過順位・馬体重などは行数に比べて値の種類が少ないため、
+パース（コンパイル済みの正規表現によるstr.extractなど）の回数が大きく減る。
+"""
+import re
+import numpy as np
+import pandas as pd
+
+# 通過順位の最初・最後の数値（例: '10-3-9-5' -> 10, 5）
+_FIRST_NUMBER = re.compile(r'^\D*(\d+)')
+_LAST_NUMBER = re.compile(r'(\d+)\D*$')
+# 馬体重（例: '506(-6)' -> '506', '-6'）。'計不'などは体重部分だけになる
+_WEIGHT_AND_DIFF = re.compile(r'^([^(]*)(?:\(([^(]*))?')
+# タイムとして許容するフォーマット（先頭から順に試す）
+_TIME_FORMATS = ['%M:%S.%f', '%M.%S.%f', '%M:%S:%f']
+
+
+def map_unique(s: pd.Series, parse):
+    """
+    sのユニークな値だけをparse（ユニーク値のSeriesを受け取り、同じ長さのSeriesかDataFrameを返す関数）で変換し、
+    元の行に割り当てる。日付・タイム・通過順位・馬体重のように、行数に比べて値の種類が少ない列で使う。
+    欠損値はparseに渡さず、結果も欠損値になる。
+    """
+    codes, uniques = pd.factorize(s, use_na_sentinel=True)
+    parsed = parse(pd.Series(uniques, dtype=object)).reset_index(drop=True)
+    # コード-1（欠損）は、reindexで欠損値（NaN、NaT）になる
+    values = parsed.reindex(codes)
+    values.index = s.index
+    if isinstance(values, pd.Series):
+        values.name = s.name
+    return values
+
+
+def to_datetime_unique(s: pd.Series, format: str = None) -> pd.Series:
+    """
+    pd.to_datetime(s, format=format)と同じ結果を、ユニークな値だけをパースして求める
+    """
+    return map_unique(s, lambda u: pd.to_datetime(u, format=format))
+
+
+def race_time_to_seconds(s: pd.Series) -> pd.Series:
+    """
+    タイム（'1:34.5'など）を秒に変換する。
+    '%M:%S.%f'以外に'%M.%S.%f'、'%M:%S:%f'も許容し、どれにも当てはまらないものは欠損値にする。
+    """
+    basetime = pd.to_datetime('00:00.0', format=_TIME_FORMATS[0])
+
+    def parse(uniques):
+        datetime_s = pd.to_datetime(uniques, format=_TIME_FORMATS[0], errors='coerce')
+        for format_ in _TIME_FORMATS[1:]:
+            datetime_s = datetime_s.fillna(pd.to_datetime(uniques, format=format_, errors='coerce'))
+        return (datetime_s - basetime).dt.total_seconds()
+
+    return map_unique(s, parse)
+
+
+def first_number(s: pd.Series) -> pd.Series:
+    """
+    文字列に含まれる最初の数値（通過順位の最初のコーナーなど）。文字列以外の値はそのまま返す。
+    """
+    return _extract_number(s, _FIRST_NUMBER)
+
+
+def last_number(s: pd.Series) -> pd.Series:
+    """
+    文字列に含まれる最後の数値（通過順位の最終コーナーなど）。文字列以外の値はそのまま返す。
+    """
+    return _extract_number(s, _LAST_NUMBER)
+
+
+def _extract_number(s: pd.Series, pattern) -> pd.Series:
+    if s.dtype != object:
+        # 文字列を含まない
+        return s
+
+    def parse(uniques):
+        extracted = pd.to_numeric(uniques.str.extract(pattern, expand=False), errors='coerce')
+        # 文字列以外の要素は、str.lenが欠損値になる
+        is_str = uniques.str.len().notna()
+        if is_str.all():
+            return extracted
+        return extracted.where(is_str, pd.to_numeric(uniques.where(~is_str), errors='coerce'))
+
+    return map_unique(s, parse)
+
+
+def clip_negative(s: pd.Series) -> pd.Series:
+    """
+    負の値を0にする（1着の着差など）。欠損値はそのまま。
+    """
+    return s.mask(s < 0, 0)
+
+
+def split_sex_age(s: pd.Series):
+    """
+    性齢（'牡3'など）を、性（先頭の1文字）と年齢（2文字目以降を数値にしたもの。変換できない場合は欠損値）に分ける
+    """
+    def parse(uniques):
+        return pd.DataFrame({
+            'sex': uniques.str[0],
+            'age': pd.to_numeric(uniques.str[1:], errors='coerce'),
+            })
+
+    # 欠損値も文字列（'nan'）として扱う
+    parsed = map_unique(s.astype(str), parse)
+    return parsed['sex'], parsed['age']
+
+
+def split_weight_and_diff(s: pd.Series):
+    """
+    馬体重（'506(-6)'など）を、体重と体重変化に分けて数値にする。'計不'などは欠損値になる。
+    """
+    def parse(uniques):
+        parts = uniques.str.extract(_WEIGHT_AND_DIFF)
+        return pd.DataFrame({
+            'weight': pd.to_numeric(parts[0], errors='coerce'),
+            'diff': pd.to_numeric(parts[1].str[:-1], errors='coerce'),
+            })
+
+    parsed = map_unique(s, parse)
+    return parsed['weight'], parsed['diff']
+
+
+def parse_rank(s: pd.Series) -> pd.Series:
+    """
+    着順を整数にする。数字以外のうち'取消'は-1、それ以外（'中止'、'除外'、欠損値など）は0にする。
+    """
+    def parse(uniques):
+        st = uniques.astype(str)
+        values = st.where(st.str.isdigit(), np.where(uniques.eq('取消'), '-1', '0'))
+        return pd.to_numeric(values, errors='coerce')
+
+    return map_unique(s, parse).fillna(0).astype(int)
@@ -1,4 +1,5 @@
 from modules.preprocessing import ReturnProcessor
+from modules.constants import Master
 from itertools import permutations
 from scipy.special import comb
 import numpy as np
@@ -9,14 +10,26 @@ class BettingTickets:
     馬券の買い方と、賭けた時のリターンを計算する。
     """
     def __init__(self, returnProcessor: ReturnProcessor) -> None:
-        self.__returnTables = returnProcessor.preprocessed_data
-        self.__returnTablesTansho = self.__returnTables['tansho']
-        self.__returnTablesFukusho = self.__returnTables['fukusho']
-        self.__returnTablesUmaren = self.__returnTables['umaren']
-        self.__returnTablesUmatan = self.__returnTables['umatan']
-        self.__returnTablesWide = self.__returnTables['wide']
-        self.__returnTablesSanrenpuku = self.__returnTables['sanrenpuku']
-        self.__returnTablesSanrentan = self.__returnTables['sanrentan']
+        # 払い戻し表（1行1組み合わせ。race_id, bet_typeの順に並んでいる）
+        payouts = returnProcessor.preprocessed_data
+        # (race_id, bet_type)を1つのint64にしたキー。searchsortedでレース・券種の行の範囲を求める
+        self.__keys = payouts['race_id'].to_numpy() * 16 + payouts['bet_type'].to_numpy()
+        self.__horses = payouts[ReturnProcessor.HORSE_COLS].to_numpy()
+        self.__payouts = payouts['payout'].to_numpy()
+
+    def _table_1R(self, race_id: str, bet_type: str):
+        """
+        レースid・券種（'単勝'など）に絞った払い戻し表を、(馬番の配列（行数×3）, 払戻金の配列)で返す。
+        払い戻し表にない場合は、KeyErrorを送出する。
+        """
+        try:
+            key = int(race_id) * 16 + Master.BET_TYPE_DICT[bet_type]
+        except ValueError:
+            raise KeyError(race_id)
+        start, stop = np.searchsorted(self.__keys, [key, key + 1])
+        if start == stop:
+            raise KeyError(race_id)
+        return self.__horses[start:stop], self.__payouts[start:stop]
 
     def bet_tansho(self, race_id: str, umaban: list, amount: float):
         """
@@ -32,20 +45,10 @@ class BettingTickets:
             # 賭けた合計額
             bet_amount = n_bets * amount
             # 賭けるレースidに絞った単勝の払い戻し表
-            table_1R = self.__returnTablesTansho.loc[race_id]
-            # table_1R が Series（1行）か DataFrame（複数行）かに応じて安全に処理
-            if isinstance(table_1R, pd.Series):
-                win_vals = np.array([table_1R['win']])
-                ret_vals = np.array([table_1R['return']])
-            else:
-                # DataFrame 想定
-                win_vals = table_1R['win'].to_numpy()
-                ret_vals = table_1R['return'].to_numpy()
-
-            # 勝ち馬番号が賭けた馬番リストに含まれる行を抽出
-            mask = np.isin(win_vals, umaban)
-            # 払戻金をスカラーで計算（複数行あれば合算）
-            return_amount = float((ret_vals[mask] * amount / 100).sum())
+            horses, payouts = self._table_1R(race_id, '単勝')
+            # 勝ち馬番号が賭けた馬番リストに含まれる行の払戻金を合算（同着で複数行の場合も含む）
+            mask = np.isin(horses[:, 0], umaban)
+            return_amount = float((payouts[mask] * amount / 100).sum())
             return n_bets, bet_amount, return_amount
 
     def bet_fukusho(self, race_id: str, umaban: list, amount: float):
@@ -60,25 +63,10 @@ class BettingTickets:
             # 賭けた合計額
             bet_amount = n_bets * amount
             # 賭けるレースidに絞った複勝の払い戻し表
-            table_1R = self.__returnTablesFukusho.loc[race_id]
-            # table_1R が Series（1行）か DataFrame（複数行）かに応じて安全に処理
-            if isinstance(table_1R, pd.Series):
-                table_df = table_1R.to_frame().T
-            else:
-                table_df = table_1R
-
-            win_cols = ['win_0', 'win_1', 'win_2']
-            ret_cols = ['return_0', 'return_1', 'return_2']
-
-            win_vals = table_df[win_cols].to_numpy()
-            ret_vals = table_df[ret_cols].to_numpy()
-
-            # 勝ち馬（複勝対象）のいずれかに賭けていれば的中
-            mask = np.isin(win_vals, umaban).astype(float)
-
-            # 払戻金をスカラーで計算（該当セルが複数あっても全て合算）
-            # ret_vals は object の可能性があるため float 化しておく
-            return_amount = float((mask * ret_vals.astype(float) * amount / 100).sum())
+            horses, payouts = self._table_1R(race_id, '複勝')
+            # 複勝対象の馬のうち、賭けた馬の払戻金を合算
+            mask = np.isin(horses[:, 0], umaban)
+            return_amount = float((payouts[mask] * amount / 100).sum())
             return n_bets, bet_amount, return_amount
 
     def bet_umaren_box(self, race_id: str, umaban: list, amount: float):
@@ -95,19 +83,11 @@ class BettingTickets:
             # 賭けた合計額
             bet_amount = n_bets * amount
             # 賭けるレースidに絞った馬連払い戻し表
-            table_1R = self.__returnTablesUmaren.loc[race_id]
-            if isinstance(table_1R, pd.Series):
-                table_df = table_1R.to_frame().T
-            else:
-                table_df = table_1R
-
-            # 的中判定（行ごとに win_0, win_1 が両方含まれるか）
-            win_vals = table_df[['win_0', 'win_1']].to_numpy()
-            hits_row = np.isin(win_vals, umaban).all(axis=1).astype(float)
-
+            horses, payouts = self._table_1R(race_id, '馬連')
+            # 的中判定（行ごとに2頭とも含まれるか）
+            hits_row = np.isin(horses[:, :2], umaban).all(axis=1)
             # 払い戻し合計額（複数行あっても合算し、必ずスカラーで返す）
-            ret_vals = table_df['return'].to_numpy()
-            return_amount = float((hits_row * ret_vals * amount / 100).sum())
+            return_amount = float((payouts[hits_row] * amount / 100).sum())
         return int(n_bets), bet_amount, return_amount
 
     def _bet_umatan(self, race_id: str, umaban: list, amount: float):
@@ -120,21 +100,11 @@ class BettingTickets:
             return 0, 0, 0
 
         # 賭けるレースidに絞った馬単払い戻し表
-        table_1R = self.__returnTablesUmatan.loc[race_id]
-        if isinstance(table_1R, pd.Series):
-            table_df = table_1R.to_frame().T
-        else:
-            table_df = table_1R
-
+        horses, payouts = self._table_1R(race_id, '馬単')
         # 的中判定（行ごとに順序一致）
-        hits_row = (
-            table_df['win_0'].eq(umaban[0]) &
-            table_df['win_1'].eq(umaban[1])
-        ).to_numpy().astype(float)
-
+        hits_row = (horses[:, 0] == umaban[0]) & (horses[:, 1] == umaban[1])
         # 払い戻し合計額（複数行あっても合算し、必ずスカラーで返す）
-        ret_vals = table_df['return'].to_numpy()
-        return_amount = float((hits_row * ret_vals * amount / 100).sum())
+        return_amount = float((payouts[hits_row] * amount / 100).sum())
         return 1, amount, return_amount
 
     def bet_umatan_box(self, race_id: str, umaban: list, amount: float):
@@ -164,21 +134,11 @@ class BettingTickets:
         # 賭けた合計額
         bet_amount = n_bets * amount
         # 賭けるレースidに絞ったワイド払い戻し表
-        table_1R = self.__returnTablesWide.loc[race_id]
-        if isinstance(table_1R, pd.Series):
-            table_df = table_1R.to_frame().T
-        else:
-            table_df = table_1R
-
-        # 的中判定（行ごとに win_0, win_1 が両方含まれるか）
-        hits_row = (
-            table_df['win_0'].isin(umaban) &
-            table_df['win_1'].isin(umaban)
-        ).to_numpy().astype(float)
-
+        horses, payouts = self._table_1R(race_id, 'ワイド')
+        # 的中判定（行ごとに2頭とも含まれるか）
+        hits_row = np.isin(horses[:, :2], umaban).all(axis=1)
         # 払い戻し合計額（複数行あっても合算し、必ずスカラーで返す）
-        ret_vals = table_df['return'].to_numpy()
-        return_amount = float((hits_row * ret_vals * amount / 100).sum())
+        return_amount = float((payouts[hits_row] * amount / 100).sum())
         return int(n_bets), bet_amount, return_amount
 
     def bet_sanrenpuku_box(self, race_id: str, umaban: list, amount: float):
@@ -190,19 +150,11 @@ class BettingTickets:
         # 賭けた合計額
         bet_amount = n_bets * amount
         # 賭けるレースidに絞った三連複払い戻し表
-        table_1R = self.__returnTablesSanrenpuku.loc[race_id]
-        if isinstance(table_1R, pd.Series):
-            table_df = table_1R.to_frame().T
-        else:
-            table_df = table_1R
-
+        horses, payouts = self._table_1R(race_id, '三連複')
         # 的中判定（行ごとに 3 着すべて含まれるか）
-        win_vals = table_df[['win_0', 'win_1', 'win_2']].to_numpy()
-        hits_row = np.isin(win_vals, umaban).all(axis=1).astype(float)
-
+        hits_row = np.isin(horses, umaban).all(axis=1)
         # 払い戻し合計額（複数行あっても合算し、必ずスカラーで返す）
-        ret_vals = table_df['return'].to_numpy()
-        return_amount = float((hits_row * ret_vals * amount / 100).sum())
+        return_amount = float((payouts[hits_row] * amount / 100).sum())
         return int(n_bets), bet_amount, return_amount
 
     def _bet_sanrentan(self, race_id: str, umaban: list, amount: float):
@@ -214,25 +166,11 @@ class BettingTickets:
             return 0, 0, 0
 
         # 賭けるレースidに絞った三連単払い戻し表
-        table_1R = self.__returnTablesSanrentan.loc[race_id]
-
-        # table_1R が Series（1行）か DataFrame（複数行）かに応じて安全に処理
-        if isinstance(table_1R, pd.Series):
-            table_df = table_1R.to_frame().T
-        else:
-            table_df = table_1R
-
+        horses, payouts = self._table_1R(race_id, '三連単')
         # 的中判定（行ごとに 3 着すべて一致しているか）
-        hits = (
-            table_df['win_0'].eq(umaban[0]) &
-            table_df['win_1'].eq(umaban[1]) &
-            table_df['win_2'].eq(umaban[2])
-        )
-
+        hits_row = (horses == np.asarray(umaban)).all(axis=1)
         # 払戻金をスカラーで計算（該当行が複数あっても合算）
-        hit_array = hits.to_numpy().astype(float)
-        return_array = table_df['return'].to_numpy()
-        return_amount = float((hit_array * return_array * amount / 100).sum())
+        return_amount = float((payouts[hits_row] * amount / 100).sum())
 
         # 1点買いとしてカウント
         return 1, amount, return_amount
@@ -1,11 +1,32 @@
+import os
+import hashlib
+import numpy as np
 import optuna.integration.lightgbm as lgb_o
 
-from modules.constants import ResultsCols
+from modules.constants import LocalPaths, ResultsCols
+from modules.preprocessing import EncodingPlan
 
 
 class DataSplitter:
-    def __init__(self, featured_data, test_size, valid_size) -> None:
+    """
+    特徴量テーブルを、時系列に沿って訓練・テスト（訓練はさらにoptuna用の訓練・検証）に分けるクラス。
+
+    - テーブルはレースの日付順に1度だけ並べ替え、各データはその行の範囲（位置によるスライス）で持つ。
+    - X_train・X_testなどの特徴量だけのテーブルは、参照した時に作る。
+    - optuna用のLightGBMのDatasetは、特徴量をfloat32（またはfloat64）の配列に直接書き込んで作る（object型の配列を経由しない）。
+      use_cache=Trueの場合は、ビン分割済みのDatasetをLightGBMのバイナリ形式でLocalPaths.LGB_DATASET_DIRに保存しておき、
+      同じデータ（配列・目的変数・列・カテゴリ変数のハッシュが同じ）であれば、次からはそれを読み込む（ビン分割をしない）。
+    """
+    # 学習・評価に用いる特徴量からは、目的変数・日付・オッズ・馬番を除外する
+    DROP_COLS = ['rank', 'date', ResultsCols.TANSHO_ODDS, ResultsCols.UMABAN, 'race_id']
+    # バイナリ形式で保存するDatasetの作成時のパラメータ（optunaでmin_data_in_leafなどを変えられるようにする）
+    DATASET_PARAMS = {'feature_pre_filter': False, 'verbose': -1}
+
+    def __init__(self, featured_data, test_size, valid_size, use_cache: bool = True,
+                 cache_dir: str = LocalPaths.LGB_DATASET_DIR) -> None:
         self.__featured_data = featured_data
+        self.__use_cache = use_cache
+        self.__cache_dir = cache_dir
         self.train_valid_test_split(test_size, valid_size)
 
     def train_valid_test_split(self, test_size, valid_size):
@@ -16,37 +37,87 @@ class DataSplitter:
         self.__train_data_optuna, self.__valid_data_optuna = self.__split_by_date(
             self.__train_data, test_size=valid_size
         )
-        # 学習・評価に用いる特徴量からは、目的変数・日付・オッズ・馬番を除外する
-        drop_cols = ['rank', 'date', ResultsCols.TANSHO_ODDS, ResultsCols.UMABAN, 'race_id']
-        self.__lgb_train_optuna = lgb_o.Dataset(
-            self.__train_data_optuna.drop(drop_cols, axis=1).values,
-            self.__train_data_optuna['rank']
-        )
-        self.__lgb_valid_optuna = lgb_o.Dataset(
-            self.__valid_data_optuna.drop(drop_cols, axis=1).values,
-            self.__valid_data_optuna['rank']
-        )
-        # 説明変数と目的変数に分ける。開催はエラーなるので一度drop。
-        self.__X_train = self.__train_data.drop(drop_cols, axis=1)
-        self.__y_train = self.__train_data['rank']
-        self.__X_test = self.__test_data.drop(drop_cols, axis=1)
-        self.__y_test = self.__test_data['rank']
+        self.__feature_cols = [col for col in self.__featured_data.columns if col not in self.DROP_COLS]
+        # EncodingPlan(native=True)で変換した列は、LightGBMのカテゴリ変数として渡す
+        self.__categorical_feature = EncodingPlan.categorical_indices(
+            self.__featured_data[self.__feature_cols].iloc[:0]) or 'auto'
+        # 特徴量だけのテーブル・Datasetは、参照した時に作る
+        self.__X_train = self.__X_test = None
+        self.__lgb_train_optuna = self.__lgb_valid_optuna = None
 
     def __split_by_date(self, df, test_size):
         """
         時系列に沿って訓練データとテストデータに分ける関数。test_sizeは0~1。
+        レースを日付順に並べた最初の (1 - test_size) の割合のレースが訓練データになる。
+        行をレースの順（同じレースの中は元の順）に並べ、訓練・テストはその前後の位置によるスライスにする。
+        """
+        sorted_id_list = df['date'].sort_values().index.unique()
+        n_train = round(len(sorted_id_list) * (1 - test_size))
+        race_order = sorted_id_list.get_indexer(df.index)
+        order = np.argsort(race_order, kind='stable')
+        if not np.array_equal(order, np.arange(len(df))):
+            df = df.take(order)
+            race_order = race_order[order]
+        boundary = np.searchsorted(race_order, n_train, side='left')
+        return df.iloc[:boundary], df.iloc[boundary:]
+
+    def __dataset(self, data, reference=None):
+        """
+        dataのoptuna用のDataset。use_cache=Trueの場合は、バイナリ形式で保存したものがあれば読み込み、なければ保存する。
         """
-        sorted_id_list = df.sort_values("date").index.unique()
-        train_id_list = sorted_id_list[: round(len(sorted_id_list) * (1 - test_size))]
-        test_id_list = sorted_id_list[round(len(sorted_id_list) * (1 - test_size)) :]
-        train = df.loc[train_id_list]
-        test = df.loc[test_id_list]
-        return train, test
+        X = data[self.__feature_cols]
+        # X.valuesと同じ型（LightGBMは、float32・float64以外の配列をfloat32に変換する）の配列に直接書き込む
+        dtype = EncodingPlan.feature_matrix(X.iloc[:0]).dtype
+        if dtype not in (np.float32, np.float64):
+            dtype = np.float32
+        matrix = EncodingPlan.feature_matrix(X, dtype=dtype)
+        label = data['rank'].to_numpy(dtype=np.float32)
+        if not self.__use_cache:
+            return lgb_o.Dataset(matrix, label, categorical_feature=self.__categorical_feature, reference=reference)
+
+        h = hashlib.blake2b(digest_size=16)
+        h.update(np.ascontiguousarray(matrix).view(np.uint8))
+        h.update(label.view(np.uint8))
+        h.update(repr((self.__feature_cols, self.__categorical_feature, self.DATASET_PARAMS,
+                       getattr(reference, 'mykeiba_fingerprint', None))).encode())
+        fingerprint = h.hexdigest()
+        filepath = os.path.join(self.__cache_dir, fingerprint + '.bin')
+        if os.path.isfile(filepath):
+            dataset = lgb_o.Dataset(filepath, params=self.DATASET_PARAMS, reference=reference)
+        else:
+            dataset = lgb_o.Dataset(matrix, label, categorical_feature=self.__categorical_feature,
+                                    reference=reference, params=self.DATASET_PARAMS).construct()
+            os.makedirs(self.__cache_dir, exist_ok=True)
+            tmp_path = filepath + '.tmp-{}'.format(os.getpid())
+            dataset.save_binary(tmp_path)
+            os.replace(tmp_path, filepath)
+        dataset.mykeiba_fingerprint = fingerprint
+        return dataset
+
+    def __getstate__(self):
+        # 特徴量だけのテーブル・Dataset（LightGBMのハンドルを持つ）は、読み込み後に作り直すため保存しない
+        state = self.__dict__.copy()
+        for name in ('__X_train', '__X_test', '__lgb_train_optuna', '__lgb_valid_optuna'):
+            state['_DataSplitter' + name] = None
+        return state
+
+    def __setstate__(self, state):
+        # 以前のバージョンで保存したもの（X_trainなどを全て持つ）は、特徴量の列をX_trainから求める
+        if '_DataSplitter__feature_cols' not in state:
+            state['_DataSplitter__feature_cols'] = list(state['_DataSplitter__X_train'].columns)
+            state.setdefault('_DataSplitter__use_cache', False)
+            state.setdefault('_DataSplitter__cache_dir', LocalPaths.LGB_DATASET_DIR)
+        self.__dict__.update(state)
 
     @property
     def featured_data(self):
         return self.__featured_data
 
+    @property
+    def feature_columns(self) -> list:
+        """学習・評価に用いる特徴量の列"""
+        return self.__feature_cols
+
     @property
     def train_data(self):
         return self.__train_data
@@ -65,27 +136,40 @@ class DataSplitter:
 
     @property
     def lgb_train_optuna(self):
+        if self.__lgb_train_optuna is None:
+            self.__lgb_train_optuna = self.__dataset(self.__train_data_optuna)
         return self.__lgb_train_optuna
 
     @property
     def lgb_valid_optuna(self):
+        if self.__lgb_valid_optuna is None:
+            self.__lgb_valid_optuna = self.__dataset(self.__valid_data_optuna, reference=self.lgb_train_optuna)
         return self.__lgb_valid_optuna
 
+    @property
+    def categorical_feature(self):
+        """LightGBMのcategorical_featureに渡す値（カテゴリ変数の列の位置。なければ'auto'）"""
+        return self.__categorical_feature
+
     @property
     def X_train(self):
+        if self.__X_train is None:
+            self.__X_train = self.__train_data[self.__feature_cols]
         return self.__X_train
 
     @property
     def y_train(self):
-        return self.__y_train
+        return self.__train_data['rank']
 
     @property
     def X_test(self):
+        if self.__X_test is None:
+            self.__X_test = self.__test_data[self.__feature_cols]
         return self.__X_test
 
     @property
     def y_test(self):
-        return self.__y_test
+        return self.__test_data['rank']
 
     @property
     def tansho_odds_test(self):
@@ -4,6 +4,7 @@ from ._model_wrapper import ModelWrapper
 from ._data_splitter import DataSplitter
 from modules.policies import AbstractScorePolicy
 from modules.constants import ResultsCols
+from modules.preprocessing import FeatureRequirements
 
 class KeibaAI:
     """
@@ -45,6 +46,17 @@ class KeibaAI:
     def feature_importance(self, num_features=20):
         return self.__model_wrapper.feature_importance[:num_features]
 
+    def feature_requirements(self, min_importance: float = 0) -> FeatureRequirements:
+        """
+        学習済みモデルが使う特徴量（FeatureRequirements）。当日の予測で、ShutubaDataMerger・FeatureEngineeringの
+        require()に渡すと、モデルが使わない特徴量を作らなくなる。
+        重要度がmin_importance以下の特徴量は使わないものとする（0なら分岐に使われていない特徴量だけを省くため、
+        スコアは変わらない）。
+        """
+        model = self.__model_wrapper.lgb_model
+        features = getattr(model, 'mykeiba_feature_columns_', None) or list(self.__datasets.feature_columns)
+        return FeatureRequirements(features, getattr(model, 'feature_importances_', None), min_importance)
+
     def calc_score(self, X: pd.DataFrame, score_policy: AbstractScorePolicy):
         """score_policyを元に、馬の「勝ちやすさスコア」を計算する。
 
@@ -82,7 +94,7 @@ class KeibaAI:
         # 列整列で全0化→全馬同一スコアになり得る。
         # KeibaAIはDataSplitterを保持しているため、学習時の列名をここで注入する。
         try:
-            train_cols = list(self.__datasets.X_train.columns)
+            train_cols = list(self.__datasets.feature_columns)
             if train_cols and not hasattr(model, 'mykeiba_feature_columns_'):
                 setattr(model, 'mykeiba_feature_columns_', train_cols)
         except Exception:
@@ -90,6 +102,20 @@ class KeibaAI:
 
         return score_policy.calc(model, X)
 
+    def calc_score_by_race(self, X: pd.DataFrame, score_policy: AbstractScorePolicy) -> dict:
+        """
+        複数レースの特徴量（race_id列、またはインデックスがrace_id）のスコアを1度の予測で計算し、
+        レースごとにスコアの高い順に並べた score_table の dict（race_id -> score_table）にして返す。
+        レース内で標準化するscore_policyは、レースごとにcalc_scoreした場合と同じスコアになる
+        （MinMaxScorePolicyの0~1へのスケーリングは、渡した全レースで行う）。
+        """
+        score_table = self.calc_score(X, score_policy)
+        race_ids = score_table['race_id'] if 'race_id' in score_table.columns else score_table.index.to_series()
+        return {
+            race_id: table.sort_values('score', ascending=False)
+            for race_id, table in score_table.groupby(race_ids.to_numpy(), sort=False)
+            }
+
     def decide_action(self, score_table: pd.DataFrame,
         bet_policy: AbstractBetPolicy, **params) -> dict:
         """
@@ -4,6 +4,7 @@ from sklearn.metrics import roc_auc_score
 import optuna.integration.lightgbm as lgb_o
 
 from ._data_splitter import DataSplitter
+from modules.preprocessing import EncodingPlan
 
 
 class ModelWrapper:
@@ -52,7 +53,10 @@ class ModelWrapper:
 
     def train(self, datasets: DataSplitter):
         # 学習
-        self.__lgb_model.fit(datasets.X_train.values, datasets.y_train.values)
+        self.__lgb_model.fit(
+            EncodingPlan.feature_matrix(datasets.X_train), datasets.y_train.values,
+            categorical_feature=getattr(datasets, 'categorical_feature', 'auto')
+            )
         # 学習時の列名をモデルに保持（predict時の整列に利用）
         try:
             self.__lgb_model.feature_name_ = list(datasets.X_train.columns)